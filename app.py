@@ -1,17 +1,55 @@
-from fastapi import FastAPI, APIRouter, responses
+import asyncio
+import concurrent.futures
+import json
+import math
+import threading
+from typing import Callable, Iterator, Optional, Union
+from fastapi import FastAPI, APIRouter, Request, responses
 from fastapi.staticfiles import StaticFiles
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from logic.funcs import get_funcs, add_func, invoke_func, modify_func, delete_func
-from logic.libs import install_libs, get_libs, install_on_startup
-from models import GetUserFuncsRequest, CreateFuncRequest, ExecFuncRequest, ModifyFuncRequest, DelFuncRequest, LibInstallRequest
+from logic.funcs import (get_funcs, iter_funcs, encode_cursor, decode_cursor, add_func, add_funcs, export_funcs,
+                         invoke_func, invoke_batch, modify_func, delete_func, create_token, get_func_versions,
+                         set_func_alias, install_func_libs, get_owned_entry)
+from logic.libs import submit_install, get_libs, install_on_startup
+from logic.pool import get_pool
+from logic.zygote import get_zygote
+from logic.jobs import invoke_jobs, lib_jobs
+from logic.scheduler import scheduler, Rejected, Ticket
+from logic.metrics import registry
+from logic.catalog import get_catalog
+from logic.invoke import prepared_cache, result_cache
+from logic.compaction import compactor
+from models import (TokenRequest, GetUserFuncsRequest, CreateFuncRequest, BulkCreateFuncRequest, ExecFuncRequest, BatchExecFuncRequest,
+                    VersionsRequest, AliasRequest, ModifyFuncRequest, DelFuncRequest, LibInstallRequest,
+                    FuncLibInstallRequest)
 from utils import create_dir
-from config import FUNC_STORE, CONF_STORE
+from config import FUNC_STORE, CONF_STORE, POOL_SIZE, STREAM_BUFFER, TIME_LIMIT, LIST_PAGE_LIMIT, BULK_MAX_FUNCTIONS
 
 # Initialize directories
 create_dir(FUNC_STORE)
 create_dir(CONF_STORE)
 
-install_on_startup(f'{CONF_STORE}/cloud_requirements.txt')
+# Index store files that changed while the server was down
+get_catalog(FUNC_STORE)
+
+# Install the libraries off the critical path, the port opens right away and /api/ready tells when they are
+startup = {'status': 'starting', 'message': 'Server is installing libraries'}
+
+
+def prepare_server() -> None:
+    try:
+        install_on_startup(f'{CONF_STORE}/cloud_requirements.txt')
+        # Start the zygote then the warm workers forked from it, after the libraries are ready
+        get_zygote()
+        if POOL_SIZE > 0:
+            get_pool()
+        startup.update(status='ready', message='Server is ready')
+    except Exception as e:
+        startup.update(status='error', message=f'Could not install libraries: {e}')
+
+
+threading.Thread(target=prepare_server, name='startup', daemon=True).start()
 
 app = FastAPI()
 app.add_middleware(
@@ -42,6 +80,14 @@ def root_redirect() -> responses.RedirectResponse:
     return responses.RedirectResponse(url='/static/index.html')
 
 
+@app.get("/metrics")
+def get_metrics() -> responses.PlainTextResponse:
+    '''
+    Invocation metrics in the Prometheus text format
+    '''
+    return responses.PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
+
+
 @router.get("/")
 def read_root() -> dict:
     '''
@@ -57,30 +103,77 @@ def read_root() -> dict:
         return res
 
 
+def stream_listing(limit: Optional[int], cursor: Optional[str], prefix: Optional[str], target: Optional[str],
+                   username: str = 'admin', password: str = 'admin', token: Optional[str] = None) -> responses.StreamingResponse:
+    '''
+    Stream 1 page of a function listing as JSON, in the same shape as other responses.
+    data.next_cursor fetches the next page, it is null on the last one
+    Raise if the page cannot be listed or is empty
+    '''
+    if limit is not None and not 1 <= limit <= LIST_PAGE_LIMIT:
+        raise Exception(f'limit must be between 1 and {LIST_PAGE_LIMIT}')
+    after = decode_cursor(cursor) if cursor else None
+    funcs = iter_funcs('functions_store', username, password, token, after, prefix, target)
+    first = next(funcs, None)
+    if first is None:
+        raise Exception('No functions found')
+
+    def body() -> Iterator[str]:
+        yield '{"status": "success", "message": "All functions retrieved successfully", "data": {"functions": {'
+        chunk, total, current, position = [], 0, None, None
+        item = first
+        while item is not None and (limit is None or total < limit):
+            # functions come ordered by target, so each target is 1 contiguous list
+            item_target, func, position = item
+            if item_target != current:
+                chunk.append(f'{"], " if current is not None else ""}{json.dumps(item_target)}: [')
+                current = item_target
+            else:
+                chunk.append(', ')
+            chunk.append(json.dumps(func))
+            total += 1
+            if len(chunk) >= 256:
+                yield ''.join(chunk)
+                chunk = []
+            item = next(funcs, None)
+
+        next_cursor = encode_cursor(position) if item is not None else None
+        chunk.append(f']}}, "total": {total}, "next_cursor": {json.dumps(next_cursor)}}}}}')
+        yield ''.join(chunk)
+
+    return responses.StreamingResponse(body(), media_type='application/json')
+
+
 @router.get("/admin/functions")
-def get_all_funcs() -> dict:
+def get_all_funcs(limit: Optional[int] = None, cursor: Optional[str] = None,
+                  prefix: Optional[str] = None, target: Optional[str] = None) -> dict:
     '''
     Get all serverless functions from functions_store
+    Pass limit to get 1 page, then cursor=data.next_cursor for the next one.
+    prefix filters function names, target keeps 1 store file or function
     '''
     res = RESPONSE_TEMPLATE.copy()
     try:
-        all_funcs = get_funcs(target_dir='functions_store')
-
-        if all_funcs is None:
-            raise Exception('No functions found')
-
-        res['data'] = {
-            'total': len(list(all_funcs.values())[0]),
-            'functions': all_funcs
-        }
-        res['status'] = 'success'
-        res['message'] = 'All functions retrieved successfully'
+        res = stream_listing(limit, cursor, prefix, target)
     except Exception as e:
         res['message'] = str(e)
     finally:
         return res
 
 
+def stream_export(username: str, password: str, token: Optional[str] = None) -> responses.StreamingResponse:
+    '''
+    Stream functions as 1 JSON array, ready to be sent back to /functions/bulk
+    '''
+    def body() -> Iterator[str]:
+        yield '['
+        for i, func in enumerate(export_funcs('functions_store', username, password, token)):
+            yield (', ' if i else '') + json.dumps(func)
+        yield ']'
+
+    return responses.StreamingResponse(body(), media_type='application/json')
+
+
 @router.get("/admin/functions/{func_name}")
 def get_func(func_name: str) -> dict:
     '''
@@ -104,30 +197,80 @@ def get_func(func_name: str) -> dict:
     finally:
         return res
 
+@router.post("/auth/token")
+def get_session_token(token_request: TokenRequest) -> dict:
+    '''
+    Log in once, then send the token instead of a username and password
+    '''
+    res = RESPONSE_TEMPLATE.copy()
+    try:
+        session = create_token('functions_store', token_request.username, token_request.password)
+        if session is None:
+            raise Exception('Invalid username or password')
+
+        res['status'] = 'success'
+        res['message'] = 'Session token created successfully'
+        res['data'] = session
+    except Exception as e:
+        res['message'] = str(e)
+    finally:
+        return res
+
+
 @router.post("/users/functions")
-def get_user_funcs(get_request: GetUserFuncsRequest) -> dict:
+def get_user_funcs(get_request: GetUserFuncsRequest, limit: Optional[int] = None, cursor: Optional[str] = None,
+                   prefix: Optional[str] = None, target: Optional[str] = None) -> dict:
     '''
     Get all serverless functions from functions_store
+    Pages and filters work like in /admin/functions
     Permission: Normal USER
     '''
     res = RESPONSE_TEMPLATE.copy()
     try:
-        all_funcs = get_funcs(target_dir='functions_store', author=get_request.username,
-                          password=get_request.password)
-        if all_funcs is None:
-            raise Exception('No functions found')
+        res = stream_listing(limit, cursor, prefix, target, get_request.username,
+                             get_request.password, get_request.token)
+    except Exception as e:
+        res['message'] = str(e)
+    finally:
+        return res
 
-        res['data'] = {
-            'total': len(list(all_funcs.values())[0]),
-            'functions': all_funcs
-        }
+@router.post("/users/functions/export")
+def export_user_funcs(get_request: GetUserFuncsRequest) -> responses.StreamingResponse:
+    '''
+    Export the latest version of every function of a user, with its source
+    Permission: Normal USER
+    '''
+    return stream_export(get_request.username, get_request.password, get_request.token)
+
+
+@router.post("/functions/bulk")
+def add_new_funcs(bulk_request: BulkCreateFuncRequest) -> dict:
+    '''
+    Add many serverless functions to functions_store in 1 request
+    data.results has 1 result per function, in order
+    '''
+    res = RESPONSE_TEMPLATE.copy()
+    try:
+        if len(bulk_request.functions) > BULK_MAX_FUNCTIONS:
+            raise Exception(f'At most {BULK_MAX_FUNCTIONS} functions can be added at once')
+
+        results = add_funcs([{
+            'content': func.content,
+            'deterministic': func.deterministic,
+            'author': bulk_request.username if bulk_request.username is not None else func.username,
+            'password': bulk_request.password if bulk_request.password is not None else func.password,
+        } for func in bulk_request.functions], target_dir='functions_store')
+
+        added = sum(result['status'] == 'success' for result in results)
         res['status'] = 'success'
-        res['message'] = 'All functions retrieved successfully'
+        res['message'] = f'Successfully added {added} of {len(results)} functions'
+        res['data'] = {'added': added, 'results': results}
     except Exception as e:
         res['message'] = str(e)
     finally:
         return res
 
+
 @router.post("/functions")
 def add_new_func(func_request: CreateFuncRequest) -> dict:
     '''
@@ -138,9 +281,9 @@ def add_new_func(func_request: CreateFuncRequest) -> dict:
         content = func_request.content
         print('Function request:', func_request)
         output = add_func(content, target_dir='functions_store', author=func_request.username,
-                          password=func_request.password)
+                          password=func_request.password, deterministic=func_request.deterministic)
         if output is None:
-            raise Exception('Function already exists')
+            raise Exception('Function already exists or is invalid')
 
         res['status'] = 'success'
         res['message'] = f'Successfully added function to store {output}'
@@ -151,25 +294,186 @@ def add_new_func(func_request: CreateFuncRequest) -> dict:
         return res
 
 
+def get_caller(func_name: str, request: Union[ExecFuncRequest, BatchExecFuncRequest]) -> Union[str, None]:
+    '''
+    The authenticated owner behind a request, once its session token covers the function
+    or its password matches it. None when neither checks out
+    Admission is charged to this user, so nobody can use up the limits of another one
+    '''
+    entry = get_owned_entry(func_name, 'functions_store', request.target, request.username, request.password,
+                            request.token or None)
+    return entry['author'] if entry is not None else None
+
+
+async def authenticate(func_name: str, body: Union[ExecFuncRequest, BatchExecFuncRequest],
+                       request: Request) -> Union[str, None]:
+    '''
+    Get the caller of an execute request, raise Rejected if its client failed to authenticate too often
+    '''
+    client = request.client.host if request.client is not None else ''
+    scheduler.check_client(client)
+    # bcrypt runs off the event loop
+    caller = await asyncio.to_thread(get_caller, func_name, body)
+    if caller is None:
+        scheduler.fail_client(client)
+    return caller
+
+
+def admit(func_name: str, username: str, target: str) -> Ticket:
+    '''
+    Ask the scheduler for a slot, raise Rejected right away if there is none to wait for
+    '''
+    return scheduler.enqueue(username, f'{target}:{func_name}')
+
+
+def too_many_requests(rejected: Rejected) -> responses.JSONResponse:
+    '''
+    Tell the client to come back later, without running anything
+    '''
+    res = RESPONSE_TEMPLATE.copy()
+    res['message'] = str(rejected)
+    res['data'] = {'retry_after': rejected.retry_after}
+    return responses.JSONResponse(res, status_code=429,
+                                  headers={'Retry-After': str(math.ceil(rejected.retry_after))})
+
+
+def run_invocation(func_name: str, exec_request: ExecFuncRequest, on_output: Callable[[str, str], None] = None) -> dict:
+    '''
+    Invoke a function for an execute request, raise if it did not run
+    '''
+    output = invoke_func(
+        func_name, exec_request.params, target_dir='functions_store', target_file=exec_request.target,
+        author=exec_request.username, password=exec_request.password, on_output=on_output, token=exec_request.token,
+        alias=exec_request.alias, version=exec_request.version)
+
+    if output is None:
+        raise Exception('Your function did not run successfully')
+    return output
+
+
+def stream_invocation(func_name: str, exec_request: ExecFuncRequest, ticket: Ticket) -> responses.StreamingResponse:
+    '''
+    Invoke a function and stream its stdout/stderr lines as Server-Sent Events,
+    the last event carries the return value.
+    Only STREAM_BUFFER events are buffered, a slow client blocks the function output
+    '''
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue(maxsize=STREAM_BUFFER)
+    disconnected = threading.Event()
+
+    def emit(event: str, data: dict) -> None:
+        # Wait for room in the buffer, give up once the client is gone or never reads
+        future = asyncio.run_coroutine_threadsafe(events.put((event, data)), loop)
+        for _ in range(TIME_LIMIT):
+            if disconnected.is_set():
+                break
+            try:
+                return future.result(timeout=1)
+            except concurrent.futures.TimeoutError:
+                continue
+        disconnected.set()
+        future.cancel()
+
+    def run() -> None:
+        try:
+            output = scheduler.run(ticket, run_invocation, func_name, exec_request,
+                                   on_output=lambda name, line: emit(name, {'line': line}))
+            emit('result', {'status': 'success', 'message': f'Successfully executed function {func_name}',
+                            'return_value': output['return_value']})
+        except Exception as e:
+            emit('result', {'status': 'error', 'message': str(e), 'return_value': None})
+
+    async def event_stream():
+        try:
+            while True:
+                event, data = await events.get()
+                yield f'event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n'
+                if event == 'result':
+                    break
+        finally:
+            disconnected.set()
+
+    invoke_jobs.run_now(run)
+    return responses.StreamingResponse(event_stream(), media_type='text/event-stream')
+
+
 @router.post("/execute/{func_name}")
-def execute_func(func_name: str, exec_request: ExecFuncRequest) -> dict:
+async def execute_func(func_name: str, exec_request: ExecFuncRequest, request: Request, mode: str = 'sync') -> dict:
     '''
     Execute a function from functions_store
     Expect user to call get functions first to get the function name and target file
+    mode=sync waits for the result, mode=async returns a job id to poll at /jobs/{job_id},
+    mode=stream sends the output as Server-Sent Events while the function runs
+    Answer 429 with a Retry-After header when the user or the server is too busy
     '''
+    if mode not in ('sync', 'async', 'stream'):
+        res = RESPONSE_TEMPLATE.copy()
+        res['message'] = f'Unknown execution mode {mode}'
+        return res
+
+    try:
+        caller = await authenticate(func_name, exec_request, request)
+        if caller is None:
+            res = RESPONSE_TEMPLATE.copy()
+            res['message'] = 'Your function did not run successfully'
+            return res
+        ticket = admit(func_name, caller, exec_request.target)
+    except Rejected as e:
+        return too_many_requests(e)
+
+    if mode == 'stream':
+        return stream_invocation(func_name, exec_request, ticket)
+
     res = RESPONSE_TEMPLATE.copy()
     try:
-        params = exec_request.params
-        target_file = exec_request.target
-        output = invoke_func(
-            func_name, params, target_dir='functions_store', target_file=target_file,
-            author=exec_request.username, password=exec_request.password)
+        if mode == 'async':
+            job = invoke_jobs.submit(scheduler.run, ticket, run_invocation, func_name, exec_request)
+            res['status'] = 'success'
+            res['message'] = f'Function {func_name} is queued for execution'
+            res['data'] = job.to_dict()
+            return res
+
+        # Run on the invocation executor, web server threads stay free
+        output = await asyncio.wrap_future(
+            invoke_jobs.run_now(scheduler.run, ticket, run_invocation, func_name, exec_request))
+
+        res['status'] = 'success'
+        res['message'] = f'Successfully executed function {func_name}'
+        res['data'] = output
+    except Exception as e:
+        res['message'] = str(e)
+    finally:
+        return res
+
+
+@router.post("/execute/{func_name}/batch")
+async def execute_func_batch(func_name: str, batch_request: BatchExecFuncRequest, request: Request) -> dict:
+    '''
+    Execute a function from functions_store once per item, all items run in 1 process
+    Results are returned in the same order as the items
+    '''
+    try:
+        caller = await authenticate(func_name, batch_request, request)
+        if caller is None:
+            res = RESPONSE_TEMPLATE.copy()
+            res['message'] = 'Your function did not run successfully'
+            return res
+        ticket = admit(func_name, caller, batch_request.target)
+    except Rejected as e:
+        return too_many_requests(e)
+
+    res = RESPONSE_TEMPLATE.copy()
+    try:
+        output = await asyncio.wrap_future(invoke_jobs.run_now(
+            scheduler.run, ticket, invoke_batch, func_name, batch_request.items, target_dir='functions_store', target_file=batch_request.target,
+            author=batch_request.username, password=batch_request.password, item_timeout=batch_request.item_timeout,
+            token=batch_request.token, alias=batch_request.alias, version=batch_request.version))
 
         if output is None:
             raise Exception('Your function did not run successfully')
 
         res['status'] = 'success'
-        res['message'] = f'Successfully executed function {func_name}'
+        res['message'] = f'Successfully executed function {func_name} on {len(output)} items'
         res['data'] = output
     except Exception as e:
         res['message'] = str(e)
@@ -177,20 +481,42 @@ def execute_func(func_name: str, exec_request: ExecFuncRequest) -> dict:
         return res
 
 
+@router.get("/jobs/{job_id}")
+def get_job(job_id: str) -> dict:
+    '''
+    Get the status and result of an asynchronous execution
+    '''
+    res = RESPONSE_TEMPLATE.copy()
+    try:
+        job = invoke_jobs.get(job_id)
+        if job is None:
+            raise Exception('Job not found')
+
+        res['status'] = 'success'
+        res['message'] = f'Job is {job.status}'
+        res['data'] = job.to_dict()
+    except Exception as e:
+        res['message'] = str(e)
+    finally:
+        return res
+
+
 @router.put("/functions/{func_name}")
 def modify_existing_func(func_name: str, modify_request: ModifyFuncRequest) -> dict:
     '''
     Modify an existing serverless function in functions_store
     Expect user to call get functions first to get the function name and target file
+    Permission: Owner
     '''
     res = RESPONSE_TEMPLATE.copy()
     try:
         content = modify_request.content
         target_file = modify_request.target
         target_file = modify_func(
-            func_name, content, target_dir='functions_store', target_file=target_file)
+            func_name, content, target_dir='functions_store', target_file=target_file,
+            author=modify_request.username, password=modify_request.password, token=modify_request.token)
         if target_file is None:
-            raise Exception('Function not found')
+            raise Exception('Function not found or invalid')
         res['status'] = 'success'
         res['message'] = f'Successfully modified function {func_name}'
     except Exception as e:
@@ -199,17 +525,66 @@ def modify_existing_func(func_name: str, modify_request: ModifyFuncRequest) -> d
         return res
 
 
+@router.post("/functions/{func_name}/versions")
+def get_versions(func_name: str, versions_request: VersionsRequest) -> dict:
+    '''
+    Get the versions of a function and where its aliases point
+    Permission: Owner
+    '''
+    res = RESPONSE_TEMPLATE.copy()
+    try:
+        versions = get_func_versions(func_name, target_dir='functions_store', target_file=versions_request.target,
+                                     author=versions_request.username, password=versions_request.password,
+                                     token=versions_request.token)
+        if versions is None:
+            raise Exception('Function not found')
+
+        res['status'] = 'success'
+        res['message'] = f'Successfully retrieved versions of function {func_name}'
+        res['data'] = versions
+    except Exception as e:
+        res['message'] = str(e)
+    finally:
+        return res
+
+
+@router.put("/functions/{func_name}/aliases/{alias}")
+def set_alias(func_name: str, alias: str, alias_request: AliasRequest) -> dict:
+    '''
+    Point an alias of a function to one of its versions, to deploy or roll back
+    Permission: Owner
+    '''
+    res = RESPONSE_TEMPLATE.copy()
+    try:
+        aliases = set_func_alias(func_name, alias, alias_request.version, target_dir='functions_store',
+                                 target_file=alias_request.target, author=alias_request.username,
+                                 password=alias_request.password, token=alias_request.token)
+        if aliases is None:
+            raise Exception('Function or version not found')
+
+        res['status'] = 'success'
+        res['message'] = f'Alias {alias} of function {func_name} now points to {alias_request.version}'
+        res['data'] = {'aliases': aliases}
+    except Exception as e:
+        res['message'] = str(e)
+    finally:
+        return res
+
+
 @router.delete("/functions/{func_name}")
 def delete_existing_func(func_name: str, del_request: DelFuncRequest) -> dict:
     '''
     Delete an existing serverless function from functions_store
     Expect user to call get functions first to get the function name and target file
+    Permission: Owner
     '''
     res = RESPONSE_TEMPLATE.copy()
     try:
-        target_file = del_request.target
-        delete_func(func_name, target_dir='functions_store',
-                    target_file=target_file)
+        target_file = delete_func(func_name, target_dir='functions_store', target_file=del_request.target,
+                                  author=del_request.username, password=del_request.password,
+                                  token=del_request.token)
+        if target_file is None:
+            raise Exception('Function not found')
         res['status'] = 'success'
         res['message'] = f'Successfully deleted function {func_name}'
     except Exception as e:
@@ -218,6 +593,97 @@ def delete_existing_func(func_name: str, del_request: DelFuncRequest) -> dict:
         return res
 
 
+@router.get("/ready")
+def get_readiness() -> dict:
+    '''
+    Tell if the libraries are installed and the warm workers started, answer 503 until then
+    '''
+    res = RESPONSE_TEMPLATE.copy()
+    try:
+        res['message'] = startup['message']
+        if startup['status'] == 'ready':
+            res['status'] = 'success'
+        else:
+            res = responses.JSONResponse(res, status_code=503)
+    except Exception as e:
+        res['message'] = str(e)
+    finally:
+        return res
+
+
+@router.get("/admin/cache")
+def get_cache_stats() -> dict:
+    '''
+    Get hit and miss counts of the invocation caches
+    Permission: ADMIN
+    '''
+    res = RESPONSE_TEMPLATE.copy()
+    try:
+        res['data'] = {
+            'prepared': prepared_cache.stats(),
+            'results': result_cache.stats(),
+        }
+        res['status'] = 'success'
+        res['message'] = 'Cache stats retrieved successfully'
+    except Exception as e:
+        res['message'] = str(e)
+    finally:
+        return res
+
+
+@router.get("/admin/scheduler")
+def get_scheduler_stats() -> dict:
+    '''
+    Get running and queued invocations and how long they waited
+    Permission: ADMIN
+    '''
+    res = RESPONSE_TEMPLATE.copy()
+    try:
+        res['data'] = scheduler.stats()
+        res['status'] = 'success'
+        res['message'] = 'Scheduler stats retrieved successfully'
+    except Exception as e:
+        res['message'] = str(e)
+    finally:
+        return res
+
+
+@router.get("/admin/compact")
+def get_compaction_stats() -> dict:
+    '''
+    Get the garbage left since the last compaction and the status of that compaction
+    Permission: ADMIN
+    '''
+    res = RESPONSE_TEMPLATE.copy()
+    try:
+        res['data'] = compactor.stats()
+        res['status'] = 'success'
+        res['message'] = 'Compaction stats retrieved successfully'
+    except Exception as e:
+        res['message'] = str(e)
+    finally:
+        return res
+
+
+@router.post("/admin/compact")
+def compact_store() -> dict:
+    '''
+    Remove store files nothing runs anymore, in the background
+    A compaction already running is returned instead of starting another one
+    Permission: ADMIN
+    '''
+    res = RESPONSE_TEMPLATE.copy()
+    try:
+        job = compactor.start(FUNC_STORE)
+        res['status'] = 'success'
+        res['message'] = f'Compaction is {job.status}'
+        res['data'] = job.to_dict()
+    except Exception as e:
+        res['message'] = str(e)
+    finally:
+        return res
+
+
 @router.get("/libs")
 def get_installed_libs() -> dict:
     '''
@@ -239,16 +705,65 @@ def get_installed_libs() -> dict:
 def install_libraries(lib_request: LibInstallRequest) -> dict:
     '''
     Install Python libraries required by users
+    Installs run in the background, poll the returned job at /libs/jobs/{job_id}
     '''
     res = RESPONSE_TEMPLATE.copy()
     try:
         libs = lib_request.libs
         print('Installing libraries:', libs)
         
-        install_libs(libs, f'{CONF_STORE}/cloud_requirements.txt')
+        job = submit_install(libs, f'{CONF_STORE}/cloud_requirements.txt')
+        res['status'] = 'success'
+        res['message'] = f'Installation of libraries is {job.status}'
+        res['data'] = job.to_dict()
+
+    except Exception as e:
+        res['message'] = str(e)
+    finally:
+        return res
+
+
+@router.get("/libs/jobs/{job_id}")
+def get_lib_job(job_id: str) -> dict:
+    '''
+    Get the status and the last output lines of a library installation
+    '''
+    res = RESPONSE_TEMPLATE.copy()
+    try:
+        job = lib_jobs.get(job_id)
+        if job is None:
+            raise Exception('Job not found')
+
         res['status'] = 'success'
-        res['message'] = 'Successfully installed libraries'
+        res['message'] = f'Job is {job.status}'
+        res['data'] = job.to_dict()
+    except Exception as e:
+        res['message'] = str(e)
+    finally:
+        return res
 
+
+@router.post("/functions/{func_name}/libs")
+def install_function_libraries(func_name: str, lib_request: FuncLibInstallRequest) -> dict:
+    '''
+    Install Python libraries in the environment of 1 version of a function, latest unless an alias or version is given.
+    The server, other versions and other functions keep theirs
+    Installs run in the background, poll the returned job at /libs/jobs/{job_id}
+    Permission: Owner
+    '''
+    res = RESPONSE_TEMPLATE.copy()
+    try:
+        print(f'Installing libraries for {func_name}:', lib_request.libs)
+        job = install_func_libs(func_name, lib_request.libs, target_dir='functions_store',
+                                target_file=lib_request.target, author=lib_request.username,
+                                password=lib_request.password, token=lib_request.token,
+                                alias=lib_request.alias, version=lib_request.version)
+        if job is None:
+            raise Exception('Function not found or invalid libraries')
+
+        res['status'] = 'success'
+        res['message'] = f'Installation of libraries for function {func_name} is {job.status}'
+        res['data'] = job.to_dict()
     except Exception as e:
         res['message'] = str(e)
     finally:
@@ -2,7 +2,10 @@ from dotenv import load_dotenv
 import os
 
 load_dotenv()
-FUNC_DELIMITER = os.getenv('FUNC_DELIMITER')
+# Secrets are taken out of the environment, so processes running user code never inherit them
+FUNC_DELIMITER = os.environ.pop('FUNC_DELIMITER', None)
+SESSION_SECRET = os.environ.pop('SESSION_SECRET', None)  # signs session tokens, random per process if unset
+LIB_WHEELHOUSE = os.getenv('LIB_WHEELHOUSE')  # directory of wheels, libraries are only installed from it if set
 
 # Length limits for function store files
 LINE_LIMIT = 10000  # Max line per store
@@ -13,5 +16,84 @@ MAX_STDOUT = 100  # Limit for terminal output
 TIME_LIMIT = 300  # Seconds ~ 5 minutes
 MEMORY_LIMIT = 2**30  # Bytes ~ 1GiB
 
+# How memory limit is enforced: 'sample' checks RSS every interval,
+# 'rlimit' lets the kernel cap the address space of the invokee
+MEMORY_ENFORCEMENT = 'sample'
+MEMORY_SAMPLE_INTERVAL = 0.5  # Seconds
+
 FUNC_STORE = 'functions_store'
 CONF_STORE = 'config_store'
+INVOKEE_CACHE = 'invokee_cache'
+BYTECODE_CACHE = 'bytecode_cache'  # compiled functions, 1 file per content and python version
+CATALOG_FILE = '.catalog.sqlite3'  # index of a function store, kept inside the store
+ALIASES_FILE = 'aliases.json'  # alias -> version of 1 function, kept next to its versions
+LATEST_ALIAS = 'latest'  # alias moved to every new upload, run when no alias is given
+REQUIREMENTS_FILE = 'requirements.json'  # version -> libraries of 1 function, kept next to its versions
+
+# Function environments, built from wheels shared by every function
+ENV_STORE = 'environments'  # 1 directory of linked packages per set of libraries
+PACKAGE_CACHE = 'package_cache'  # unpacked wheels, 1 directory per wheel content
+WHEEL_CACHE = 'wheel_cache'  # wheels downloaded or built by pip, looked up first by later builds
+ENV_BUILD_TIMEOUT = 1800  # Seconds ~ 30 minutes, max time of pip for 1 environment
+LIB_STAMP_FILE = '.requirements.stamp'  # fingerprint of the last install, kept next to the requirements file
+LIB_JOB_WORKERS = 2  # Library installs running at once, the server libraries are still installed 1 at a time
+
+# Max number of prepared functions kept in memory
+PREPARED_CACHE_SIZE = 256
+# Max number of parsed store files kept in memory
+PARSED_STORE_CACHE_SIZE = 1024
+
+# Function listing
+LIST_PAGE_LIMIT = 1000  # Max functions in 1 page of a listing
+LIST_CHUNK_SIZE = 200  # Catalog rows read at once while a listing streams
+
+# Bulk import
+BULK_MAX_FUNCTIONS = 1000  # Max functions in 1 import request
+BULK_WORKERS = 4  # Threads validating functions and hashing passwords
+
+# Compaction of the function store
+COMPACTION_THRESHOLD = 100  # Edits and deletes leaving files behind before compaction runs on its own
+COMPACTION_KEEP_VERSIONS = 5  # Versions without an alias kept per function, for rollbacks
+COMPACTION_GRACE = 3600  # Seconds ~ 1 hour, unused files younger than this are kept
+COMPACTION_BUSY_INVOCATIONS = 4  # Compaction waits while this many invocations are running
+COMPACTION_PAUSE = 0.01  # Seconds compaction sleeps after each function, so invocations go first
+
+# Memoized results of deterministic functions
+RESULT_CACHE_SIZE = 10000  # Max number of results
+RESULT_CACHE_MAX_BYTES = 64 * (2**20)  # Bytes ~ 64MiB
+RESULT_CACHE_TTL = 3600  # Seconds ~ 1 hour
+
+# Warm worker pool, set POOL_SIZE to 0 to spawn a new process per invocation
+POOL_SIZE = 4  # Max number of workers
+POOL_WARM_WORKERS = 1  # Workers started before the first invocation
+POOL_MAX_CALLS = 100  # Recycle a worker after this many invocations
+POOL_MAX_RSS = 2**28  # Bytes ~ 256MiB, recycle a worker above this memory
+
+# Zygote, a process forking invokees with heavy libraries already imported
+# Functions with their own environment do not use it, their libraries may differ from the preloaded ones
+ZYGOTE_ENABLED = True
+ZYGOTE_PRELOAD = ['numpy']  # Modules imported once and shared copy-on-write, missing ones are skipped
+
+# Invocations run on their own executor, not on the web server threadpool
+INVOKE_CONCURRENCY = 8  # Max invocations running at once
+INVOKE_QUEUE_SIZE = 32  # Max invocations waiting for a free slot, more are rejected
+INVOKE_MAX_WAIT = 60  # Seconds an invocation may wait for a free slot
+JOB_RETENTION = 1000  # Finished async jobs kept for polling
+JOB_LOG_LINES = 200  # Last output lines kept per job
+STREAM_BUFFER = 64  # Output lines buffered for a streaming client
+
+# Admission control, fair between users
+USER_CONCURRENCY = 4  # Max invocations running at once for 1 user
+FUNC_CONCURRENCY = 4  # Max invocations running at once for 1 function
+USER_RATE_LIMIT = 10  # Invocations per second for 1 user, on average
+USER_RATE_BURST = 20  # Invocations 1 user can make at once
+AUTH_FAILURE_RATE = 1  # Failed authentications per second for 1 client, on average, checked before bcrypt runs
+AUTH_FAILURE_BURST = 10  # Failed authentications 1 client can make at once
+
+# Metrics
+STORE_SIZE_TTL = 60  # Seconds the size of the function store is reused between scrapes, walking it is O(files)
+
+# Authentication
+SESSION_TTL = 900  # Seconds ~ 15 minutes, lifetime of a session token
+CREDENTIAL_CACHE_SIZE = 10000  # Max number of checked passwords kept in memory
+CREDENTIAL_CACHE_TTL = 60  # Seconds a checked password is trusted without bcrypt
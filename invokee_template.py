@@ -1,7 +1,8 @@
-from logic.signature import get_return_signature
+from logic.transport import read_frame, write_frame
+from logic.worker import apply_memory_limit, run_batch, make_sendable, MEMORY_ERROR_EXIT
+import os
 import sys
-import pickle
-import base64
+import traceback
 '''
 This file serve as a template file to run invokee functions
 '''
@@ -11,12 +12,27 @@ This file serve as a template file to run invokee functions
 
 
 def invoker() -> None:
-    params = sys.argv[1]
-    decoded_params = pickle.loads(base64.b64decode(params))
-    result = func(*decoded_params)
-    # return signature, separate std output with return value
-    print(get_return_signature())
-    print(base64.b64encode(pickle.dumps(result)).decode())  # func's return value
+    apply_memory_limit()
+    # params and return value go through their own pipes, separated from std output
+    params_fd, result_fd = int(sys.argv[1]), int(sys.argv[2])
+    with os.fdopen(params_fd, 'rb') as f:
+        request = read_frame(f)
+
+    # a batch runs every item in this process and returns all results at once
+    if 'items' in request:
+        response = run_batch(func, request['items'], request['max_stdout'], request['item_timeout'])
+        with os.fdopen(result_fd, 'wb') as f:
+            write_frame(f, make_sendable(response))
+        return
+
+    try:
+        result = func(*request['params'])
+    except MemoryError:
+        traceback.print_exc()
+        sys.exit(MEMORY_ERROR_EXIT)
+
+    with os.fdopen(result_fd, 'wb') as f:
+        write_frame(f, result)  # func's return value
 
 #start-function: KEYPHRASE
 #end-function: KEYPHRASE
@@ -1,10 +1,25 @@
+import base64
 import bcrypt
+import hashlib
+import hmac
+import json
+import secrets
+import time
+from typing import Any, Dict, List, Tuple, Union
+from config import SESSION_SECRET, SESSION_TTL, CREDENTIAL_CACHE_SIZE, CREDENTIAL_CACHE_TTL
+from .cache import LRUCache
 
 '''
 This file handles the authentication of the user. 
 It checks if a user is matched to an invoke function.
 '''
 
+# Key that signs session tokens, a random one means tokens do not survive a restart
+SECRET = SESSION_SECRET.encode() if SESSION_SECRET else secrets.token_bytes(32)
+
+# (hashed password, keyed digest of the password) -> bcrypt outcome
+verified_cache = LRUCache(CREDENTIAL_CACHE_SIZE, ttl=CREDENTIAL_CACHE_TTL)
+
 
 def hash_password(password: str) -> str:
     '''
@@ -20,5 +35,67 @@ def hash_password(password: str) -> str:
 def check_password(password: str, hashed_password: str) -> bool:
     '''
     Check if the password matches the hashed password
+    The outcome is cached briefly, so bcrypt runs once per credential, not once per function
+    '''
+    # the plain password is never kept in memory, only a keyed digest of it
+    key = (hashed_password, hmac.new(SECRET, password.encode(), hashlib.sha256).digest())
+    verified = verified_cache.get(key)
+    if verified is None:
+        verified = bcrypt.checkpw(password.encode(), hashed_password.encode())
+        verified_cache.put(key, verified)
+    return verified
+
+
+def creds_fingerprint(hashed_password: str) -> str:
+    '''
+    Short stand-in of a hashed password, carried by session tokens
+    '''
+    return hashlib.sha256(hashed_password.encode()).hexdigest()[:32]
+
+
+def sign(body: str) -> str:
+    return hmac.new(SECRET, body.encode(), hashlib.sha256).hexdigest()
+
+
+def create_session_token(username: str, creds: List[str], ttl: int = SESSION_TTL) -> Tuple[str, float]:
+    '''
+    Create a signed token for a user, valid for the functions protected by creds
+    Return the token and when it expires
+    '''
+    expires_at = time.time() + ttl
+    payload = json.dumps({
+        'user': username,
+        'creds': [creds_fingerprint(hashed_password) for hashed_password in creds],
+        'exp': expires_at,
+    }, separators=(',', ':'))
+    body = base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+    return f'{body}.{sign(body)}', expires_at
+
+
+def read_session_token(token: str) -> Union[Dict[str, Any], None]:
+    '''
+    Get the session of a token, None if it is forged or expired
+    '''
+    body, _, signature = token.rpartition('.')
+    if not body or not hmac.compare_digest(sign(body).encode(), signature.encode()):
+        return None
+    try:
+        session = json.loads(base64.urlsafe_b64decode(body + '=' * (-len(body) % 4)))
+    except ValueError:
+        return None
+    if session['exp'] < time.time():
+        return None
+    return session
+
+
+def verify_owner(func_author: str, func_creds: str, author: str, password: str, token: Union[str, None] = None) -> bool:
+    '''
+    Check that a user owns a function, either with a session token or with a password
     '''
-    return bcrypt.checkpw(password.encode(), hashed_password.encode())
+    if func_creds is None:
+        return False
+    if token is not None:
+        session = read_session_token(token)
+        return (session is not None and session['user'] == func_author
+                and creds_fingerprint(func_creds) in session['creds'])
+    return author == func_author and check_password(password, func_creds)
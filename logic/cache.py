@@ -0,0 +1,115 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, List, Union
+
+'''
+This file contains the in-memory caches shared by the invocation logic
+'''
+
+
+class LRUCache:
+    '''
+    A thread-safe cache that evicts the least recently used entry when full.
+    It can also be bounded by the total size of its values, and expire entries after a TTL
+    '''
+
+    def __init__(self, max_entries: int = 128, on_evict: Callable[[Hashable, Any], None] = None,
+                 max_bytes: Union[int, None] = None, ttl: Union[float, None] = None,
+                 size_of: Callable[[Any], int] = len) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_of = size_of
+        self.on_evict = on_evict
+        self.entries = OrderedDict()  # key -> (value, size, expires_at)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        evicted = []
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+                evicted.append(self.remove(key))
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+
+        for item in evicted:
+            self.evict(*item)
+        return default if entry is None else entry[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.size_of(value) if self.max_bytes is not None else 0
+        # Never let one value flush the whole cache
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)  # replaced, not evicted
+            self.entries[key] = (value, size, expires_at)
+            self.total_bytes += size
+            while len(self.entries) > self.max_entries or (
+                    self.max_bytes is not None and self.total_bytes > self.max_bytes):
+                evicted.append(self.remove(next(iter(self.entries))))
+                self.evictions += 1
+
+        for item in evicted:
+            self.evict(*item)
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]) -> List[Hashable]:
+        '''
+        Remove all entries whose key matches the predicate
+        '''
+        with self.lock:
+            keys = [key for key in self.entries if predicate(key)]
+            evicted = [self.remove(key) for key in keys]
+
+        for item in evicted:
+            self.evict(*item)
+        return keys
+
+    def values(self) -> List[Any]:
+        '''
+        Get every cached value, expired ones included until they are looked up
+        '''
+        with self.lock:
+            return [value for value, _, _ in self.entries.values()]
+
+    def remove(self, key: Hashable) -> tuple:
+        '''
+        Remove an entry, the lock must be held by the caller
+        '''
+        value, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+        return key, value
+
+    def evict(self, key: Hashable, value: Any) -> None:
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+from threading import Lock, local
+from typing import Any, Dict, List, Set, Tuple, Union
+from utils import get_py_files
+from config import CATALOG_FILE, FUNC_STORE
+from .signature import get_store_file_funcs, split_func_block
+
+'''
+This file contains the catalog of a function store.
+The catalog is a SQLite index of every stored function: its file, line and byte range,
+params, author and content hash, so a lookup never has to scan the store files.
+It is updated whenever a store file is written, and can be rebuilt from the store files
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS functions (
+    file TEXT NOT NULL,
+    name TEXT NOT NULL,
+    params TEXT NOT NULL,
+    author TEXT,
+    creds TEXT,
+    deterministic INTEGER NOT NULL,
+    start_line INTEGER NOT NULL,
+    end_line INTEGER NOT NULL,
+    start_offset INTEGER NOT NULL,
+    end_offset INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    PRIMARY KEY (file, name)
+);
+CREATE INDEX IF NOT EXISTS functions_by_name ON functions (name);
+CREATE INDEX IF NOT EXISTS functions_by_author ON functions (author);
+CREATE TABLE IF NOT EXISTS files (
+    file TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+'''
+
+
+class Catalog:
+    '''
+    The index of 1 function store directory
+    '''
+
+    def __init__(self, target_dir: str) -> None:
+        self.target_dir = target_dir
+        self.path = os.path.join(target_dir, CATALOG_FILE)
+        self.local = local()  # 1 connection per thread
+        self.write_lock = Lock()
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    def connect(self) -> sqlite3.Connection:
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            self.local.db = db
+        return db
+
+    def find(self, func_name: str, target_file: Union[str, None] = None) -> Union[Dict[str, Any], None]:
+        '''
+        Get the entry of a function, in a given store file or in any of them
+        '''
+        if target_file is None:
+            row = self.connect().execute(
+                'SELECT * FROM functions WHERE name = ? LIMIT 1', (func_name,)).fetchone()
+        else:
+            row = self.connect().execute(
+                'SELECT * FROM functions WHERE file = ? AND name = ?', (str(target_file), func_name)).fetchone()
+        return to_entry(row) if row is not None else None
+
+    def list_functions(self, after: Union[Tuple[str, str], None] = None, prefix: Union[str, None] = None,
+                       target_file: Union[str, None] = None, author: Union[str, None] = None,
+                       limit: int = 100) -> List[Dict[str, Any]]:
+        '''
+        Get up to limit entries ordered by (file, name), starting after a (file, name) position.
+        prefix filters function names, target_file keeps 1 store file or the versions of 1 function
+        '''
+        clauses, args = [], []
+        if after is not None:
+            clauses.append('(file, name) > (?, ?)')
+            args.extend(after)
+        if prefix:
+            # a range instead of LIKE, so the match is exact and can use the name index
+            clauses.append('name >= ? AND name < ?')
+            args.extend((prefix, prefix + '\U0010ffff'))
+        if target_file is not None:
+            clauses.append('(file = ? OR substr(file, 1, ?) = ?)')
+            args.extend((target_file, len(target_file) + 1, f'{target_file}/'))
+        if author is not None:
+            clauses.append('author = ?')
+            args.append(author)
+
+        where = f' WHERE {" AND ".join(clauses)}' if clauses else ''
+        rows = self.connect().execute(
+            f'SELECT * FROM functions{where} ORDER BY file, name LIMIT ?', (*args, limit)).fetchall()
+        return [to_entry(row) for row in rows]
+
+    def get_author_creds(self, author: str) -> List[str]:
+        '''
+        Get the distinct hashed passwords protecting the functions of an author
+        '''
+        return [row['creds'] for row in self.connect().execute(
+            'SELECT DISTINCT creds FROM functions WHERE author = ? AND creds IS NOT NULL', (author,))]
+
+    def get_content_hashes(self) -> Set[str]:
+        '''
+        Get the content hash of every stored function
+        '''
+        return {row['content_hash'] for row in self.connect().execute(
+            'SELECT DISTINCT content_hash FROM functions')}
+
+    def read_block(self, entry: Dict[str, Any]) -> Union[List[str], None]:
+        '''
+        Read the lines of a stored function, signatures included, straight from its byte range
+        '''
+        try:
+            with open(os.path.join(self.target_dir, f'{entry["file"]}.py'), 'rb') as f:
+                f.seek(entry['start_offset'])
+                block = f.read(entry['end_offset'] - entry['start_offset'])
+        except OSError:
+            return None
+        return block.decode().splitlines(keepends=True)
+
+    def read_source(self, entry: Dict[str, Any]) -> Union[Tuple[str, str], None]:
+        '''
+        Get the start signature and the source of a function from its entry,
+        None if its store file changed since it was indexed
+        '''
+        lines = self.read_block(entry)
+        if not lines:
+            return None
+        start_signature, source = split_func_block(lines)
+        if hashlib.sha256(source.encode()).hexdigest() != entry['content_hash']:
+            return None
+        return start_signature, source
+
+    def reindex_file(self, target_file: str) -> None:
+        '''
+        Replace the entries of 1 store file with a fresh parse of it
+        '''
+        self.reindex_files([target_file])
+
+    def reindex_files(self, target_files: List[str]) -> None:
+        '''
+        Replace the entries of many store files in 1 transaction
+        '''
+        with self.write_lock, self.connect() as db:
+            for target_file in map(str, target_files):
+                file_path = os.path.join(self.target_dir, f'{target_file}.py')
+                db.execute('DELETE FROM functions WHERE file = ?', (target_file,))
+                db.execute('DELETE FROM files WHERE file = ?', (target_file,))
+                try:
+                    stat = os.stat(file_path)
+                    funcs = get_store_file_funcs(self.target_dir, target_file)
+                except FileNotFoundError:
+                    continue  # the file was removed, so are its entries
+                except (OSError, ValueError, SyntaxError) as e:
+                    print(f'Could not index {file_path}:', e)
+                    continue
+
+                db.executemany(
+                    'INSERT OR REPLACE INTO functions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(target_file, func['function'], json.dumps(func['params']), func['author'], func['creds'],
+                      int(func['deterministic']), func['start_line'], func['end_line'],
+                      func['start_offset'], func['end_offset'], func['content_hash']) for func in funcs])
+                db.execute('INSERT INTO files VALUES (?, ?, ?)',
+                           (target_file, stat.st_mtime_ns, stat.st_size))
+
+    def sync(self) -> int:
+        '''
+        Reindex the store files that changed since they were indexed,
+        return how many were reindexed
+        '''
+        indexed = {row['file']: (row['mtime_ns'], row['size'])
+                   for row in self.connect().execute('SELECT * FROM files')}
+        store_files = [file[:-len('.py')] for file in get_py_files(self.target_dir)
+                       if file != '__init__.py']
+
+        changed = []
+        for target_file in store_files:
+            try:
+                stat = os.stat(os.path.join(self.target_dir, f'{target_file}.py'))
+            except OSError:
+                continue
+            if indexed.get(target_file) != (stat.st_mtime_ns, stat.st_size):
+                changed.append(target_file)
+        removed = set(indexed) - set(store_files)
+
+        self.reindex_files(changed + list(removed))
+        return len(changed) + len(removed)
+
+    def rebuild(self) -> int:
+        '''
+        Drop the whole index and build it again from the store files
+        '''
+        with self.write_lock, self.connect() as db:
+            db.execute('DELETE FROM functions')
+            db.execute('DELETE FROM files')
+        return self.sync()
+
+    def compact(self) -> None:
+        '''
+        Fold the write-ahead log into the database and give the space of deleted entries back
+        '''
+        with self.write_lock:
+            db = self.connect()
+            db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            db.execute('VACUUM')
+
+
+def to_entry(row: sqlite3.Row) -> Dict[str, Any]:
+    entry = dict(row)
+    entry['params'] = json.loads(entry['params'])
+    entry['deterministic'] = bool(entry['deterministic'])
+    return entry
+
+
+_catalogs: Dict[str, Catalog] = {}
+_catalogs_lock = Lock()
+
+
+def get_catalog(target_dir: str = FUNC_STORE) -> Catalog:
+    '''
+    Get the catalog of a function store,
+    store files changed while the server was down are reindexed on first use
+    '''
+    with _catalogs_lock:
+        catalog = _catalogs.get(target_dir)
+        if catalog is None:
+            catalog = _catalogs[target_dir] = Catalog(target_dir)
+            catalog.sync()
+    return catalog
+
+
+if __name__ == '__main__':
+    # python -m logic.catalog [store dir], rebuild a catalog after editing store files by hand
+    target_dir = sys.argv[1] if len(sys.argv) > 1 else FUNC_STORE
+    print(f'Indexed {Catalog(target_dir).rebuild()} store files in {target_dir}')
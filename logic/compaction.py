@@ -0,0 +1,284 @@
+import os
+import shutil
+import time
+from threading import Lock
+from typing import Dict, List, Set, Tuple, Union
+from config import (FUNC_STORE, BYTECODE_CACHE, INVOKEE_CACHE, ENV_STORE, PACKAGE_CACHE, ALIASES_FILE, REQUIREMENTS_FILE, JOB_RETENTION, COMPACTION_THRESHOLD,
+                    COMPACTION_KEEP_VERSIONS, COMPACTION_GRACE, COMPACTION_BUSY_INVOCATIONS, COMPACTION_PAUSE)
+from .catalog import get_catalog
+from .envs import get_env_id, get_build_lock, get_linked_packages, packages_lock
+from .invoke import get_bytecode_file, invalidate_invokee, prepared_cache
+from .jobs import Job, JobStore
+from .scheduler import scheduler
+from .store import (get_target_path, get_version_file, get_versions, is_legacy_file, lock_file, read_aliases,
+                    read_requirements, write_requirements, remove_func_file, fsync_dir, ALIAS)
+
+'''
+This file contains the compaction of a function store.
+Edits, deletes and alias moves leave files nobody runs anymore: versions without an alias,
+numbered store files without functions, compiled code of removed sources, invokee scripts
+evicted from the prepared cache, library environments of removed versions, empty directories.
+Compaction removes them in the background, 1 function at a time under its write lock,
+and gives way to invocations. It runs on demand or once enough garbage was left behind
+'''
+
+
+class Compactor:
+    '''
+    Run 1 compaction at a time and count the garbage left since the last one
+    '''
+
+    def __init__(self, threshold: int = COMPACTION_THRESHOLD) -> None:
+        self.jobs = JobStore(1, JOB_RETENTION, name='compaction')
+        self.threshold = threshold
+        self.garbage = 0
+        self.last_job: Union[Job, None] = None
+        self.lock = Lock()
+
+    def note_garbage(self, target_dir: str = FUNC_STORE, count: int = 1) -> None:
+        '''
+        Count files left behind by a write, start a compaction once there are enough of them
+        '''
+        with self.lock:
+            self.garbage += count
+            if self.garbage < self.threshold:
+                return
+        self.start(target_dir)
+
+    def start(self, target_dir: str = FUNC_STORE) -> Job:
+        '''
+        Start a compaction in the background, or return the one already queued or running
+        '''
+        with self.lock:
+            if self.last_job is not None and self.last_job.finished_at is None:
+                return self.last_job
+            self.garbage = 0
+            self.last_job = self.jobs.submit(compact_store, target_dir)
+            return self.last_job
+
+    def stats(self) -> Dict[str, Union[int, dict, None]]:
+        with self.lock:
+            return {
+                'garbage': self.garbage,
+                'threshold': self.threshold,
+                'last_job': self.last_job.to_dict() if self.last_job is not None else None,
+            }
+
+
+def wait_for_idle() -> None:
+    '''
+    Sleep while the server is busy running invocations
+    '''
+    time.sleep(COMPACTION_PAUSE)
+    while scheduler.stats()['running'] >= COMPACTION_BUSY_INVOCATIONS:
+        time.sleep(max(COMPACTION_PAUSE, 0.1))
+
+
+def is_old(file_path: str, now: float) -> bool:
+    try:
+        return now - os.stat(file_path).st_mtime > COMPACTION_GRACE
+    except OSError:
+        return False
+
+
+def compact_func_dir(target_dir: str, target_file: str, now: float) -> Tuple[List[str], bool]:
+    '''
+    Remove the old versions of a function that no alias points to,
+    keeping the newest ones for rollbacks, and its directory once nothing is left in it
+    Return the removed store files and whether the directory was removed
+    '''
+    removed, removed_dir = [], False
+    with lock_file(target_dir, target_file):
+        # a version is written before the alias that points to it, the grace period covers the gap
+        aliases = read_aliases(target_dir, target_file)
+        unused = [version for version in get_versions(target_dir, target_file)
+                  if version not in aliases.values()]
+        for version in unused[:max(len(unused) - COMPACTION_KEEP_VERSIONS, 0)]:
+            store_file = get_version_file(target_file, version)
+            if is_old(get_target_path(target_dir, store_file), now):
+                remove_func_file(target_dir, store_file)
+                removed.append(store_file)
+
+        # removed versions take their libraries with them
+        requirements = read_requirements(target_dir, target_file)
+        kept = {version: libs for version, libs in requirements.items()
+                if get_version_file(target_file, version) not in removed}
+        if len(kept) != len(requirements):
+            write_requirements(target_dir, target_file, kept)
+
+        func_dir = os.path.join(target_dir, target_file)
+        if not aliases and not get_versions(target_dir, target_file) and is_old(func_dir, now):
+            removed_dir = remove_empty_dir(func_dir)
+
+        if removed:
+            get_catalog(target_dir).reindex_files(removed)
+    for store_file in removed:
+        invalidate_invokee(target_file.split('/')[-1], target_dir, store_file)
+    return removed, removed_dir
+
+
+def compact_legacy_file(target_dir: str, target_file: str, now: float) -> bool:
+    '''
+    Remove a numbered store file once every function was deleted from it
+    '''
+    with lock_file(target_dir, target_file):
+        if get_catalog(target_dir).list_functions(target_file=target_file, limit=1):
+            return False
+        file_path = get_target_path(target_dir, target_file)
+        with open(file_path) as f:
+            # only comments are left once its functions are gone, e.g. the header of create_py_file
+            code = [line for line in f if line.strip() and not line.lstrip().startswith('#')]
+        if code or not is_old(file_path, now):
+            return False  # it may hold functions the catalog could not index
+        remove_func_file(target_dir, target_file)
+        get_catalog(target_dir).reindex_file(target_file)
+    return True
+
+
+def remove_empty_dir(dir_path: str) -> bool:
+    '''
+    Remove a directory with only leftover temp, aliases or requirements files in it
+    '''
+    try:
+        for entry in os.scandir(dir_path):
+            if not entry.name.startswith('.') and entry.name not in (ALIASES_FILE, REQUIREMENTS_FILE):
+                return False
+        for entry in os.scandir(dir_path):
+            os.remove(entry.path)
+        os.rmdir(dir_path)
+    except OSError:
+        return False
+    fsync_dir(os.path.dirname(dir_path))
+    return True
+
+
+def compact_bytecode(target_dir: str, now: float) -> int:
+    '''
+    Remove compiled code of sources no longer stored, or of other python versions
+    '''
+    content_hashes = get_catalog(target_dir).get_content_hashes()
+    removed = 0
+    try:
+        entries = list(os.scandir(BYTECODE_CACHE))
+    except OSError:
+        return 0
+    for entry in entries:
+        content_hash = entry.name.split('.')[0]
+        current = content_hash in content_hashes and entry.name == os.path.basename(get_bytecode_file(content_hash))
+        if current or not is_old(entry.path, now):
+            continue
+        try:
+            os.remove(entry.path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def compact_invokees(now: float) -> int:
+    '''
+    Remove invokee scripts no longer cached, long enough after their eviction that no invocation is starting them
+    '''
+    cached = {os.path.abspath(prepared.invokee_file) for prepared in prepared_cache.values()}
+    removed = 0
+    try:
+        entries = list(os.scandir(INVOKEE_CACHE))
+    except OSError:
+        return 0
+    for entry in entries:
+        if os.path.abspath(entry.path) in cached or not is_old(entry.path, now):
+            continue
+        try:
+            os.remove(entry.path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def compact_environments(target_dir: str, func_dirs: List[str], now: float) -> Tuple[int, int]:
+    '''
+    Remove the environments no version of a function needs anymore,
+    then the unpacked packages no remaining environment links to
+    Return how many environments and packages were removed
+    '''
+    used = {get_env_id(libs) for target_file in func_dirs
+            for libs in read_requirements(target_dir, target_file).values() if libs}
+    removed_envs, removed_packages = 0, 0
+    linked: Set[str] = set()
+    try:
+        entries = list(os.scandir(ENV_STORE))
+    except OSError:
+        entries = []
+    for entry in entries:
+        # half built environments start with a dot, an old one was left by a crashed build
+        lock = get_build_lock(entry.name.lstrip('.').split('.')[0])
+        # a locked environment is being built or reused right now
+        if entry.name not in used and lock.acquire(blocking=False):
+            try:
+                if is_old(entry.path, now):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed_envs += 1
+                    continue
+            finally:
+                lock.release()
+        linked |= get_linked_packages(entry.path)
+
+    try:
+        entries = list(os.scandir(PACKAGE_CACHE))
+    except OSError:
+        entries = []
+    for entry in entries:
+        with packages_lock:
+            if entry.name in linked or not is_old(entry.path, now):
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed_packages += 1
+    return removed_envs, removed_packages
+
+
+def compact_store(target_dir: str = FUNC_STORE) -> Dict[str, int]:
+    '''
+    Remove every file of a function store that nothing runs anymore, then shrink its catalog
+    '''
+    now = time.time()
+    stats = {'versions': 0, 'legacy_files': 0, 'directories': 0, 'bytecode': 0, 'invokees': 0,
+             'environments': 0, 'packages': 0}
+
+    func_dirs, user_dirs = [], []
+    for user_dir in sorted(os.scandir(target_dir), key=lambda entry: entry.name):
+        if not user_dir.is_dir():
+            continue
+        user_dirs.append(user_dir.path)
+        func_dirs.extend(f'{user_dir.name}/{entry.name}' for entry in os.scandir(user_dir.path)
+                         if entry.is_dir() and ALIAS.fullmatch(entry.name))
+
+    for target_file in func_dirs:
+        wait_for_idle()
+        removed, removed_dir = compact_func_dir(target_dir, target_file, now)
+        stats['versions'] += len(removed)
+        stats['directories'] += removed_dir
+
+    for file in sorted(os.listdir(target_dir)):
+        if is_legacy_file(file):
+            wait_for_idle()
+            stats['legacy_files'] += compact_legacy_file(target_dir, file[:-len('.py')], now)
+
+    for user_dir in user_dirs:
+        if is_old(user_dir, now) and not os.listdir(user_dir):
+            try:
+                os.rmdir(user_dir)
+                stats['directories'] += 1
+            except OSError:
+                pass  # a function was just added to it
+
+    wait_for_idle()
+    stats['bytecode'] = compact_bytecode(target_dir, now)
+    stats['invokees'] = compact_invokees(now)
+    wait_for_idle()
+    stats['environments'], stats['packages'] = compact_environments(target_dir, func_dirs, now)
+    get_catalog(target_dir).compact()
+    return stats
+
+
+compactor = Compactor()
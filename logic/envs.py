@@ -0,0 +1,219 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from threading import Lock
+from typing import Dict, List, Set, Union
+from weakref import WeakValueDictionary
+from config import ENV_STORE, PACKAGE_CACHE, WHEEL_CACHE, ENV_BUILD_TIMEOUT
+from utils import create_dir
+from .jobs import log_progress
+from .libs import normalize_name, run_pip
+from .store import fsync_dir
+
+'''
+This file contains the environments of functions.
+An environment is a site-packages directory for 1 set of libraries, shared by every function needing that set.
+pip resolves the libraries into wheels, each wheel is unpacked once into the package cache under its content hash,
+and an environment only holds symlinks to unpacked packages, so building one mostly costs a resolve.
+Functions run with their environment in front of the server libraries.
+Compaction removes the environments no version needs anymore and the packages they alone linked to
+'''
+
+# project name at the start of a requirement, e.g. numpy in numpy>=1.26
+REQUIREMENT_NAME = re.compile(r'[A-Za-z0-9][A-Za-z0-9._-]*')
+
+# id of an environment -> lock of its builders, dropped once no build holds it
+_build_locks: 'WeakValueDictionary[str, Lock]' = WeakValueDictionary()
+_build_locks_lock = Lock()
+
+# held while an unpacked package is reused by a build or removed by compaction
+packages_lock = Lock()
+
+
+def get_requirement_name(lib: str) -> Union[str, None]:
+    '''
+    Normalized project name of a requirement, None if it is not one (e.g. a pip option)
+    '''
+    match = REQUIREMENT_NAME.match(lib.strip())
+    return normalize_name(match.group()) if match is not None else None
+
+
+def merge_requirements(requirements: List[str], libs: List[str]) -> Union[List[str], None]:
+    '''
+    Add libraries to a set of requirements, a library replaces the requirement of the same project
+    None if a library is not a requirement
+    '''
+    merged: Dict[str, str] = {}
+    for lib in [*requirements, *libs]:
+        name = get_requirement_name(lib)
+        if name is None:
+            return None
+        merged[name] = lib.strip()
+    return [merged[name] for name in sorted(merged)]
+
+
+def get_env_id(requirements: List[str]) -> str:
+    return hashlib.sha256('\n'.join(sorted(requirements)).encode()).hexdigest()[:16]
+
+
+def get_env_path(env_id: str) -> str:
+    '''
+    Path of the site-packages directory of an environment
+    '''
+    return os.path.abspath(os.path.join(ENV_STORE, env_id, 'site-packages'))
+
+
+def get_environment(requirements: List[str]) -> Union[str, None]:
+    '''
+    Get the site-packages of a built environment, None if it is not built yet
+    '''
+    site_dir = get_env_path(get_env_id(requirements))
+    return site_dir if os.path.isdir(site_dir) else None
+
+
+def get_build_lock(env_id: str) -> Lock:
+    '''
+    Lock of the builders of an environment, compaction holds it to remove one
+    '''
+    with _build_locks_lock:
+        lock = _build_locks.get(env_id)
+        if lock is None:
+            lock = _build_locks[env_id] = Lock()
+        return lock
+
+
+def build_environment(requirements: List[str]) -> str:
+    '''
+    Get the site-packages of an environment, build it first if needed
+    An environment is published in 1 rename once every package is linked, so it is never seen half built
+    Raise an exception if pip can not resolve the requirements
+    '''
+    env_id = get_env_id(requirements)
+    with get_build_lock(env_id):
+        site_dir = get_env_path(env_id)
+        if os.path.isdir(site_dir):
+            # a reused environment is in use again, compaction leaves it alone for a while
+            os.utime(os.path.dirname(site_dir))
+            return site_dir
+
+        create_dir(ENV_STORE)
+        tmp_dir = tempfile.mkdtemp(dir=ENV_STORE, prefix=f'.{env_id}.')
+        try:
+            wheel_dir = os.path.join(tmp_dir, 'wheels')
+            download_wheels(requirements, wheel_dir)
+            tmp_site_dir = os.path.join(tmp_dir, 'site-packages')
+            os.mkdir(tmp_site_dir)
+            for wheel in sorted(os.listdir(wheel_dir)):
+                log_progress(f'Linking {wheel}')
+                link_tree(unpack_wheel(cache_wheel(os.path.join(wheel_dir, wheel))), tmp_site_dir)
+
+            shutil.rmtree(wheel_dir)
+            try:
+                os.rename(tmp_dir, os.path.dirname(site_dir))
+            except OSError:
+                if not os.path.isdir(site_dir):
+                    raise
+                # built by another server process meanwhile
+            fsync_dir(ENV_STORE)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return site_dir
+
+
+def download_wheels(requirements: List[str], wheel_dir: str) -> None:
+    '''
+    Resolve requirements and their dependencies into wheels, from the wheel cache and the index,
+    or the wheel cache and the wheelhouse only when one is set
+    '''
+    create_dir(WHEEL_CACHE)
+    log_progress(f'Resolving {" ".join(requirements)}')
+    run_pip('wheel', requirements, ['--wheel-dir', wheel_dir, '--find-links', WHEEL_CACHE],
+            timeout=ENV_BUILD_TIMEOUT, on_output=log_progress)
+
+
+def cache_wheel(wheel_path: str) -> str:
+    '''
+    Keep a wheel in the wheel cache for later builds, return its path there
+    '''
+    cached_path = os.path.join(WHEEL_CACHE, os.path.basename(wheel_path))
+    if not os.path.exists(cached_path):
+        shutil.copyfile(wheel_path, wheel_path + '.tmp')
+        os.replace(wheel_path + '.tmp', cached_path)
+    return cached_path
+
+
+def unpack_wheel(wheel_path: str) -> str:
+    '''
+    Unpack a wheel once into the package cache, return the directory of its content
+    '''
+    digest = hashlib.sha256()
+    with open(wheel_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    package_dir = os.path.abspath(os.path.join(PACKAGE_CACHE, digest.hexdigest()[:16]))
+    with packages_lock:
+        if os.path.isdir(package_dir):
+            # it is linked right after, compaction leaves it alone for a while
+            os.utime(package_dir)
+            return package_dir
+
+    create_dir(PACKAGE_CACHE)
+    tmp_dir = tempfile.mkdtemp(dir=PACKAGE_CACHE, prefix='.')
+    try:
+        with zipfile.ZipFile(wheel_path) as wheel:
+            wheel.extractall(tmp_dir)
+        # libraries under <name>.data/purelib or platlib belong in site-packages too
+        for entry in os.listdir(tmp_dir):
+            if entry.endswith('.data'):
+                for scheme in ('purelib', 'platlib'):
+                    scheme_dir = os.path.join(tmp_dir, entry, scheme)
+                    if os.path.isdir(scheme_dir):
+                        for name in os.listdir(scheme_dir):
+                            os.replace(os.path.join(scheme_dir, name), os.path.join(tmp_dir, name))
+        try:
+            os.rename(tmp_dir, package_dir)
+        except OSError:
+            pass  # unpacked by a concurrent build
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return package_dir
+
+
+def get_linked_packages(env_dir: str) -> Set[str]:
+    '''
+    Names of the unpacked packages an environment links to
+    '''
+    package_cache = os.path.abspath(PACKAGE_CACHE)
+    packages = set()
+    for dir_path, dir_names, file_names in os.walk(env_dir):
+        for name in [*dir_names, *file_names]:
+            path = os.path.join(dir_path, name)
+            if os.path.islink(path):
+                target = os.path.relpath(os.readlink(path), package_cache)
+                if not target.startswith(os.pardir):
+                    packages.add(target.split(os.sep)[0])
+    return packages
+
+
+def link_tree(src_dir: str, dst_dir: str) -> None:
+    '''
+    Link every entry of an unpacked wheel into a site-packages directory
+    A directory provided by several wheels (e.g. a namespace package) becomes a real one linking all of them
+    '''
+    for name in os.listdir(src_dir):
+        if name.endswith('.data'):
+            continue
+        src, dst = os.path.join(src_dir, name), os.path.join(dst_dir, name)
+        if not os.path.lexists(dst):
+            os.symlink(src, dst)
+        elif os.path.isdir(src) and os.path.isdir(dst):
+            if os.path.islink(dst):
+                linked = os.readlink(dst)
+                os.remove(dst)
+                os.mkdir(dst)
+                link_tree(linked, dst)
+            link_tree(src, dst)
+        # else the first wheel providing a file keeps it
@@ -1,12 +1,27 @@
-from utils import get_py_files, create_py_file
-from config import LINE_LIMIT, TIME_LIMIT, MEMORY_LIMIT, MAX_UPLOAD_SIZE
-from typing import Union, List, Dict, Any
+from config import LINE_LIMIT, TIME_LIMIT, MEMORY_LIMIT, MAX_UPLOAD_SIZE, POOL_SIZE, LATEST_ALIAS, LIST_CHUNK_SIZE, BULK_WORKERS
+from typing import Union, List, Dict, Any, Callable, Iterator, Tuple
 from .signature import *
-from .invoke import invoke_with_limit, prepare_invokee
+from .invoke import (invoke_with_limit, prepare_invokee, invalidate_invokee, compile_func, PreparedInvokee,
+                     get_cached_result, cache_result)
+from .pool import get_pool
+from .catalog import get_catalog
+from .auth import check_password, hash_password, verify_owner, create_session_token, read_session_token
+from .store import (get_func_target, get_target_path, is_legacy_file, lock_file, write_atomic,
+                    remove_func_file, is_versioned, get_versions, get_version_file, split_version_file,
+                    read_aliases, write_aliases, write_version, resolve_target, remove_func_dir,
+                    read_requirements, write_requirements, ALIAS, VERSION)
+from .envs import build_environment, get_environment, merge_requirements
+from .compaction import compactor
+from .jobs import Job, lib_jobs
+from .metrics import (INVOCATION_PHASE, INVOCATIONS, INVOCATION_FAILURES, REJECTED_FUNCTION, observe_invocation,
+                      observe_cache)
+import base64
+import hashlib
+import json
 import os
 import re
-import pickle
-import base64
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 '''
 This file contains the logic to modify and manage invokee/invoker functions
@@ -40,206 +55,584 @@ def split_func_content(func_content: str) -> Union[str, List[str], Union[str, No
     return func_name, params, return_type
 
 
-def func_exists(func_name: str, target_dir: str) -> bool:
+def encode_cursor(position: Tuple[str, str]) -> str:
     '''
-    Check if a function exists in a python file
+    Opaque cursor of a listing position, a (store file, function name)
     '''
-    funcs = get_funcs(target_dir)
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
 
-    if not funcs:
-        return False
 
-    for val in list(funcs.values())[0]:
-        if val['function'] == func_name:
-            return True
-    return False
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    '''
+    Get the listing position of a cursor, raise ValueError if it is not one
+    '''
+    try:
+        store_file, func_name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    return str(store_file), str(func_name)
 
 
-def get_funcs(target_dir: str, author: str = 'admin', password: str = 'admin') -> Union[Dict[str, List[str]], None]:
+def iter_funcs(target_dir: str, author: str = 'admin', password: str = 'admin', token: Union[str, None] = None,
+               after: Union[Tuple[str, str], None] = None, prefix: Union[str, None] = None,
+               target_file: Union[str, None] = None, allow_admin: bool = True) -> Iterator[Tuple[str, Dict[str, Any], Tuple[str, str]]]:
     '''
-    Get all serverless functions from a python file
+    Yield (target, function, position) for the functions visible to a user, ordered by store file and name
+    Only the latest version of a function is listed. Rows are read from the catalog a chunk at a time,
+    so a listing of any size runs in constant memory
     Permission: ADMIN, USER
+    A session token, when given, stands in for the author and password
+    allow_admin=False lists the functions of the user only, even for the admin
     '''
     # Mock data for admin
     admin_username = 'admin'
     admin_pass = 'admin'
 
-    funcs = {}
-    py_files = get_py_files(target_dir)
-    # handle when no store exists
-    if not py_files:
-        create_py_file(target_dir, '0.py')
-        return None
-
-    for file in py_files:
-        with open(f'{target_dir}/{file}', 'r') as f:
-            # ignore init file
-            if file == '__init__.py':
+    owner = None
+    if token is not None or not allow_admin or not (author == admin_username and password == admin_pass):
+        session = read_session_token(token) if token is not None else None
+        owner = session['user'] if session is not None else author
+
+    catalog = get_catalog(target_dir)
+    owned = {}  # creds -> whether the user owns the functions they protect
+    while True:
+        entries = catalog.list_functions(after, prefix, target_file, owner, LIST_CHUNK_SIZE)
+        for entry in entries:
+            after = (entry['file'], entry['name'])
+            target, version = split_version_file(entry['file'])
+            if version is not None and version != read_aliases(target_dir, target).get(LATEST_ALIAS):
                 continue
 
-            # add functions of each file to a dictionary
-            out_list = []
-            func_lst = None
-            formatted_file = file.split('.')[0]
-
             # either return all funcs of 1 user or return all funcs in the system
-            if author == admin_username and password == admin_pass:
-                func_lst = get_all_func_names_by_signature(
-                    target_dir, formatted_file)
-            else:
-                func_lst = get_func_names_by_author(
-                    target_dir, formatted_file, author, password)
-
-            if func_lst is None:
-                continue
-
-            # get params for each function
-            for func in func_lst:
-                params = get_params_by_signature(
-                    func, target_dir, formatted_file)
-                if params is None:
+            if owner is not None:
+                if entry['creds'] not in owned:
+                    owned[entry['creds']] = verify_owner(entry['author'], entry['creds'], author, password, token)
+                if not owned[entry['creds']]:
                     continue
 
-                out_list.append({
-                    'function': func,
-                    'params': params
-                })
+            if entry['params']:
+                yield target, {'function': entry['name'], 'params': entry['params']}, after
 
-            # get rid of extension
-            funcs[formatted_file] = out_list
+        if len(entries) < LIST_CHUNK_SIZE:
+            return
+
+
+def get_funcs(target_dir: str, author: str = 'admin', password: str = 'admin',
+              token: Union[str, None] = None) -> Union[Dict[str, List[str]], None]:
+    '''
+    Get all serverless functions from a python file
+    Permission: ADMIN, USER
+    A session token, when given, stands in for the author and password
+    '''
+    funcs = {}
+    for target, func, _ in iter_funcs(target_dir, author, password, token):
+        funcs.setdefault(target, []).append(func)
 
     return funcs if funcs else None
 
 
-def add_func(func_content: str, target_dir: str, author: str = 'admin', password: str = 'admin') -> Union[str, None]:
+def add_func(func_content: str, target_dir: str, author: str = 'admin', password: str = 'admin', deterministic: bool = False) -> Union[str, None]:
     '''
-    Add a serverless function to a python file,
-    return a target file name
+    Add a serverless function to its own directory in the directory of its author,
+    as its first version, return a target file name
+    Deterministic functions have their results memoized
     '''
 
-    func_name, params, _ = split_func_content(func_content)
-    funcs = get_funcs(target_dir)
-
-    # Not allow same function name
-    # TODO: Work out so different user can have same function name
-    # if func_exists(func_name, target_dir):
-    #     return None
+    # Reject overly long, overly large or invalid functions
+    valid = validate_func(func_content)
+    if isinstance(valid, str):
+        return None
+    func_name, params = valid
 
-    # Reject overly long functions
-    if len(func_content.split('\n')) > LINE_LIMIT:
+    target_file = get_func_target(author, func_name)
+    if target_file is None:
         return None
 
-    # Reject overly large functions
+    content = (get_start_signature(func_name, params, deterministic)
+               + get_author_signature(author, password, get_known_creds(target_dir, author, password))
+               + func_content
+               + get_end_signature(func_name))
+
+    # Uploads of other functions do not wait for this lock
+    with lock_file(target_dir, target_file):
+        # Not allow same function name for 1 user, different users can have the same name
+        if is_versioned(target_dir, target_file) or os.path.exists(get_target_path(target_dir, target_file)):
+            return None
+        version = write_version(target_dir, target_file, content)
+        get_catalog(target_dir).reindex_file(get_version_file(target_file, version))
+        write_aliases(target_dir, target_file, {LATEST_ALIAS: version})
+
+    return target_file
+
+
+def validate_func(func_content: str) -> Union[Tuple[str, List[str]], str]:
+    '''
+    Check an uploaded function and compile it into the bytecode cache,
+    return its name and params, or why it was rejected
+    '''
+    parsed = split_func_content(func_content) if func_content.strip() else None
+    if parsed is None:
+        return 'Not a function definition'
+    func_name, params, _ = parsed
+    if len(func_content.split('\n')) > LINE_LIMIT:
+        return 'Function is too long'
     if len(func_content.encode('utf-8')) > MAX_UPLOAD_SIZE:
-        return None
+        return 'Function is too large'
+    if not precompile(func_content, func_name):
+        return 'Function does not compile'
+    return func_name, params
 
-    target_file = list(funcs.keys())[-1] if funcs else 0
-    write_mode = 'a'
-    file_path = f'{target_dir}/{target_file}.py'
 
-    # If file doesnt exist or is too large, create a new one
-    if not os.path.exists(file_path) or len(open(file_path).readlines()) + len(func_content.split('\n')) > LINE_LIMIT:
-        target_file = target_file + 1 if target_file else 0
-        write_mode = 'w'
+def add_funcs(funcs: List[Dict[str, Any]], target_dir: str) -> List[Dict[str, Any]]:
+    '''
+    Add many serverless functions at once, each one as in add_func.
+    funcs are dicts with content, deterministic, author and password.
+    Functions are validated in parallel, each author's password is hashed once,
+    and the catalog is updated in 1 transaction.
+    Return 1 {'status', 'message', 'target'} per function, in order
+    '''
+    results = [{'status': 'error', 'message': 'Function already exists', 'target': None} for _ in funcs]
+    with ThreadPoolExecutor(max_workers=BULK_WORKERS) as executor:
+        validated = list(executor.map(validate_func, [func['content'] for func in funcs]))
+
+        # bcrypt releases the GIL, authors are hashed in parallel too
+        authors = list({(func['author'], func['password']) for func in funcs})
+        creds = dict(zip(authors, executor.map(
+            lambda author: get_known_creds(target_dir, *author) or hash_password(author[1]), authors)))
+
+    written = []  # (index, target, version)
+    for i, (func, valid) in enumerate(zip(funcs, validated)):
+        if isinstance(valid, str):
+            results[i]['message'] = valid
+            continue
+        func_name, params = valid
+        target_file = get_func_target(func['author'], func_name)
+        if target_file is None:
+            results[i]['message'] = 'Username is required'
+            continue
+
+        content = (get_start_signature(func_name, params, func['deterministic'])
+                   + get_author_signature(func['author'], func['password'], creds[(func['author'], func['password'])])
+                   + func['content']
+                   + get_end_signature(func_name))
+        with lock_file(target_dir, target_file):
+            # also rejects a name repeated in the same batch
+            if is_versioned(target_dir, target_file) or os.path.exists(get_target_path(target_dir, target_file)):
+                continue
+            written.append((i, target_file, write_version(target_dir, target_file, content)))
 
-    # Add the new function to the file
-    file_path = f'{target_dir}/{target_file}.py'
-    with open(file_path, write_mode) as f:
-        f.write(get_start_signature(func_name, params))
-        f.write(get_author_signature(author, password))
-        f.write(func_content)
-        f.write(get_end_signature(func_name))
+    get_catalog(target_dir).reindex_files(
+        [get_version_file(target_file, version) for _, target_file, version in written])
 
-    return target_file
+    # functions become visible once they are indexed
+    for i, target_file, version in written:
+        with lock_file(target_dir, target_file):
+            write_aliases(target_dir, target_file, {LATEST_ALIAS: version})
+        results[i] = {'status': 'success', 'message': 'Function added', 'target': target_file}
+    return results
+
+
+def export_funcs(target_dir: str, author: str, password: str,
+                 token: Union[str, None] = None) -> Iterator[Dict[str, Any]]:
+    '''
+    Yield the latest version of every function of a user, with its source,
+    in the format add_funcs takes
+    Permission: Owner
+    '''
+    catalog = get_catalog(target_dir)
+    for target, func, (store_file, func_name) in iter_funcs(target_dir, author, password, token, allow_admin=False):
+        entry = catalog.find(func_name, store_file)
+        block = catalog.read_source(entry) if entry is not None else None
+        if block is None:
+            continue  # changed since it was listed
+        yield {
+            'target': target,
+            'username': entry['author'],
+            'content': block[1],
+            'deterministic': entry['deterministic'],
+        }
+
+
+def precompile(func_content: str, func_name: str) -> bool:
+    '''
+    Compile an uploaded function into the bytecode cache, return False if it does not compile
+    The others are never compiled again
+    '''
+    try:
+        compile_func(func_content, hashlib.sha256(func_content.encode()).hexdigest(), func_name)
+    except (SyntaxError, ValueError) as e:
+        print('Could not compile function:', e)
+        return False
+    return True
+
+
+def get_known_creds(target_dir: str, author: str, password: str) -> Union[str, None]:
+    '''
+    Get the hashed password of an author's functions that matches password, if any
+    '''
+    for creds in get_catalog(target_dir).get_author_creds(author):
+        if check_password(password, creds):
+            return creds
+    return None
 
 
-def invoke_func(func_name: str, params: list, target_dir: str, target_file: str, author: str = 'admin', password: str = 'admin') -> Dict[str, Any]:
+def create_token(target_dir: str, author: str, password: str) -> Union[Dict[str, Any], None]:
     '''
-    Run a serverless function from a function store
+    Log a user in, return a session token that stands in for their password
+    The token covers every function of the author protected by this password
     '''
-    if not func_exists(func_name, target_dir):
+    creds = [creds for creds in get_catalog(target_dir).get_author_creds(author)
+             if check_password(password, creds)]
+    if not creds:
         return None
 
-    invokee_file = 'invokee.py'
-    template_file = 'invokee_template.py'
-    return_signature = get_return_signature()
-    user_auth = verify_author(
-        author, password, func_name, target_dir, target_file)
+    token, expires_at = create_session_token(author, creds)
+    return {'token': token, 'expires_at': expires_at}
 
-    # User not found
-    if user_auth is None:
+
+def get_authorized_entry(func_name: str, target_dir: str, target_file: str, author: str, password: str,
+                         token: Union[str, None], alias: str, version: Union[str, None]) -> Union[Tuple[str, Dict[str, Any]], None]:
+    '''
+    Check that the user owns a function, then get the store file and catalog entry of the version to run
+    '''
+    start = time.perf_counter()
+    store_file = resolve_target(target_dir, target_file, alias, version)
+    entry = get_catalog(target_dir).find(func_name, store_file) if store_file is not None else None
+    # unknown names are not used as labels, callers could create any number of them
+    function = f'{target_file}:{func_name}' if entry is not None else REJECTED_FUNCTION
+    INVOCATION_PHASE.observe(time.perf_counter() - start, function=function, phase='exists')
+    if entry is None:
+        return None
+
+    # Wrong user, password or token
+    with INVOCATION_PHASE.time(function=function, phase='auth'):
+        if not verify_owner(entry['author'], entry['creds'], author, password, token):
+            return None
+    return store_file, entry
+
+
+def get_authorized_invokee(func_name: str, target_dir: str, target_file: str, author: str, password: str,
+                           token: Union[str, None] = None, alias: str = LATEST_ALIAS,
+                           version: Union[str, None] = None) -> Union[PreparedInvokee, None]:
+    '''
+    Check that the user owns a function, then get the version to run ready.
+    Each version is prepared and cached on its own, so a new upload never invalidates one
+    '''
+    found = get_authorized_entry(func_name, target_dir, target_file, author, password, token, alias, version)
+    if found is None:
         return None
+    return prepare_function(func_name, target_dir, found[0], f'{target_file}:{func_name}')
+
+
+def prepare_function(func_name: str, target_dir: str, store_file: str, function: str) -> Union[PreparedInvokee, None]:
+    '''
+    Get a version ready to run, recording the time spent and whether it was cached under its function label
+    '''
+    lookup = {}
+    with INVOCATION_PHASE.time(function=function, phase='prepare'):
+        prepared = prepare_invokee(func_name, target_dir, store_file, lookup=lookup)
+    observe_cache(function, 'prepared', lookup['hit'])
+    return prepared
+
 
-    # Wrong password
-    if not user_auth:
+def invoke_func(func_name: str, params: list, target_dir: str, target_file: str, author: str = 'admin', password: str = 'admin',
+                on_output: Callable[[str, str], None] = None, token: Union[str, None] = None,
+                alias: str = LATEST_ALIAS, version: Union[str, None] = None) -> Dict[str, Any]:
+    '''
+    Run a serverless function from a function store, the version given or the one an alias points to
+    When on_output is given, it receives ('stdout' | 'stderr', line) while the function runs
+    '''
+    found = get_authorized_entry(func_name, target_dir, target_file, author, password, token, alias, version)
+    if found is None:
+        INVOCATIONS.inc(function=REJECTED_FUNCTION)
+        INVOCATION_FAILURES.inc(function=REJECTED_FUNCTION)
+        return None
+    store_file, entry = found
+    function = f'{target_file}:{func_name}'
+    INVOCATIONS.inc(function=function)
+
+    # Deterministic functions are served from memory when possible, without preparing them
+    output = get_cached_result(os.path.join(target_dir, f'{store_file}.py'), entry, params)
+    if entry['deterministic']:
+        observe_cache(function, 'results', output is not None)
+    if output is not None:
+        if on_output is not None:
+            for name in ('stdout', 'stderr'):
+                for line in output[name].splitlines(keepends=True):
+                    on_output(name, line)
+        return {
+            'return_value': output['return_value'],
+            'stdout': output['stdout'],
+            'stderr': output['stderr'],
+        }
+
+    prepared = prepare_function(func_name, target_dir, store_file, function)
+    if prepared is None:
+        INVOCATION_FAILURES.inc(function=function)
         return None
 
-    prepare_invokee(func_name, target_dir, target_file,
-                    invokee_file, template_file)
+    # Run on a warm worker when the pool is enabled
+    environment = get_func_environment(target_dir, prepared)
+    if POOL_SIZE > 0:
+        output = get_pool().invoke(prepared.code, prepared.func_name, params, TIME_LIMIT, MEMORY_LIMIT,
+                                   on_output=on_output, environment=environment, owner=prepared.owner)
+    else:
+        output = invoke_with_limit(prepared.invokee_file, params, TIME_LIMIT, MEMORY_LIMIT,
+                                   on_output=on_output, environment=environment)
+    observe_invocation(function, output)
 
-    output = invoke_with_limit(
-        invokee_file, params, TIME_LIMIT, MEMORY_LIMIT)
+    if output['status'] != 'success':
+        raise Exception(output['message'])
 
-    stdout, return_value = output['stdout'].split(return_signature)
-    decoded_return_value = pickle.loads(
-        base64.b64decode(return_value)) if return_value else None
+    cache_result(prepared, params, output)
 
-    output = {
-        'return_value': decoded_return_value,
-        'stdout': stdout,
+    return {
+        'return_value': output['return_value'],
+        'stdout': output['stdout'],
         'stderr': output['stderr'],
     }
 
-    return output
 
+def invoke_batch(func_name: str, items: List[list], target_dir: str, target_file: str, author: str = 'admin', password: str = 'admin',
+                 item_timeout: float = None, token: Union[str, None] = None,
+                 alias: str = LATEST_ALIAS, version: Union[str, None] = None) -> Union[List[Dict[str, Any]], None]:
+    '''
+    Run a serverless function once per item of a batch, inside one process.
+    Auth and preparation are done once, limits apply to the whole batch
+    '''
+    prepared = get_authorized_invokee(
+        func_name, target_dir, target_file, author, password, token, alias, version)
+    if prepared is None:
+        INVOCATIONS.inc(function=REJECTED_FUNCTION)
+        INVOCATION_FAILURES.inc(function=REJECTED_FUNCTION)
+        return None
+    function = f'{target_file}:{func_name}'
+    INVOCATIONS.inc(function=function)
+
+    environment = get_func_environment(target_dir, prepared)
+    if POOL_SIZE > 0:
+        output = get_pool().invoke(prepared.code, prepared.func_name, [], TIME_LIMIT, MEMORY_LIMIT,
+                                   batch=items, item_timeout=item_timeout, environment=environment,
+                                   owner=prepared.owner)
+    else:
+        output = invoke_with_limit(prepared.invokee_file, [], TIME_LIMIT, MEMORY_LIMIT,
+                                   batch=items, item_timeout=item_timeout, environment=environment)
+    observe_invocation(function, output)
+
+    if output['status'] != 'success':
+        raise Exception(output['message'])
+
+    return [{
+        'return_value': item['return_value'],
+        'error': item['error'],
+        'stdout': item['stdout'],
+        'stderr': item['stderr'],
+    } for item in output['results']]
+
+
+def modify_func(func_name: str, new_func: str, target_dir: str, target_file: str, author: str = 'admin',
+                password: str = 'admin', token: Union[str, None] = None) -> Union[str, None]:
+    '''
+    Upload a new version of a serverless function and move its latest alias to it,
+    return a target file name
+    Older versions stay runnable by id or by any alias still pointing to them
+    Permission: Owner
+    '''
+    with lock_file(target_dir, target_file):
+        # look the function up under the lock, a concurrent edit may have moved it
+        store_file = resolve_target(target_dir, target_file)
+        entry = get_owned_entry(func_name, target_dir, target_file, author, password, token)
+        if entry is None:
+            return None
+
+        if is_legacy_file(f'{target_file}.py'):
+            # replace old content with new one, between the author and end signatures
+            file_path = get_target_path(target_dir, target_file)
+            start, end = entry['start_line'], entry['end_line']
+            with open(file_path) as f:
+                lines = f.readlines()
+            lines[start+2:end-1] = [new_func if new_func.endswith('\n') else new_func + '\n']
+            write_atomic(file_path, ''.join(lines).encode())
+            get_catalog(target_dir).reindex_file(target_file)
+            invalidate_invokee(func_name, target_dir, target_file)
+            return target_file
+
+        # its name and author stay the same
+        parsed = split_func_content(new_func)
+        if parsed is None or parsed[0] != func_name or not precompile(new_func, func_name):
+            return None
+        version = write_version(target_dir, target_file, get_start_signature(func_name, parsed[1], entry['deterministic'])
+                                + get_author_signature(entry['author'], None, entry['creds'])
+                                + new_func
+                                + get_end_signature(func_name))
+        get_catalog(target_dir).reindex_file(get_version_file(target_file, version))
+
+        if store_file == target_file:
+            # a function stored without versions gets them from now on
+            write_aliases(target_dir, target_file, {LATEST_ALIAS: version})
+            remove_func_file(target_dir, target_file)
+            get_catalog(target_dir).reindex_file(target_file)
+            invalidate_invokee(func_name, target_dir, target_file)
+        else:
+            write_aliases(target_dir, target_file, {**read_aliases(target_dir, target_file), LATEST_ALIAS: version})
+            # the new version runs with the libraries of the one it replaces, existing versions keep theirs
+            requirements = read_requirements(target_dir, target_file)
+            previous = split_version_file(store_file)[1]
+            if previous in requirements and version not in requirements:
+                write_requirements(target_dir, target_file, {**requirements, version: requirements[previous]})
+
+    # the previous version may have no alias left
+    compactor.note_garbage(target_dir)
+    return target_file
 
-def modify_func(func_name: str, new_func: str, target_dir: str, target_file: str) -> Union[str, None]:
+
+def delete_func(func_name: str, target_dir: str, target_file: str, author: str = 'admin', password: str = 'admin',
+                token: Union[str, None] = None) -> Union[str, None]:
     '''
-    Modify a serverless function in a python file,
+    Delete a serverless function from a python file, every version of it included,
     return a target file name
+    Permission: Owner
+    '''
+    with lock_file(target_dir, target_file):
+        store_file = resolve_target(target_dir, target_file)
+        entry = get_owned_entry(func_name, target_dir, target_file, author, password, token)
+        if entry is None:
+            return None
+
+        if is_legacy_file(f'{target_file}.py'):
+            # delet function and signatures
+            file_path = get_target_path(target_dir, target_file)
+            start, end = entry['start_line'], entry['end_line']
+            with open(file_path) as f:
+                lines = f.readlines()
+            del lines[start:end]
+            write_atomic(file_path, ''.join(lines).encode())
+            removed = [target_file]
+        elif store_file == target_file:
+            remove_func_file(target_dir, target_file)
+            removed = [target_file]
+        else:
+            removed = remove_func_dir(target_dir, target_file)
+
+        for store_file in removed:
+            get_catalog(target_dir).reindex_file(store_file)
+    for store_file in removed:
+        invalidate_invokee(func_name, target_dir, store_file)
+
+    compactor.note_garbage(target_dir)
+    return target_file
+
+
+def get_owned_entry(func_name: str, target_dir: str, target_file: str, author: str, password: str,
+                    token: Union[str, None] = None) -> Union[Dict[str, Any], None]:
+    '''
+    Get the catalog entry of the latest version of a function, if the user owns it
     '''
-    if not func_exists(func_name, target_dir):
+    store_file = resolve_target(target_dir, target_file)
+    entry = get_catalog(target_dir).find(func_name, store_file) if store_file is not None else None
+    if entry is None or not verify_owner(entry['author'], entry['creds'], author, password, token):
         return None
+    return entry
 
-    start, end = locate_function(func_name, target_dir, target_file)
 
-    if start is None or end is None:
+def get_func_versions(func_name: str, target_dir: str, target_file: str, author: str = 'admin', password: str = 'admin',
+                      token: Union[str, None] = None) -> Union[Dict[str, Any], None]:
+    '''
+    Get the versions of a function, oldest first, where its aliases point and the libraries of each version
+    Permission: Owner
+    '''
+    if get_owned_entry(func_name, target_dir, target_file, author, password, token) is None:
         return None
+    if not is_versioned(target_dir, target_file):
+        return {'versions': [], 'aliases': {}, 'requirements': {}}
+    return {
+        'versions': get_versions(target_dir, target_file),
+        'aliases': read_aliases(target_dir, target_file),
+        'requirements': read_requirements(target_dir, target_file),
+    }
 
-    # replace old content with new one
-    with open(f'{target_dir}/{target_file}.py', 'r+') as f:
-        lines = f.readlines()
-        lines[start+1:end-1] = new_func.split('\n')
-        f.seek(0)
-        f.writelines(lines)
-        f.truncate()
 
-    return target_file
+def set_func_alias(func_name: str, alias: str, version: str, target_dir: str, target_file: str, author: str = 'admin',
+                   password: str = 'admin', token: Union[str, None] = None) -> Union[Dict[str, str], None]:
+    '''
+    Point an alias of a function to one of its versions, in 1 atomic swap.
+    This is how a version is deployed or rolled back, return the new aliases
+    Permission: Owner
+    '''
+    if not ALIAS.fullmatch(alias) or not VERSION.fullmatch(version):
+        return None
+
+    with lock_file(target_dir, target_file):
+        if get_owned_entry(func_name, target_dir, target_file, author, password, token) is None:
+            return None
+        # only versions of this very function can be aliased
+        if get_catalog(target_dir).find(func_name, get_version_file(target_file, version)) is None:
+            return None
+
+        aliases = {**read_aliases(target_dir, target_file), alias: version}
+        write_aliases(target_dir, target_file, aliases)
+    compactor.note_garbage(target_dir)
+    return aliases
 
 
-def delete_func(func_name: str, target_dir: str, target_file: str) -> Union[str, None]:
+def get_func_environment(target_dir: str, prepared: PreparedInvokee) -> Union[str, None]:
     '''
-    Delete a serverless function from a python file,
-    return a target file name
+    Get the site-packages directory a version runs with, None when it uses the server libraries
+    Raise right away if its environment is not built on this server, a library job builds it meanwhile
     '''
-    if not func_exists(func_name, target_dir):
+    target_file, version = split_version_file(os.path.relpath(prepared.store_file, target_dir)[:-len('.py')])
+    requirements = read_requirements(target_dir, target_file).get(version) if version is not None else None
+    if not requirements:
         return None
+    environment = get_environment(requirements)
+    if environment is None:
+        # pip may take much longer than an invocation, it never runs in one
+        lib_jobs.submit_once(('environment', *requirements), build_environment, requirements)
+        raise Exception('Libraries of the function are being installed, try again later')
+    return environment
 
-    # check for start and end of function
 
-    start, end = locate_function(func_name, target_dir, target_file)
-    if start is None or end is None:
+def install_func_libs(func_name: str, libs: List[str], target_dir: str, target_file: str, author: str = 'admin',
+                      password: str = 'admin', token: Union[str, None] = None,
+                      alias: str = LATEST_ALIAS, version: Union[str, None] = None) -> Union[Job, None]:
+    '''
+    Add libraries to the environment of 1 version of a function in the background,
+    the version given or the one an alias points to. Other versions and functions keep their own.
+    Return the job to poll, a request for the same libraries as an unfinished one gets the same job
+    Permission: Owner
+    '''
+    if get_owned_entry(func_name, target_dir, target_file, author, password, token) is None:
         return None
+    # functions stored without versions have no directory to keep requirements in
+    store_file = resolve_target(target_dir, target_file, alias, version)
+    version = split_version_file(store_file)[1] if store_file is not None else None
+    if version is None or get_catalog(target_dir).find(func_name, store_file) is None:
+        return None
+    libs = sorted({lib.strip() for lib in libs if lib.strip()})
+    if not libs or merge_requirements([], libs) is None:
+        return None
+    return lib_jobs.submit_once(('function', target_dir, target_file, version, *libs),
+                                build_func_environment, func_name, libs, target_dir, target_file, version)
 
-    # delet function and signatures
-    with open(f'{target_dir}/{target_file}.py', 'r+') as f:
-        lines = f.readlines()
-        del lines[start:end]
-        f.seek(0)
-        f.writelines(lines)
-        f.truncate()
 
-    return target_file
+def build_func_environment(func_name: str, libs: List[str], target_dir: str, target_file: str, version: str) -> List[str]:
+    '''
+    Build the environment of a version with more libraries, then switch the version to it
+    Return the requirements of the version
+    '''
+    while True:
+        # pip runs outside the lock, edits and alias moves of the function go on meanwhile
+        merged = merge_requirements(read_requirements(target_dir, target_file).get(version, []), libs)
+        build_environment(merged)
+        with lock_file(target_dir, target_file):
+            requirements = read_requirements(target_dir, target_file)
+            # an install that finished while this one was building changed the libraries, build again
+            if merge_requirements(requirements.get(version, []), libs) == merged:
+                write_requirements(target_dir, target_file, {**requirements, version: merged})
+                break
+    # memoized results came from the previous libraries
+    invalidate_invokee(func_name, target_dir, get_version_file(target_file, version))
+    return merged
 
 
 if __name__ == '__main__':
@@ -1,109 +1,305 @@
 import time
 import psutil
 import subprocess
-import pickle
-import base64
-import importlib.util
-import inspect
+import hashlib
+import marshal
 import os
+import pickle
 import shutil
+import sys
+import tempfile
+from dataclasses import dataclass
 from .signature import add_signature_to_invokee, insert_func_to_invokee
-from typing import Dict, Union
+from .catalog import get_catalog
+from .cache import LRUCache
+from .supervisor import get_supervisor, memory_limit_env
+from .worker import MEMORY_ERROR_EXIT
+from .transport import read_payload, write_frame
+from .store import write_atomic
+from . import zygote
+from typing import Any, BinaryIO, Callable, Dict, List, Tuple, Union
 from threading import Thread
 from queue import Queue, Empty
-from config import MAX_STDOUT
+from utils import create_dir
+from config import MAX_STDOUT, PREPARED_CACHE_SIZE, INVOKEE_CACHE, BYTECODE_CACHE, RESULT_CACHE_SIZE, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL
 
 '''
 This file contains the low-level logic of invoking a function
 '''
 
 
-def prepare_invokee(func_name: str, funcstore_dir: str, funcstore_file: str, invokee_file: str = 'invokee.py', template: str = 'invokee_template.py') -> Union[str, None]:
+@dataclass(frozen=True)
+class PreparedInvokee:
+    '''
+    An immutable, ready-to-run copy of a stored function
+    '''
+    store_file: str
+    func_name: str
+    content_hash: str
+    source: str
+    code: bytes  # marshalled code object of the source
+    invokee_file: str  # standalone invokee script, for one-off processes
+    deterministic: bool = False  # results can be memoized
+    owner: Union[Tuple[str, str], None] = None  # (author, creds) of the function, warm workers only run code of 1 owner
+
+
+def retire_invokee_file(key: Tuple[str, str, str], prepared: PreparedInvokee) -> None:
+    '''
+    Mark when the invokee script of an evicted entry stopped being cached.
+    An invocation may still be about to start it, compaction removes it once it is old
+    '''
+    try:
+        os.utime(prepared.invokee_file)
+    except OSError:
+        pass
+
+
+prepared_cache = LRUCache(PREPARED_CACHE_SIZE, on_evict=retire_invokee_file)
+# pickled outputs of deterministic functions
+result_cache = LRUCache(RESULT_CACHE_SIZE, max_bytes=RESULT_CACHE_MAX_BYTES, ttl=RESULT_CACHE_TTL)
+
+
+def get_bytecode_file(content_hash: str) -> str:
+    '''
+    Path of the compiled code of a function source, for the running python version
+    '''
+    return os.path.join(BYTECODE_CACHE, f'{content_hash}.{sys.implementation.cache_tag}.bin')
+
+
+def compile_func(source: str, content_hash: str, func_name: str) -> bytes:
+    '''
+    Get the marshalled code of a function source.
+    It is compiled once per content and python version, then loaded from the bytecode cache
+    Raise SyntaxError if the source does not compile
+    '''
+    bytecode_file = get_bytecode_file(content_hash)
+    try:
+        with open(bytecode_file, 'rb') as f:
+            return f.read()
+    except OSError:
+        pass
+
+    # the file name does not depend on where the source is stored, so the same content shares its code
+    code = marshal.dumps(compile(source, f'{func_name}.py', 'exec'))
+    create_dir(BYTECODE_CACHE)
+    write_atomic(bytecode_file, code)
+    return code
+
+
+def prepare_invokee(func_name: str, funcstore_dir: str, funcstore_file: str, template: str = 'invokee_template.py',
+                    lookup: Dict[str, bool] = None) -> Union[PreparedInvokee, None]:
+    '''
+    Get a prepared copy of a stored function.
+    Each (store file, function, content) is only prepared once,
+    then served from an LRU cache, so the invoke path stays read-only
+    lookup receives whether the copy was served from the cache
+    '''
+    lookup = {} if lookup is None else lookup
+    lookup['hit'] = False
+    try:
+        catalog = get_catalog(funcstore_dir)
+        entry = catalog.find(func_name, funcstore_file)
+        if entry is None:
+            return None
+
+        # The catalog knows the content hash, a cached function is never read from disk
+        store_file = os.path.join(funcstore_dir, f'{funcstore_file}.py')
+        key = (store_file, func_name, entry['content_hash'])
+        prepared = prepared_cache.get(key)
+        if prepared is not None:
+            lookup['hit'] = True
+            return prepared
+
+        block = catalog.read_source(entry)
+        if block is None:
+            # the store file was edited outside the API, index it again
+            catalog.reindex_file(funcstore_file)
+            entry = catalog.find(func_name, funcstore_file)
+            block = catalog.read_source(entry) if entry is not None else None
+            if block is None:
+                return None
+            key = (store_file, func_name, entry['content_hash'])
+        _, source = block
+
+        code = compile_func(source, entry['content_hash'], func_name)
+
+        # * BUILD a private invokee file from the template
+        create_dir(INVOKEE_CACHE)
+        key_hash = hashlib.sha256(repr(key).encode()).hexdigest()
+        invokee_file = os.path.join(INVOKEE_CACHE, f'{key_hash}.py')
+        fd, tmp_file = tempfile.mkstemp(dir=INVOKEE_CACHE, suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(template, tmp_file)
+            add_signature_to_invokee(tmp_file)
+            insert_func_to_invokee(f'{source}\nfunc = {func_name}\n', tmp_file)
+            os.replace(tmp_file, invokee_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+        prepared = PreparedInvokee(store_file, func_name, entry['content_hash'], source, code,
+                                   invokee_file, entry['deterministic'],
+                                   (entry['author'], entry['creds']))
+        prepared_cache.put(key, prepared)
+        return prepared
+    except Exception as e:
+        print('Could not prepare function:', e)
+        return None
+
+
+def invalidate_invokee(func_name: str, funcstore_dir: str, funcstore_file: str) -> None:
+    '''
+    Drop every prepared copy and memoized result of a function,
+    called when the function changes
+    '''
+    store_file = os.path.join(funcstore_dir, f'{funcstore_file}.py')
+
+    def same_func(key: tuple) -> bool:
+        return key[0] == store_file and key[1] == func_name
+
+    prepared_cache.invalidate(same_func)
+    result_cache.invalidate(same_func)
+
+
+def get_result_key(store_file: str, func_name: str, content_hash: str, params: list) -> Union[Tuple[str, str, str, str], None]:
     '''
-    This function do minimal modification to the invokee file
-    so it will be ready for next call
+    Key of a memoized result: the function content and its pickled params
     '''
     try:
-        # * RESET invokee file
-        shutil.copyfile(template, invokee_file)
-        add_signature_to_invokee(invokee_file)
-
-        # * PREPARE function to be invoked
-        # Get the function from funcstore
-        spec = importlib.util.spec_from_file_location(
-            funcstore_file, os.path.join(funcstore_dir, f'{funcstore_file}.py'))
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
-        func = getattr(module, func_name)
-
-        # Rename function
-        src = inspect.getsource(func)
-        src = src.replace(func_name, 'func')
-
-        # * PASS function to invokee file
-        insert_func_to_invokee(src, invokee_file)
-
-        return 'Function prepared successfully'
+        params_hash = hashlib.sha256(pickle.dumps(params)).hexdigest()
     except Exception:
         return None
+    return (store_file, func_name, content_hash, params_hash)
+
+
+def get_cached_result(store_file: str, entry: Dict[str, Any], params: list) -> Union[Dict[str, Any], None]:
+    '''
+    Get a memoized output of a deterministic function from its catalog entry,
+    so a hit never has to prepare the function
+    '''
+    if not entry['deterministic']:
+        return None
+    key = get_result_key(store_file, entry['name'], entry['content_hash'], params)
+    cached = result_cache.get(key) if key is not None else None
+    return pickle.loads(cached) if cached is not None else None
+
+
+def cache_result(prepared: PreparedInvokee, params: list, output: Dict[str, Any]) -> None:
+    '''
+    Memoize the output of a deterministic function, failed runs are never cached
+    '''
+    if not prepared.deterministic or output['status'] != 'success' or output.get('error'):
+        return
+    key = get_result_key(prepared.store_file, prepared.func_name, prepared.content_hash, params)
+    if key is None:
+        return
+    try:
+        result_cache.put(key, pickle.dumps(output))
+    except Exception:
+        # return value can not be pickled, skip memoization
+        pass
 
 
-def invoke_with_limit(invokee: str, params: str, time_limit: int = 60, memory_limit: int = 1000000000) -> Dict[str, str]:
+def invoke_with_limit(invokee: str, params: list, time_limit: int = 60, memory_limit: int = 1000000000,
+                      batch: List[list] = None, item_timeout: float = None,
+                      on_output: Callable[[str, str], None] = None, environment: Union[str, None] = None) -> Dict[str, Any]:
     '''
     Run invokee with some limits on top
     Current check for time and memory limits
+    When batch is given, params is ignored and every item of the batch runs in the same process
+    When on_output is given, it receives ('stdout' | 'stderr', line) while the function runs
+    environment is the site-packages directory of the function, None for the server libraries
     '''
     output = {
         'status': 'error',
         'message': 'Function did not run successfully',
+        'return_value': None,
         'stdout': '',
         'stderr': ''
     }
+    stdout_queue = Queue()
+    stderr_queue = Queue()
+    result = {}
+    timings = {}
+    if batch is None:
+        request = {'params': params}
+    else:
+        request = {'items': batch, 'item_timeout': item_timeout, 'max_stdout': MAX_STDOUT}
 
     try:
-        encoded_params = base64.b64encode(pickle.dumps(params)).decode()
-        cmd = ['python3', invokee, encoded_params]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE, text=True)
+        # params and return value get their own pipes, apart from std output
+        params_read, params_write = os.pipe()
+        result_read, result_write = os.pipe()
+        cmd = [invokee, str(params_read), str(result_write)]
+        # invokee files live outside the project root, keep logic importable
+        python_path = [os.getcwd()] if environment is None else [os.getcwd(), environment]
+        env = {'PYTHONPATH': os.pathsep.join(python_path), 'INVOKEE_MEMORY_LIMIT': memory_limit_env(memory_limit)}
+        start = time.perf_counter()
+        try:
+            # the zygote preloads the server libraries, so only functions without an environment fork from it
+            process = zygote.popen(cmd, env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                   pass_fds=(params_read, result_write)) if environment is None else None
+            if process is None:
+                process = subprocess.Popen(['python3', *cmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                           env={**os.environ, **env}, pass_fds=(params_read, result_write))
+        finally:
+            os.close(params_read)
+            os.close(result_write)
+        timings['spawn'] = time.perf_counter() - start
 
         # Define threads to store stdout and stderr
-        stdout_queue = Queue()
-        stderr_queue = Queue()
         stdout_thread = Thread(target=enqueue_output,
-                               args=(process.stdout, stdout_queue, MAX_STDOUT))
+                               args=(process.stdout, stdout_queue, MAX_STDOUT, on_output and (lambda line: on_output('stdout', line))))
         stderr_thread = Thread(target=enqueue_output,
-                               args=(process.stderr, stderr_queue, MAX_STDOUT))
-        stdout_thread.daemon = True
-        stderr_thread.daemon = True
-
-        # Start time and memory tracking
-        start_time = time.perf_counter()
-        start_mem = psutil.Process(process.pid).memory_info().rss
-
-        # start stdout and stderr threads
-        stdout_thread.start()
-        stderr_thread.start()
-
-        # last_print_time = start_time
-        while process.poll() is None:
-            if over_time_limit(start_time, time_limit):
-                raise TimeoutError('Function exceeded the time limit')
-            if over_mem_limit(process.pid, start_mem, memory_limit):
-                raise MemoryError('Function exceeded the memory limit')
-
-            # Print the dashboard every 2s
-            # if time.perf_counter() - last_print_time > 2:
-            #     print_dashboard(process.pid, start_time,
-            #                     time_limit, memory_limit)
-            #     last_print_time = time.perf_counter()
-
-            # Store the output in a list
+                               args=(process.stderr, stderr_queue, MAX_STDOUT, on_output and (lambda line: on_output('stderr', line))))
+        # Define threads to send params and receive the return value
+        params_thread = Thread(target=send_params,
+                               args=(os.fdopen(params_write, 'wb'), request))
+        result_thread = Thread(target=receive_result,
+                               args=(os.fdopen(result_read, 'rb'), result))
+        threads = [stdout_thread, stderr_thread, params_thread, result_thread]
+        for thread in threads:
+            thread.daemon = True
+
+        # Hand the process over to the supervisor, it kills the process on a limit
+        watch = get_supervisor().watch(process, time_limit, memory_limit)
+
+        for thread in threads:
+            thread.start()
+
+        # Block until the process exits, no CPU is spent while waiting
+        process.wait()
+        for thread in threads:
+            thread.join()
+        timings['decode'] = result.pop('decode', 0.0)
+        timings['run'] = time.perf_counter() - start - timings['spawn'] - timings['decode']
+
+        reason = get_supervisor().unwatch(watch)
+        output['peak_rss'] = watch.peak_rss
+        if reason == 'time':
+            output['limit'] = 'time'
+            raise TimeoutError('Function exceeded the time limit')
+        if reason == 'memory' or process.returncode == MEMORY_ERROR_EXIT:
+            output['limit'] = 'memory'
+            raise MemoryError('Function exceeded the memory limit')
+
+        if process.returncode < 0:
+            raise Exception(f'Process was killed with code {process.returncode}')
+
+        if batch is None:
+            output['return_value'] = result.get('value')
+            if process.returncode != 0:
+                output['error'] = f'Process exited with code {process.returncode}'
+        elif 'value' in result:
+            output['results'] = result['value']['results']
+        else:
+            raise Exception('Batch did not return any result')
 
         output['status'] = 'success'
         output['message'] = 'Function ran successfully'
-    except (TimeoutError, MemoryError) as Exception:
-        process.terminate()
-        output['message'] = str(Exception)
+    except (TimeoutError, MemoryError) as e:
+        output['message'] = str(e)
 
     except Exception as e:
         output['message'] = 'Unexpected error occurred'
@@ -111,10 +307,39 @@ def invoke_with_limit(invokee: str, params: str, time_limit: int = 60, memory_li
     finally:
         output['stdout'] = get_queue_content(stdout_queue)
         output['stderr'] = get_queue_content(stderr_queue)
+        output['timings'] = timings
 
     return output
 
 
+def send_params(channel: BinaryIO, request: Dict[str, Any]) -> None:
+    '''
+    A helper function to write the params of an invocation to its pipe
+    '''
+    try:
+        with channel:
+            write_frame(channel, request)
+    except OSError:
+        # invokee exited before reading its params
+        pass
+
+
+def receive_result(channel: BinaryIO, result: Dict[str, Any]) -> None:
+    '''
+    A helper function to read the return value of an invocation from its pipe
+    The seconds spent decoding it are kept as well
+    '''
+    with channel:
+        try:
+            payload = read_payload(channel)
+            start = time.perf_counter()
+            result['value'] = pickle.loads(payload)
+            result['decode'] = time.perf_counter() - start
+        except EOFError:
+            # invokee exited without a return value
+            pass
+
+
 def over_time_limit(start_time: float, limit: int = 60) -> bool:
     '''
     A helper function to limit the execution time of a process
@@ -131,16 +356,19 @@ def over_mem_limit(pid: int, start_mem: int, limit: int = 50000000) -> bool:
     return psutil.Process(pid).memory_info().rss - start_mem > limit
 
 
-def enqueue_output(out: subprocess.Popen, queue: Queue, maxsize: int = MAX_STDOUT) -> None:
+def enqueue_output(out: subprocess.Popen, queue: Queue, maxsize: int = MAX_STDOUT, forward: Callable[[str], None] = None) -> None:
     '''
     A helper function to enqueue the output of a process.
     It will store stdout and stderr in a queue
     Auto delete the oldest item if the queue is full
+    Each line is also forwarded as soon as it is read, if forward is given
     '''
 
-    for line in iter(out.readline, b''):
+    for line in iter(out.readline, ''):
         if line.strip():
             queue.put(line)
+            if forward is not None:
+                forward(line)
         if queue.qsize() > maxsize:
             queue.get()
     out.close()
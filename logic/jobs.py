@@ -0,0 +1,145 @@
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock, local
+from typing import Any, Callable, Dict, Hashable, Union
+from config import INVOKE_CONCURRENCY, INVOKE_QUEUE_SIZE, JOB_RETENTION, JOB_LOG_LINES, LIB_JOB_WORKERS
+
+'''
+This file contains the background jobs of the API server.
+A job runs on a dedicated executor, its status, result and last output lines are kept for later polling
+'''
+
+# job run by the current thread
+_current = local()
+
+
+class Job:
+    '''
+    A unit of work submitted in the background
+    '''
+
+    def __init__(self) -> None:
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'  # queued -> running -> success | error
+        self.message = 'Job is waiting to run'
+        self.result = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.logs = deque(maxlen=JOB_LOG_LINES)
+
+    def log(self, line: str) -> None:
+        self.logs.append(line)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'message': self.message,
+            'result': self.result,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'logs': list(self.logs),
+        }
+
+
+class JobStore:
+    '''
+    Run jobs on a bounded executor and remember the last finished ones
+    '''
+
+    def __init__(self, max_workers: int = INVOKE_CONCURRENCY, retention: int = JOB_RETENTION, name: str = 'job') -> None:
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name)
+        self.retention = retention
+        self.jobs: Dict[str, Job] = OrderedDict()
+        self.active: Dict[Hashable, Job] = {}  # key -> job submitted once, until it finishes
+        self.lock = Lock()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Job:
+        '''
+        Run fn in the background, return its job right away
+        '''
+        job = Job()
+        with self.lock:
+            self.jobs[job.id] = job
+            self.forget_old_jobs()
+        self.executor.submit(self.run, job, fn, *args, **kwargs)
+        return job
+
+    def submit_once(self, key: Hashable, fn: Callable, *args, **kwargs) -> Job:
+        '''
+        Like submit, but return the unfinished job of the same key instead of running fn again
+        '''
+        with self.lock:
+            job = self.active.get(key)
+            if job is not None and job.finished_at is None:
+                return job
+            self.active = {other: active for other, active in self.active.items() if active.finished_at is None}
+            job = self.active[key] = Job()
+            self.jobs[job.id] = job
+            self.forget_old_jobs()
+        self.executor.submit(self.run, job, fn, *args, **kwargs)
+        return job
+
+    def run_now(self, fn: Callable, *args, **kwargs) -> Future:
+        '''
+        Run fn on the executor without tracking it as a job,
+        the caller waits for the returned future
+        '''
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def run(self, job: Job, fn: Callable, *args, **kwargs) -> None:
+        job.status = 'running'
+        job.message = 'Job is running'
+        job.started_at = time.time()
+        _current.job = job
+        try:
+            job.result = fn(*args, **kwargs)
+            job.status = 'success'
+            job.message = 'Job finished successfully'
+        except Exception as e:
+            job.status = 'error'
+            job.message = str(e)
+        finally:
+            _current.job = None
+            job.finished_at = time.time()
+
+    def get(self, job_id: str) -> Union[Job, None]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def forget_old_jobs(self) -> None:
+        '''
+        Drop the oldest finished jobs once there are too many
+        '''
+        finished = [job_id for job_id, job in self.jobs.items()
+                    if job.finished_at is not None]
+        for job_id in finished[:max(len(self.jobs) - self.retention, 0)]:
+            del self.jobs[job_id]
+
+
+def current_job() -> Union[Job, None]:
+    '''
+    Get the job the current thread is running, None outside of jobs
+    '''
+    return getattr(_current, 'job', None)
+
+
+def log_progress(line: str) -> None:
+    '''
+    Add a line to the logs of the current job, if any
+    '''
+    job = current_job()
+    if job is not None:
+        job.log(line)
+
+
+# Room for every admitted invocation, running or waiting in the scheduler,
+# so a granted invocation never waits behind ones that can not run yet
+invoke_jobs = JobStore(INVOKE_CONCURRENCY + INVOKE_QUEUE_SIZE, JOB_RETENTION, name='invoke')
+# Library installs, apart from invocations so they never take an invocation slot
+lib_jobs = JobStore(LIB_JOB_WORKERS, JOB_RETENTION, name='libs')
@@ -1,75 +1,206 @@
-from typing import List
+from importlib import invalidate_caches, metadata
+from threading import Lock, Timer
+from typing import Callable, Dict, List, Union
+from config import LIB_STAMP_FILE, LIB_WHEELHOUSE
+from .jobs import Job, lib_jobs, log_progress
+from .zygote import retire_zygote
+import hashlib
+import json
 import os
+import re
+import shutil
 import subprocess
+import sys
 
 '''
 This file handles all the library management in the virtual environment
+The installed libraries are read from the metadata of installed distributions, without running pip,
+and cached until the next install
+A stamp next to the requirements file remembers the last install, so a restart with nothing new skips pip
+Installs run as background jobs, 1 at a time, and identical requests share 1 job
 '''
 
+# pip freeze leaves out the packaging tools
+FREEZE_EXCLUDE = {'pip', 'setuptools', 'wheel', 'distribute'}
+
+# normalized name -> 'Name==version', None until read again
+_installed: Union[Dict[str, str], None] = None
+_installed_lock = Lock()
+# pip must not change the server libraries twice at once
+_install_lock = Lock()
+
+def normalize_name(name: str) -> str:
+    '''
+    Compare project names like pip does: case, '-', '_' and '.' do not matter
+    '''
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def get_installed() -> Dict[str, str]:
+    '''
+    Get the installed distributions by normalized name, read once until an install finishes
+    The result must not be modified
+    '''
+    global _installed
+    with _installed_lock:
+        if _installed is None:
+            installed = {}
+            for dist in metadata.distributions():
+                name = dist.metadata['Name']
+                if not name or normalize_name(name) in FREEZE_EXCLUDE:
+                    continue
+                # the first one on sys.path is the one imported, like pip freeze
+                installed.setdefault(normalize_name(name), f'{name}=={dist.version}')
+            _installed = installed
+        return _installed
+
+def invalidate_libs() -> None:
+    '''
+    Forget the installed libraries, they are read again on next use
+    '''
+    global _installed
+    invalidate_caches()  # new distributions are not found on cached path entries
+    with _installed_lock:
+        _installed = None
+
 def get_libs() -> List[str]:
     '''
     Get all installed libraries in the virtual environment
     '''
-    result = subprocess.run(['pip', 'freeze'], stdout=subprocess.PIPE)
-    installed_libs = result.stdout.decode('utf-8').split('\n')
-    return [lib for lib in installed_libs if lib]  # Filter out empty strings
+    return sorted(get_installed().values(), key=str.lower)
+
+def is_installed(lib: str) -> bool:
+    '''
+    Check if a requirement is met: the same pinned version, or any version of a bare name
+    '''
+    installed = get_installed()
+    name, _, version = lib.partition('==')
+    pinned = installed.get(normalize_name(name.strip()))
+    if pinned is None:
+        return False
+    return not version or pinned.partition('==')[2] == version.strip()
 
 def install_libs(libs: List[str], req_file: str = 'cloud_requirements.txt') -> None:
     '''
     Install a list of libraries to the virtual environment
     '''
-    # Check if the library is already installed
-    installed_libs = get_libs()
-    libs_to_install = []
-
-    # Sort both lists
-    libs.sort()
-    installed_libs.sort()
-
-    # Use two-pointer technique to find non-existing libraries
-    i, j = 0, 0
-    while i < len(libs) and j < len(installed_libs):
-        if libs[i] < installed_libs[j]:
-            libs_to_install.append(libs[i])
-            i += 1
-        elif libs[i] > installed_libs[j]:
-            j += 1
+    with _install_lock:
+        # Check if the library is already installed
+        libs_to_install = [lib for lib in libs if lib and not is_installed(lib)]
+
+        if libs_to_install:
+            log_progress(f'Installing {" ".join(libs_to_install)}')
+            try:
+                run_pip('install', libs_to_install, on_output=log_progress)
+            finally:
+                invalidate_libs()
+                # the zygote still holds the libraries it imported before, the next one imports the new ones
+                retire_zygote()
         else:
-            i += 1
-            j += 1
+            log_progress('Libraries are already installed')
 
-    # Add remaining libraries that are not in installed_libs
-    while i < len(libs):
-        libs_to_install.append(libs[i])
-        i += 1
+        update_requirements(req_file)
 
-    if libs_to_install:
-        install_str = ' '.join(libs_to_install)
-        os.system(f'pip install {install_str}')
+def submit_install(libs: List[str], req_file: str = 'cloud_requirements.txt') -> Job:
+    '''
+    Install libraries in the background, return the job to poll
+    A request for the same libraries as an unfinished one gets the same job
+    '''
+    libs = sorted({lib.strip() for lib in libs if lib.strip()})
+    return lib_jobs.submit_once(('server', req_file, *libs), install_libs, libs, req_file)
+
+def get_index_args() -> List[str]:
+    '''
+    Options of pip telling where libraries come from, only the local wheelhouse when there is one
+    '''
+    if LIB_WHEELHOUSE:
+        return ['--no-index', '--find-links', LIB_WHEELHOUSE]
+    return []
 
-    update_requirements(req_file)
+def run_pip(command: str, libs: List[str], options: List[str] = None, timeout: Union[float, None] = None,
+            on_output: Callable[[str], None] = None) -> None:
+    '''
+    Run a pip command on some libraries with the interpreter of the server
+    on_output receives each line of output as soon as pip writes it
+    Raise an exception with the last line of the output if it fails
+    '''
+    index_args = get_index_args() if command in ('install', 'download', 'wheel') else []
+    # libraries come after --, they can not be taken for options
+    process = subprocess.Popen([sys.executable, '-m', 'pip', command, '--disable-pip-version-check',
+                                *index_args, *(options or []), '--', *libs],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    timer = Timer(timeout, process.kill) if timeout else None
+    if timer is not None:
+        timer.start()
+    last_line = None
+    try:
+        for line in process.stdout:
+            line = line.rstrip()
+            if line:
+                last_line = line
+                if on_output is not None:
+                    on_output(line)
+        process.wait()
+    finally:
+        process.stdout.close()
+        if timer is not None:
+            timer.cancel()
+    if process.returncode != 0:
+        raise Exception(last_line or f'pip exited with code {process.returncode}')
 
 def update_requirements(file_path: str) -> None:
     '''
     Update requirements.txt file with all installed libraries, instead of manually updating it
     '''
-    os.system(f'pip freeze > {file_path}')
+    with open(file_path, 'w') as f:
+        f.writelines(f'{lib}\n' for lib in get_libs())
+
+def get_stamp(req_file: str) -> Dict[str, str]:
+    '''
+    Fingerprints of a requirements file and of the installed libraries, for this interpreter
+    '''
+    with open(req_file, 'rb') as f:
+        requirements = sorted(line.strip() for line in f.read().decode().splitlines() if line.strip())
+    interpreter = f'{sys.executable} {sys.version}'
+    return {
+        'requirements': hashlib.sha256('\n'.join([interpreter, *requirements]).encode()).hexdigest(),
+        'installed': hashlib.sha256('\n'.join([interpreter, *get_libs()]).encode()).hexdigest(),
+    }
+
+def is_stamp_current(req_file: str) -> bool:
+    '''
+    Check if the requirements file and the installed libraries did not change since the last install
+    '''
+    try:
+        with open(os.path.join(os.path.dirname(req_file), LIB_STAMP_FILE)) as f:
+            return json.load(f) == get_stamp(req_file)
+    except (OSError, ValueError):
+        return False
+
+def write_stamp(req_file: str) -> None:
+    with open(os.path.join(os.path.dirname(req_file), LIB_STAMP_FILE), 'w') as f:
+        json.dump(get_stamp(req_file), f)
 
 def install_on_startup(req_file: str = 'cloud_requirements.txt') -> None:
     '''
     Install all libraries in the cloud_requirements.txt file during startup
+    Nothing runs when neither the file nor the installed libraries changed since the last time
     '''
 
     # verify if the file exists
     if not os.path.exists(req_file):
         # raise Exception('cloud_requirements.txt file not found')
         print('cloud_requirements.txt file not found, start with default requirements')
-        os.system(f'cp requirements.txt {req_file}')
+        shutil.copyfile('requirements.txt', req_file)
+
+    if is_stamp_current(req_file):
+        print('Libraries are up to date with', req_file)
+        return
 
     libs = []
     with open(req_file, 'r') as f:
-        libs = [lib.strip() for lib in f.readlines()]
-    install_libs(libs)
+        libs = [lib.strip() for lib in f.readlines() if lib.strip() and not lib.startswith('#')]
+    install_libs(libs, req_file)
+    write_stamp(req_file)
 
 if __name__ == '__main__':
     print(get_libs())
\ No newline at end of file
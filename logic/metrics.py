@@ -0,0 +1,276 @@
+import bisect
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
+from .cache import LRUCache
+from .invoke import prepared_cache, result_cache
+from .scheduler import scheduler
+from config import FUNC_STORE, STORE_SIZE_TTL
+
+'''
+This file contains the metrics of the API server, exposed in the Prometheus text format.
+Recording a value is a dict update under a lock, so instrumentation can stay on in production
+'''
+
+# Label of invocations rejected before their function was found and authorized
+REJECTED_FUNCTION = '(rejected)'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# directory -> total size of its files, measured at most once per STORE_SIZE_TTL
+dir_sizes = LRUCache(16, ttl=STORE_SIZE_TTL)
+
+
+def format_labels(names: Sequence[str], values: Sequence[Any]) -> str:
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    '''
+    A named metric with one value per combination of labels
+    '''
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[Tuple[str, ...], Any] = {}
+        self.lock = Lock()
+
+    def key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[Any, ...], float]]:
+        '''
+        All (name, label names, label values, value) of the metric
+        '''
+        with self.lock:
+            return [(self.name, self.labels, key, value) for key, value in self.values.items()]
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for name, label_names, label_values, value in self.samples():
+            lines.append(f'{name}{format_labels(label_names, label_values)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    '''
+    A value that only goes up
+    '''
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    '''
+    A value that goes up and down.
+    When collect is given, the values are read from it on every scrape instead
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 collect: Callable[[], Dict[Tuple[str, ...], float]] = None) -> None:
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def set(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_max(self, value: float, **labels) -> None:
+        '''
+        Keep the highest value seen so far
+        '''
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = max(self.values.get(key, value), value)
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[Any, ...], float]]:
+        if self.collect is None:
+            return super().samples()
+        return [(self.name, self.labels, key, value) for key, value in self.collect().items()]
+
+
+class Histogram(Metric):
+    '''
+    Count observations in cumulative buckets, along with their sum
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket, +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        '''
+        Observe how long the body of a with statement takes
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[Any, ...], float]]:
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+
+        samples = []
+        label_names = self.labels + ('le',)
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                samples.append((f'{self.name}_bucket', label_names, key + (format_value(bound),), total))
+            samples.append((f'{self.name}_sum', self.labels, key, counts[-1]))
+            samples.append((f'{self.name}_count', self.labels, key, total))
+        return samples
+
+
+class Registry:
+    '''
+    The set of metrics exposed together
+    '''
+
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # one broken collector must not hide every other metric
+                print('Could not collect metric:', metric.name, e)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+INVOCATION_PHASE = registry.register(Histogram(
+    'customlambda_invocation_phase_seconds',
+    'Time spent in each phase of an invocation: exists, auth, prepare, spawn, run, decode',
+    ('function', 'phase')))
+INVOCATIONS = registry.register(Counter(
+    'customlambda_invocations_total', 'Invocations requested', ('function',)))
+INVOCATION_FAILURES = registry.register(Counter(
+    'customlambda_invocation_failures_total',
+    'Invocations that did not return a value, including timeouts and memory kills', ('function',)))
+INVOCATION_TIMEOUTS = registry.register(Counter(
+    'customlambda_invocation_timeouts_total', 'Invocations killed on the time limit', ('function',)))
+INVOCATION_MEMORY_KILLS = registry.register(Counter(
+    'customlambda_invocation_memory_kills_total', 'Invocations killed on the memory limit', ('function',)))
+CACHE_HITS = registry.register(Counter(
+    'customlambda_cache_hits_total', 'Lookups served from an invocation cache', ('function', 'cache')))
+CACHE_MISSES = registry.register(Counter(
+    'customlambda_cache_misses_total', 'Lookups an invocation cache could not serve', ('function', 'cache')))
+INVOCATION_PEAK_RSS = registry.register(Gauge(
+    'customlambda_invocation_peak_rss_bytes', 'Highest memory usage seen in a process running the function',
+    ('function',)))
+
+
+def observe_invocation(function: str, output: Dict[str, Any]) -> None:
+    '''
+    Record the outcome of an invocation that reached a process
+    '''
+    for phase, seconds in output.get('timings', {}).items():
+        INVOCATION_PHASE.observe(seconds, function=function, phase=phase)
+    if output.get('peak_rss'):
+        INVOCATION_PEAK_RSS.set_max(output['peak_rss'], function=function)
+
+    if output.get('limit') == 'time':
+        INVOCATION_TIMEOUTS.inc(function=function)
+    elif output.get('limit') == 'memory':
+        INVOCATION_MEMORY_KILLS.inc(function=function)
+    if output['status'] != 'success' or output.get('error'):
+        INVOCATION_FAILURES.inc(function=function)
+
+
+def observe_cache(function: str, cache: str, hit: bool) -> None:
+    '''
+    Record 1 lookup of an invocation cache, prepared or results
+    '''
+    (CACHE_HITS if hit else CACHE_MISSES).inc(function=function, cache=cache)
+
+
+def get_running_invocations() -> Dict[Tuple[str, ...], float]:
+    with scheduler.lock:
+        return {(function,): count for function, count in scheduler.running_by_func.items()}
+
+
+def get_cache_hit_rates() -> Dict[Tuple[str, ...], float]:
+    return {
+        ('prepared',): prepared_cache.stats()['hit_rate'],
+        ('results',): result_cache.stats()['hit_rate'],
+    }
+
+
+def get_dir_size(target_dir: str) -> Dict[Tuple[str, ...], float]:
+    '''
+    Total size in bytes of the files in a directory, cached so a scrape does not walk the directory every time
+    '''
+    total = dir_sizes.get(target_dir)
+    if total is None:
+        total = 0
+        for root, _, files in os.walk(target_dir):
+            for file in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, file))
+                except OSError:
+                    pass
+        dir_sizes.put(target_dir, total)
+    return {(): total}
+
+
+registry.register(Gauge(
+    'customlambda_running_invocations', 'Invocations running right now',
+    ('function',), collect=get_running_invocations))
+registry.register(Gauge(
+    'customlambda_queued_invocations', 'Invocations waiting for a free slot',
+    collect=lambda: {(): scheduler.stats()['queued']}))
+registry.register(Gauge(
+    'customlambda_store_size_bytes', 'Size of the function store on disk',
+    collect=lambda: get_dir_size(FUNC_STORE)))
+registry.register(Gauge(
+    'customlambda_cache_hit_ratio', 'Share of lookups served from an invocation cache, over every function',
+    ('cache',), collect=get_cache_hit_rates))
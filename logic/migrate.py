@@ -0,0 +1,75 @@
+import os
+import sys
+from typing import Dict
+from utils import get_py_files
+from config import FUNC_STORE, LATEST_ALIAS
+from .catalog import Catalog
+from .signature import get_store_file_funcs
+from .store import get_func_target, is_legacy_file, read_aliases, write_aliases, write_version
+
+'''
+This file moves functions stored by older versions to the versioned layout:
+the functions of numbered store files (0.py, 1.py...),
+and functions stored alone without versions (<user>/<function>.py).
+Run it while the server is down: python -m logic.migrate [store dir]
+'''
+
+# suffix of a numbered store file once its functions are moved out
+MIGRATED_SUFFIX = '.migrated'
+
+
+def migrate_store(target_dir: str = FUNC_STORE) -> Dict[str, int]:
+    '''
+    Store every function of an older layout as the first version of its target, byte for byte,
+    then rename the numbered files, remove the unversioned ones and rebuild the catalog.
+    A function defined twice by 1 user keeps its last definition, like lookups did,
+    a function that already has versions keeps its aliases
+    '''
+    py_files = get_py_files(target_dir)
+    legacy_files = sorted((file for file in py_files if is_legacy_file(file)),
+                          key=lambda file: int(file[:-len('.py')]))
+    single_files = [file for file in py_files if len(file.split('/')) == 2]
+    stats = {'files': 0, 'functions': 0, 'skipped': 0}
+    latest: Dict[str, str] = {}  # target -> version to alias as latest
+
+    for file in legacy_files + single_files:
+        file_path = os.path.join(target_dir, file)
+        funcs = get_store_file_funcs(target_dir, file[:-len('.py')])
+        with open(file_path, 'rb') as f:
+            data = f.read()
+
+        moved = True
+        for func in funcs:
+            target_file = get_func_target(func['author'], func['function'])
+            if target_file is None:
+                print(f'Skipped {func["function"]} in {file}: it has no author')
+                stats['skipped'] += 1
+                moved = False
+                continue
+
+            block = data[func['start_offset']:func['end_offset']]
+            if not block.endswith(b'\n'):
+                block += b'\n'
+            latest[target_file] = write_version(target_dir, target_file, block.decode())
+            stats['functions'] += 1
+
+        if is_legacy_file(file):
+            # keep the original around instead of deleting it
+            os.replace(file_path, file_path + MIGRATED_SUFFIX)
+        elif moved:
+            os.remove(file_path)
+        stats['files'] += 1
+
+    for target_file, version in latest.items():
+        if LATEST_ALIAS not in read_aliases(target_dir, target_file):
+            write_aliases(target_dir, target_file, {LATEST_ALIAS: version})
+
+    Catalog(target_dir).rebuild()
+    return stats
+
+
+if __name__ == '__main__':
+    target_dir = sys.argv[1] if len(sys.argv) > 1 else FUNC_STORE
+    stats = migrate_store(target_dir)
+    print(f'Migrated {stats["functions"]} functions from {stats["files"]} store files in {target_dir}, '
+          f'skipped {stats["skipped"]}')
@@ -0,0 +1,251 @@
+import atexit
+import os
+import pickle
+import time
+import subprocess
+import psutil
+from threading import Condition, Lock
+from typing import Any, Callable, Dict, List, Tuple, Union
+from . import zygote
+from .transport import read_payload, write_frame
+from .supervisor import get_supervisor, memory_limit_env
+from config import MAX_STDOUT, MEMORY_LIMIT, POOL_SIZE, POOL_WARM_WORKERS, POOL_MAX_CALLS, POOL_MAX_RSS
+
+'''
+This file contains a pool of warm worker processes.
+Workers are started once and reused between invocations,
+so the interpreter startup cost is only paid when the pool grows
+'''
+
+
+class Worker:
+    '''
+    A pre-started python process that runs invocation requests over a pipe
+    '''
+
+    def __init__(self, environment: Union[str, None] = None, owner: Union[Tuple[str, str], None] = None) -> None:
+        env = {'INVOKEE_MEMORY_LIMIT': memory_limit_env(MEMORY_LIMIT)}
+        if environment is not None:
+            # the libraries of the environment come before the ones of the server
+            env['PYTHONPATH'] = os.pathsep.join([os.getcwd(), environment])
+        self.environment = environment
+        # user code runs in the interpreter of the worker and can patch it, so it never serves another owner.
+        # An owner is an (author, creds) pair, anyone can upload under an author name but not with its creds
+        self.owner = owner
+        # the zygote preloads the server libraries, so only workers without an environment fork from it
+        self.process = zygote.popen(['-m', 'logic.worker'], env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL) if environment is None else None
+        if self.process is None:
+            self.process = subprocess.Popen(['python3', '-m', 'logic.worker'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=subprocess.DEVNULL, cwd=os.getcwd(), env={**os.environ, **env})
+        self.calls = 0
+
+    def claim(self, owner: Union[Tuple[str, str], None]) -> None:
+        '''
+        Reserve the worker for an owner, raise if it already ran code of another one
+        '''
+        if self.calls and self.owner != owner:
+            raise RuntimeError('Worker already ran functions of another owner')
+        self.owner = owner
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def rss(self) -> int:
+        '''
+        Current memory usage of the worker in bytes
+        '''
+        try:
+            return psutil.Process(self.process.pid).memory_info().rss
+        except psutil.Error:
+            return 0
+
+    def call(self, request: Dict[str, Any], time_limit: int, memory_limit: int,
+             on_output: Callable[[str, str], None] = None, usage: Dict[str, float] = None) -> Dict[str, Any]:
+        '''
+        Send 1 request to the worker and wait for its response.
+        The worker is killed if it exceeds the time or memory limit
+        usage receives the seconds spent running and decoding, and the peak memory of the worker
+        '''
+        usage = {} if usage is None else usage
+        self.calls += 1
+        watch = get_supervisor().watch(self.process, time_limit, memory_limit)
+        start = time.perf_counter()
+        decode = 0.0
+        try:
+            write_frame(self.process.stdin, request)
+            # The supervisor kills the worker on a limit, which closes the pipe
+            while True:
+                payload = read_payload(self.process.stdout)
+                decode_start = time.perf_counter()
+                frame = pickle.loads(payload)
+                decode += time.perf_counter() - decode_start
+                # streamed (stream name, line) frames come before the response
+                if not isinstance(frame, tuple):
+                    usage['run'] = time.perf_counter() - start - decode
+                    usage['decode'] = decode
+                    return frame
+                if on_output is not None:
+                    on_output(*frame)
+        except (EOFError, OSError):
+            self.stop()
+            reason = get_supervisor().unwatch(watch)
+            if reason == 'time':
+                raise TimeoutError('Function exceeded the time limit')
+            if reason == 'memory':
+                raise MemoryError('Function exceeded the memory limit')
+            raise
+        finally:
+            get_supervisor().unwatch(watch)
+            usage['peak_rss'] = watch.peak_rss
+
+    def stop(self) -> None:
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+
+
+class WorkerPool:
+    '''
+    A bounded pool of warm workers.
+    A worker only runs functions of the owner and environment it was started with,
+    an idle worker of another owner or environment is stopped to make room when the pool is full
+    Workers are recycled after max_calls invocations or when their memory exceeds max_rss
+    '''
+
+    def __init__(self, size: int = POOL_SIZE, warm: int = POOL_WARM_WORKERS,
+                 max_calls: int = POOL_MAX_CALLS, max_rss: int = POOL_MAX_RSS) -> None:
+        self.size = size
+        self.max_calls = max_calls
+        self.max_rss = max_rss
+        self.idle: List[Worker] = []
+        self.total = 0
+        self.cond = Condition()
+
+        # Pay the cold start before the first request comes in
+        for _ in range(min(warm, size)):
+            self.idle.append(Worker())
+            self.total += 1
+
+    def acquire(self, environment: Union[str, None] = None, owner: Union[Tuple[str, str], None] = None) -> Worker:
+        '''
+        Get an idle worker of an owner and environment, start a new one if the pool can still grow
+        '''
+        evicted = None
+        with self.cond:
+            while not self.idle and self.total >= self.size:
+                self.cond.wait()
+
+            for i in range(len(self.idle) - 1, -1, -1):
+                worker = self.idle[i]
+                # a warm worker that never ran anything is free to take
+                if worker.environment == environment and (worker.owner == owner or worker.calls == 0):
+                    worker.claim(owner)
+                    return self.idle.pop(i)
+            if self.total >= self.size:
+                # the least recently used worker makes room
+                evicted = self.idle.pop(0)
+            else:
+                self.total += 1
+
+        if evicted is not None:
+            evicted.stop()
+        try:
+            return Worker(environment, owner)
+        except Exception:
+            with self.cond:
+                self.total -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, worker: Worker) -> None:
+        '''
+        Give a worker back to the pool, or retire it if it should be recycled
+        '''
+        retire = (not worker.alive() or worker.calls >= self.max_calls
+                  or worker.rss() > self.max_rss)
+        if retire:
+            worker.stop()
+
+        with self.cond:
+            if retire:
+                self.total -= 1
+            else:
+                self.idle.append(worker)
+            self.cond.notify()
+
+    def invoke(self, code: bytes, func_name: str, params: list, time_limit: int = 60, memory_limit: int = 1000000000,
+               batch: List[list] = None, item_timeout: float = None,
+               on_output: Callable[[str, str], None] = None, environment: Union[str, None] = None,
+               owner: Union[Tuple[str, str], None] = None) -> Dict[str, Any]:
+        '''
+        Run a function on a warm worker with some limits on top
+        When batch is given, params is ignored and every item of the batch runs on the same worker
+        When on_output is given, it receives ('stdout' | 'stderr', line) while the function runs
+        environment is the site-packages directory of the function, None for the server libraries
+        owner is the (author, creds) of the function, its worker never runs code of other owners
+        '''
+        output = {
+            'status': 'error',
+            'message': 'Function did not run successfully',
+            'return_value': None,
+            'stdout': '',
+            'stderr': ''
+        }
+        request = {
+            'code': code,
+            'func_name': func_name,
+            'max_stdout': MAX_STDOUT,
+        }
+        if batch is None:
+            request['params'] = params
+            request['stream'] = on_output is not None
+        else:
+            request['items'] = batch
+            request['item_timeout'] = item_timeout
+
+        usage = {}
+        start = time.perf_counter()
+        worker = self.acquire(environment, owner)
+        try:
+            usage['spawn'] = time.perf_counter() - start
+            output.update(worker.call(request, time_limit, memory_limit, on_output, usage))
+        except TimeoutError as e:
+            output['message'] = str(e)
+            output['limit'] = 'time'
+        except MemoryError as e:
+            output['message'] = str(e)
+            output['limit'] = 'memory'
+        except Exception as e:
+            worker.stop()
+            output['message'] = 'Unexpected error occurred'
+            print('Unexpected error:', e)
+        finally:
+            self.release(worker)
+
+        output['peak_rss'] = usage.pop('peak_rss', 0)
+        output['timings'] = usage
+        return output
+
+    def shutdown(self) -> None:
+        with self.cond:
+            workers, self.idle = self.idle, []
+            self.total -= len(workers)
+        for worker in workers:
+            worker.stop()
+
+
+_pool: Union[WorkerPool, None] = None
+_pool_lock = Lock()
+
+
+def get_pool() -> WorkerPool:
+    '''
+    Get the shared worker pool, start it on first use
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool()
+            atexit.register(_pool.shutdown)
+    return _pool
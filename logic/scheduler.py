@@ -0,0 +1,283 @@
+import time
+from collections import defaultdict, deque
+from threading import Event, Lock
+from typing import Any, Callable, Deque, Dict
+from config import (INVOKE_CONCURRENCY, INVOKE_QUEUE_SIZE, INVOKE_MAX_WAIT, USER_CONCURRENCY,
+                    FUNC_CONCURRENCY, USER_RATE_LIMIT, USER_RATE_BURST, AUTH_FAILURE_RATE, AUTH_FAILURE_BURST)
+
+'''
+This file contains the admission control in front of function invocations.
+Invocations are limited globally, per user and per function, users are rate limited,
+and the ones that have to wait are served round robin across users.
+Clients that keep failing to authenticate are limited before their passwords are checked
+'''
+
+
+class Rejected(Exception):
+    '''
+    An invocation that can not be admitted right now
+    '''
+
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    '''
+    Allow rate requests per second on average, with bursts up to burst requests
+    '''
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        '''
+        Take 1 token, return 0 on success or the seconds to wait for the next token
+        '''
+        wait = self.wait()
+        if not wait:
+            self.tokens -= 1
+        return wait
+
+    def wait(self) -> float:
+        '''
+        Seconds to wait for the next token, 0 if there is one, without taking it
+        '''
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now: float) -> bool:
+        '''
+        Whether the bucket refilled up to burst, then it is the same as a new one
+        '''
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class Ticket:
+    '''
+    A place in the scheduler, granted once the invocation is allowed to run
+    '''
+
+    def __init__(self, user: str, func: str) -> None:
+        self.user = user
+        self.func = func
+        self.enqueued_at = time.monotonic()
+        self.granted = Event()
+
+
+class Scheduler:
+    '''
+    Admit invocations under global, per user and per function concurrency limits
+    '''
+
+    def __init__(self, max_running: int = INVOKE_CONCURRENCY, queue_size: int = INVOKE_QUEUE_SIZE,
+                 user_limit: int = USER_CONCURRENCY, func_limit: int = FUNC_CONCURRENCY,
+                 rate: float = USER_RATE_LIMIT, burst: int = USER_RATE_BURST,
+                 failure_rate: float = AUTH_FAILURE_RATE, failure_burst: int = AUTH_FAILURE_BURST) -> None:
+        self.max_running = max_running
+        self.queue_size = queue_size
+        self.user_limit = user_limit
+        self.func_limit = func_limit
+        self.rate = rate
+        self.burst = burst
+        self.failure_rate = failure_rate
+        self.failure_burst = failure_burst
+
+        self.lock = Lock()
+        self.running = 0
+        self.running_by_user: Dict[str, int] = defaultdict(int)
+        self.running_by_func: Dict[str, int] = defaultdict(int)
+        self.queues: Dict[str, Deque[Ticket]] = {}  # waiting tickets of each user
+        self.turns: Deque[str] = deque()  # users with waiting tickets, round robin
+        self.queued = 0
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.failures: Dict[str, TokenBucket] = {}  # failed authentications of each client
+        self.pruned_at = time.monotonic()
+
+        # observability
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def enqueue(self, user: str, func: str) -> Ticket:
+        '''
+        Ask to run an invocation, never blocks.
+        The ticket is granted right away when possible, otherwise it waits in the queue.
+        Raise Rejected when the user is rate limited or the queue is full
+        '''
+        ticket = Ticket(user, func)
+        with self.lock:
+            self.prune_buckets()
+            bucket = self.buckets.setdefault(user, TokenBucket(self.rate, self.burst))
+            wait = bucket.take()
+            if wait > 0:
+                self.rejected += 1
+                raise Rejected('Rate limit exceeded', wait)
+
+            if not self.queued and self.can_run(ticket):
+                self.grant(ticket)
+                return ticket
+
+            if self.queued >= self.queue_size:
+                self.rejected += 1
+                raise Rejected('Too many invocations waiting, try again later', self.retry_hint())
+
+            if user not in self.queues:
+                self.queues[user] = deque()
+                self.turns.append(user)
+            self.queues[user].append(ticket)
+            self.queued += 1
+            self.dispatch()
+        return ticket
+
+    def check_client(self, client: str) -> None:
+        '''
+        Raise Rejected when a client failed to authenticate too often,
+        called before its password is checked so bcrypt never runs for it
+        '''
+        with self.lock:
+            bucket = self.failures.get(client)
+            wait = bucket.wait() if bucket is not None else 0
+            if wait > 0:
+                self.rejected += 1
+                raise Rejected('Too many failed authentications', wait)
+
+    def fail_client(self, client: str) -> None:
+        '''
+        Charge a failed authentication to a client
+        '''
+        with self.lock:
+            self.prune_buckets()
+            self.failures.setdefault(client, TokenBucket(self.failure_rate, self.failure_burst)).take()
+
+    def wait(self, ticket: Ticket, timeout: float = INVOKE_MAX_WAIT) -> None:
+        '''
+        Block until the ticket is granted, raise Rejected if it takes too long
+        '''
+        if ticket.granted.wait(timeout):
+            return
+
+        with self.lock:
+            if ticket.granted.is_set():
+                return
+            queue = self.queues.get(ticket.user)
+            if queue is not None and ticket in queue:
+                queue.remove(ticket)
+                self.queued -= 1
+                if not queue:
+                    del self.queues[ticket.user]
+                    self.turns.remove(ticket.user)
+            self.rejected += 1
+        raise Rejected('Timed out waiting for a free slot', self.retry_hint())
+
+    def release(self, ticket: Ticket) -> None:
+        '''
+        Free the slot of a finished invocation and admit the next ones
+        '''
+        with self.lock:
+            self.running -= 1
+            self.running_by_user[ticket.user] -= 1
+            if not self.running_by_user[ticket.user]:
+                del self.running_by_user[ticket.user]
+            self.running_by_func[ticket.func] -= 1
+            if not self.running_by_func[ticket.func]:
+                del self.running_by_func[ticket.func]
+            self.dispatch()
+
+    def run(self, ticket: Ticket, fn: Callable, *args, **kwargs) -> Any:
+        '''
+        Wait for the ticket, then run fn in its slot
+        '''
+        self.wait(ticket)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.release(ticket)
+
+    def prune_buckets(self) -> None:
+        '''
+        Drop the buckets of users and clients idle long enough for them to refill, at most once per refill time,
+        so buckets are only kept for recently active ones. The lock must be held by the caller
+        '''
+        now = time.monotonic()
+        if now - self.pruned_at < self.burst / self.rate:
+            return
+        self.pruned_at = now
+        for buckets in (self.buckets, self.failures):
+            for key in [key for key, bucket in buckets.items() if bucket.is_full(now)]:
+                del buckets[key]
+
+    def can_run(self, ticket: Ticket) -> bool:
+        return (self.running < self.max_running
+                and self.running_by_user[ticket.user] < self.user_limit
+                and self.running_by_func[ticket.func] < self.func_limit)
+
+    def grant(self, ticket: Ticket) -> None:
+        '''
+        Give a slot to a ticket, the lock must be held by the caller
+        '''
+        self.running += 1
+        self.running_by_user[ticket.user] += 1
+        self.running_by_func[ticket.func] += 1
+
+        waited = time.monotonic() - ticket.enqueued_at
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        ticket.granted.set()
+
+    def dispatch(self) -> None:
+        '''
+        Grant waiting tickets, taking turns between users.
+        The lock must be held by the caller
+        '''
+        skipped = 0
+        while self.turns and skipped < len(self.turns) and self.running < self.max_running:
+            user = self.turns.popleft()
+            queue = self.queues[user]
+            if not self.can_run(queue[0]):
+                self.turns.append(user)
+                skipped += 1
+                continue
+
+            self.grant(queue.popleft())
+            self.queued -= 1
+            skipped = 0
+            if queue:
+                self.turns.append(user)
+            else:
+                del self.queues[user]
+
+    def retry_hint(self) -> float:
+        '''
+        Rough number of seconds before a slot frees up
+        '''
+        average_wait = self.total_wait / self.admitted if self.admitted else 0.0
+        return max(average_wait, 1.0)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'running': self.running,
+                'queued': self.queued,
+                'max_running': self.max_running,
+                'queue_size': self.queue_size,
+                'running_by_user': dict(self.running_by_user),
+                'queued_by_user': {user: len(queue) for user, queue in self.queues.items()},
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'average_wait': self.total_wait / self.admitted if self.admitted else 0.0,
+                'max_wait': self.max_wait,
+            }
+
+
+scheduler = Scheduler()
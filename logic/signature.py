@@ -1,6 +1,10 @@
-from config import FUNC_DELIMITER
-from typing import List, Tuple, Union, Literal
-from .auth import hash_password, check_password
+from config import FUNC_DELIMITER, PARSED_STORE_CACHE_SIZE
+from typing import Any, Dict, List, Tuple, Union, Literal
+import ast
+import hashlib
+import os
+from .auth import hash_password
+from .cache import LRUCache
 '''
 This file accounts for function signature verification.
 Signature is used to distinguish between different functions in the same file,
@@ -16,11 +20,20 @@ def get_return_signature() -> str:
     return f'#function-return: {FUNC_DELIMITER}'
 
 
-def get_start_signature(func_name: str, params: List[str]) -> str:
+def get_start_signature(func_name: str, params: List[str], deterministic: bool = False) -> str:
     '''
     Return a start signature for a saved function
+    Deterministic functions are marked so their results can be memoized
     '''
-    return f'#start-function: {FUNC_DELIMITER}, function: {func_name}, params: {params}\n'
+    options = ', deterministic: True' if deterministic else ''
+    return f'#start-function: {FUNC_DELIMITER}, function: {func_name}{options}, params: {params}\n'
+
+
+def is_deterministic(start_signature: str) -> bool:
+    '''
+    Check if a start signature marks its function as deterministic
+    '''
+    return ', deterministic: True, params: ' in start_signature
 
 
 def get_end_signature(func_name: str) -> str:
@@ -30,96 +43,99 @@ def get_end_signature(func_name: str) -> str:
     return f'#end-function: {FUNC_DELIMITER}, function: {func_name}\n'
 
 
-def get_author_signature(name: str, password: str) -> str:
+def get_author_signature(name: str, password: str, creds: Union[str, None] = None) -> str:
     '''
     Add author name and password of an invokee function
+    creds reuses a hash of the same password, so every function of a user shares it
     '''
-    return f'#author: {name}, creds: {hash_password(password)}\n'
+    return f'#author: {name}, creds: {creds or hash_password(password)}\n'
 
 
-def locate_function(func_name: str, target_dir: str, target_file: str) -> Union[Tuple[int, int], None]:
+def split_func_block(lines: List[str]) -> Tuple[str, str]:
     '''
-    Locate the start & end of a function in a python file
+    Split the lines of a stored function, signatures included,
+    into its start signature and its source
     '''
-    start = None
-    end = None
-    with open(f'{target_dir}/{target_file}.py', 'r') as f:
-        lines = f.readlines()
-        for i, line in enumerate(lines):
-            if f'#start-function: {FUNC_DELIMITER}, function: {func_name}' in line:
-                start = i
-            if f'#end-function: {FUNC_DELIMITER}, function: {func_name}' in line:
-                end = i + 1  # include the end line
-
-    if start is None or end is None:
-        return None, None
+    # skip start and author signatures
+    body = lines[2:-1]
+    # end signature can share a line with the last line of code
+    last_line = lines[-1].split(f'#end-function: {FUNC_DELIMITER}')[0]
+    return lines[0], ''.join(body) + last_line
 
-    return start, end
 
-
-def get_all_func_names_by_signature(target_dir: str, target_file: str) -> Union[List[str], None]:
+def parse_start_signature(line: str) -> Tuple[str, List[str], bool]:
     '''
-    Get all func names from a python file by signature
+    Get the name, params and deterministic flag from a start signature
     '''
-    func_names = []
-    with open(f'{target_dir}/{target_file}.py', 'r') as f:
-        lines = f.readlines()
-        for line in lines:
-            if f'#start-function: {FUNC_DELIMITER}, function: ' in line:
-                func_name = line.split(',')[1].split('function: ')[1]
-                func_names.append(func_name)
-
-    if len(func_names) == 0:
-        return None
+    func_name = line.split(',')[1].split('function: ')[1].strip()
+    params = ast.literal_eval(line.split('params: ')[1].strip())
+    return func_name, params, is_deterministic(line)
 
-    return func_names
 
-def get_func_names_by_author(target_dir: str, target_file: str, author: str, password: str) -> Union[List[str], None]:
+def parse_store_file(target_dir: str, target_file: str) -> List[Dict[str, Any]]:
     '''
-    Get all func names from 1 author in current py file
-    Required user to have valid auth
+    Read a store file once and get every function in it, in order.
+    Each function comes with its params, author, creds, line range,
+    byte range and the hash of its source
     '''
-    func_names = set()
-    with open(f'{target_dir}/{target_file}.py', 'r') as f:
-        lines = f.readlines()
-        for line in lines:
-            # check if the line is a function signature
-            if not f'#start-function: {FUNC_DELIMITER}, function: ' in line:
+    start_marker = f'#start-function: {FUNC_DELIMITER}, function: '
+    funcs = []
+    current = None
+    offset = 0
+    with open(f'{target_dir}/{target_file}.py', 'rb') as f:
+        for i, raw_line in enumerate(f):
+            line = raw_line.decode()
+            if current is None and start_marker in line:
+                func_name, params, deterministic = parse_start_signature(line)
+                current = {
+                    'function': func_name,
+                    'params': params,
+                    'deterministic': deterministic,
+                    'author': None,
+                    'creds': None,
+                    'start_line': i,
+                    'start_offset': offset,
+                    'lines': [],
+                }
+            offset += len(raw_line)
+            if current is None:
                 continue
 
-            func_name = line.split(',')[1].split('function: ')[1]
-            
-            # then need to check if the author is correct
-            verified_author = verify_author(author, password, func_name, target_dir, target_file)
-            
-            if verified_author is None or not verified_author:
-                continue
+            current['lines'].append(line)
+            if i == current['start_line'] + 1 and line.startswith('#author: '):
+                author, creds = line[len('#author: '):].rsplit(', creds: ', 1)
+                current['author'], current['creds'] = author, creds.strip()
 
-            func_names.add(func_name)
+            end_signature = f'#end-function: {FUNC_DELIMITER}, function: {current["function"]}'
+            if i > current['start_line'] and line.rstrip('\n').endswith(end_signature):
+                _, source = split_func_block(current.pop('lines'))
+                current['end_line'] = i + 1  # include the end line
+                current['end_offset'] = offset
+                current['content_hash'] = hashlib.sha256(source.encode()).hexdigest()
+                funcs.append(current)
+                current = None
 
-    if len(func_names) == 0:
-        return None
+    return funcs
 
-    return list(func_names)
-    
 
-def get_params_by_signature(func_name: str, target_dir: str, target_file: str) -> Union[List[str], None]:
-    '''
-    Get all params from a saved function using signature
-    '''
+# path of a store file -> (mtime, size, parsed functions)
+parsed_store_cache = LRUCache(PARSED_STORE_CACHE_SIZE)
 
-    params = []
-    with open(f'{target_dir}/{target_file}.py', 'r') as f:
-        lines = f.readlines()
-        for line in lines:
-            if f'#start-function: {FUNC_DELIMITER}, function: {func_name}' in line:
-                params = eval(line.split('params: ')[1])
-                break
 
-    if len(params) == 0:
-        return None
+def get_store_file_funcs(target_dir: str, target_file: str) -> List[Dict[str, Any]]:
+    '''
+    Get the parsed functions of a store file.
+    A file is only read again once its mtime or size changes, the result must not be modified
+    '''
+    file_path = f'{target_dir}/{target_file}.py'
+    stat = os.stat(file_path)
+    cached = parsed_store_cache.get(file_path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
 
-    return params
+    funcs = parse_store_file(target_dir, target_file)
+    parsed_store_cache.put(file_path, (stat.st_mtime_ns, stat.st_size, funcs))
+    return funcs
 
 
 def add_signature_to_invokee(invokee: str) -> Union[str, None]:
@@ -166,38 +182,3 @@ def insert_func_to_invokee(src: str, invokee: str) -> Union[str, None]:
         file.writelines(lines[end_index:])
         file.truncate()
     return invokee
-
-
-def verify_author(author: str, password: str, func_name: str, target_dir: str, target_file: str) -> Union[bool, None]:
-    '''
-    Check if the author and password are correct for a specific function.
-    True - User is authorized with the correct function.
-    False - User is not authorized with the correct function.
-    None - User does not exist.
-    '''
-    try:
-        with open(f'{target_dir}/{target_file}.py', 'r') as file:
-            lines = file.readlines()
-    
-        for i, line in enumerate(lines):
-            # Check if the author exists
-            if f'#author: {author}, creds: ' not in line:
-                continue
-    
-            hashed_password = line.split('creds: ')[1].strip()
-    
-            # Check if the function is correct
-            if i <= 0 or f'#start-function: {FUNC_DELIMITER}, function: {func_name}' not in lines[i - 1]:
-                continue
-
-            return check_password(password, hashed_password)
-        
-        # Author or function not found
-        return None
-    
-    except FileNotFoundError:
-        print(f"File {target_file}.py not found in directory {target_dir}.")
-        return None
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return None
\ No newline at end of file
@@ -0,0 +1,271 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+from contextlib import contextmanager
+from threading import Lock
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Union
+from urllib.parse import quote
+from weakref import WeakValueDictionary
+from config import ALIASES_FILE, REQUIREMENTS_FILE, LATEST_ALIAS, PARSED_STORE_CACHE_SIZE
+from .cache import LRUCache
+
+'''
+This file contains the layout of a function store.
+Every function has a directory in the directory of its author: <store>/<user>/<function>/.
+Each upload adds an immutable version file named after the hash of its content,
+<store>/<user>/<function>/<version>.py, and aliases.json maps names like latest or prod
+to versions. Deploying or rolling back only rewrites the aliases,
+and users never write to the same file. requirements.json maps versions to the libraries of their environment.
+Store files of older versions are numbered (<store>/0.py, <store>/1.py...) and hold many functions,
+or hold 1 function without versions (<store>/<user>/<function>.py).
+They can still be read until they are migrated with python -m logic.migrate.
+Writers hold the lock of the function they change and replace files atomically,
+so readers see either the old or the new file, never a partial one
+'''
+
+LEGACY_FILE = re.compile(r'\d+\.py')
+VERSION = re.compile(r'[0-9a-f]{16}')
+ALIAS = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+# absolute path of a store file -> lock of its writers, dropped once no writer holds it
+_file_locks: 'WeakValueDictionary[str, Lock]' = WeakValueDictionary()
+_file_locks_lock = Lock()
+
+# path of an aliases or requirements file -> (mtime, size, content)
+aliases_cache = LRUCache(PARSED_STORE_CACHE_SIZE)
+requirements_cache = LRUCache(PARSED_STORE_CACHE_SIZE)
+
+
+def get_user_dir(author: str) -> Union[str, None]:
+    '''
+    Name of the directory of a user, safe to use in a path
+    '''
+    if not author:
+        return None
+    # quote leaves dots alone, escape them so '.' and '..' stay plain names
+    return quote(author, safe='').replace('.', '%2E')
+
+
+def get_func_target(author: str, func_name: str) -> Union[str, None]:
+    '''
+    Store target of a function of a user, relative to the store and without extension
+    '''
+    user_dir = get_user_dir(author)
+    if user_dir is None:
+        return None
+    return f'{user_dir}/{func_name}'
+
+
+def get_target_path(target_dir: str, target_file: str) -> str:
+    return os.path.join(target_dir, f'{target_file}.py')
+
+
+def is_legacy_file(file: str) -> bool:
+    '''
+    Check if a store file, relative to the store, is a numbered file shared by many functions
+    '''
+    return LEGACY_FILE.fullmatch(file) is not None
+
+
+@contextmanager
+def lock_file(target_dir: str, target_file: str) -> Iterator[None]:
+    '''
+    Hold the write lock of 1 store file, writers of other files are not blocked
+    '''
+    file_path = os.path.abspath(get_target_path(target_dir, target_file))
+    with _file_locks_lock:
+        lock = _file_locks.get(file_path)
+        if lock is None:
+            lock = _file_locks[file_path] = Lock()
+    with lock:
+        yield
+
+
+def fsync_dir(dir_path: str) -> None:
+    '''
+    Make a rename in a directory durable
+    '''
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return  # directories cannot be opened on every platform
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_atomic(file_path: str, data: bytes) -> None:
+    '''
+    Replace a file with new content: write a temp file next to it,
+    flush it to disk, then rename it over the old one
+    '''
+    dir_path = os.path.dirname(file_path)
+    # the temp file does not end with .py, so it is never listed as a store file
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    fsync_dir(dir_path)
+
+
+def remove_func_file(target_dir: str, target_file: str) -> None:
+    '''
+    Remove the file of 1 function, the caller holds the lock of the file
+    '''
+    file_path = get_target_path(target_dir, target_file)
+    os.remove(file_path)
+    fsync_dir(os.path.dirname(file_path))
+
+
+def get_version(content: bytes) -> str:
+    '''
+    Id of a version, from the hash of its whole file
+    '''
+    return hashlib.sha256(content).hexdigest()[:16]
+
+
+def get_version_file(target_file: str, version: str) -> str:
+    '''
+    Store file of 1 version of a function, relative to the store and without extension
+    '''
+    return f'{target_file}/{version}'
+
+
+def split_version_file(store_file: str) -> Tuple[str, Union[str, None]]:
+    '''
+    Get the target and the version of a store file, the version is None for files without versions
+    '''
+    parts = store_file.split('/')
+    if len(parts) == 3 and VERSION.fullmatch(parts[2]):
+        return f'{parts[0]}/{parts[1]}', parts[2]
+    return store_file, None
+
+
+def is_versioned(target_dir: str, target_file: str) -> bool:
+    return os.path.isdir(os.path.join(target_dir, target_file))
+
+
+def get_versions(target_dir: str, target_file: str) -> List[str]:
+    '''
+    Get every stored version of a function, oldest first
+    '''
+    func_dir = os.path.join(target_dir, target_file)
+    try:
+        files = [(entry.stat().st_mtime_ns, entry.name[:-len('.py')]) for entry in os.scandir(func_dir)
+                 if entry.name.endswith('.py') and VERSION.fullmatch(entry.name[:-len('.py')])]
+    except OSError:
+        return []
+    return [version for _, version in sorted(files)]
+
+
+def read_cached(file_path: str, cache: LRUCache, load: Callable[[bytes], Any], default: Any) -> Any:
+    '''
+    Parse a small file of a function, again only when it changes
+    '''
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return default
+    cached = cache.get(file_path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    with open(file_path, 'rb') as f:
+        content = load(f.read())
+    cache.put(file_path, (stat.st_mtime_ns, stat.st_size, content))
+    return content
+
+
+def write_cached(file_path: str, cache: LRUCache, data: bytes, content: Any) -> None:
+    '''
+    Replace a small file of a function in 1 atomic rename, the caller holds the lock of the function
+    '''
+    write_atomic(file_path, data)
+    # a rewrite within the same mtime tick could look unchanged, so cache it right away
+    stat = os.stat(file_path)
+    cache.put(file_path, (stat.st_mtime_ns, stat.st_size, content))
+
+
+def read_aliases(target_dir: str, target_file: str) -> Dict[str, str]:
+    '''
+    Get the aliases of a function, re-read only when the aliases file changes.
+    The result must not be modified
+    '''
+    return read_cached(os.path.join(target_dir, target_file, ALIASES_FILE), aliases_cache, json.loads, {})
+
+
+def write_aliases(target_dir: str, target_file: str, aliases: Dict[str, str]) -> None:
+    '''
+    Replace the aliases of a function in 1 atomic rename, the caller holds the lock of the function
+    '''
+    write_cached(os.path.join(target_dir, target_file, ALIASES_FILE), aliases_cache,
+                 json.dumps(aliases, indent=2, sort_keys=True).encode(), dict(aliases))
+
+
+def read_requirements(target_dir: str, target_file: str) -> Dict[str, List[str]]:
+    '''
+    Get the libraries of each version of a function, versions without an environment are left out.
+    The result must not be modified
+    '''
+    return read_cached(os.path.join(target_dir, target_file, REQUIREMENTS_FILE), requirements_cache, json.loads, {})
+
+
+def write_requirements(target_dir: str, target_file: str, requirements: Dict[str, List[str]]) -> None:
+    '''
+    Replace the libraries of the versions of a function, the caller holds the lock of the function
+    '''
+    write_cached(os.path.join(target_dir, target_file, REQUIREMENTS_FILE), requirements_cache,
+                 json.dumps(requirements, indent=2, sort_keys=True).encode(), dict(requirements))
+
+
+def write_version(target_dir: str, target_file: str, content: str) -> str:
+    '''
+    Store a version of a function and return its id, an existing version is never rewritten
+    The caller holds the lock of the function
+    '''
+    data = content.encode()
+    version = get_version(data)
+    file_path = get_target_path(target_dir, get_version_file(target_file, version))
+    if not os.path.exists(file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        write_atomic(file_path, data)
+    return version
+
+
+def resolve_target(target_dir: str, target_file: str, alias: str = LATEST_ALIAS,
+                   version: Union[str, None] = None) -> Union[str, None]:
+    '''
+    Get the store file to run for a target: an explicit version, else the version an alias points to.
+    Files without versions resolve to themselves
+    '''
+    if not is_versioned(target_dir, target_file):
+        return target_file
+    if version is None:
+        version = read_aliases(target_dir, target_file).get(alias)
+    if version is None or not VERSION.fullmatch(version):
+        return None
+    return get_version_file(target_file, version)
+
+
+def remove_func_dir(target_dir: str, target_file: str) -> List[str]:
+    '''
+    Remove every version and alias of a function, return the store files that were removed
+    The caller holds the lock of the function
+    '''
+    versions = get_versions(target_dir, target_file)
+    shutil.rmtree(os.path.join(target_dir, target_file))
+    fsync_dir(os.path.dirname(os.path.join(target_dir, target_file)))
+    return [get_version_file(target_file, version) for version in versions]
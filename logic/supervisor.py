@@ -0,0 +1,162 @@
+import heapq
+import itertools
+import subprocess
+import time
+import psutil
+from threading import Condition, Thread
+from typing import List, Set, Union
+from config import MEMORY_ENFORCEMENT, MEMORY_SAMPLE_INTERVAL
+
+'''
+This file contains the supervisor that enforces resource limits on invokee processes.
+One thread watches every running process: deadlines are kept in a heap
+and memory is sampled at a fixed interval, so the cost stays flat
+no matter how many invocations are running
+'''
+
+
+class Watch:
+    '''
+    A process under supervision and the limits it has to respect
+    '''
+
+    def __init__(self, process: subprocess.Popen, time_limit: int, memory_limit: int) -> None:
+        self.process = process
+        self.deadline = time.monotonic() + time_limit
+        self.memory_limit = memory_limit
+        self.reason: Union[str, None] = None
+
+        try:
+            self.ps_process = psutil.Process(process.pid)
+            self.start_mem = self.ps_process.memory_info().rss
+        except psutil.Error:
+            self.ps_process = None
+            self.start_mem = 0
+        self.peak_rss = self.start_mem  # highest sampled memory usage
+
+    def sample(self) -> int:
+        '''
+        Current memory usage of the process in bytes, 0 once it is gone
+        '''
+        if self.ps_process is None:
+            return 0
+        try:
+            rss = self.ps_process.memory_info().rss
+        except psutil.Error:
+            return 0
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def over_mem_limit(self) -> bool:
+        rss = self.sample()
+        return rss > 0 and rss - self.start_mem > self.memory_limit
+
+    def kill(self, reason: str) -> None:
+        if self.reason is not None:
+            return
+        self.reason = reason
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+
+
+class Supervisor:
+    '''
+    Kill watched processes when they run out of time or memory
+    '''
+
+    def __init__(self, sample_memory: bool = MEMORY_ENFORCEMENT == 'sample',
+                 interval: float = MEMORY_SAMPLE_INTERVAL) -> None:
+        self.sample_memory = sample_memory
+        self.interval = interval
+        self.watches: Set[Watch] = set()
+        self.deadlines = []  # heap of (deadline, counter, watch)
+        self.counter = itertools.count()
+        self.cond = Condition()
+        self.thread = None
+
+    def watch(self, process: subprocess.Popen, time_limit: int, memory_limit: int) -> Watch:
+        '''
+        Start supervising a process
+        '''
+        watch = Watch(process, time_limit, memory_limit)
+        with self.cond:
+            self.watches.add(watch)
+            heapq.heappush(self.deadlines,
+                           (watch.deadline, next(self.counter), watch))
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return watch
+
+    def unwatch(self, watch: Watch) -> Union[str, None]:
+        '''
+        Stop supervising a process,
+        return why it was killed: 'time', 'memory' or None
+        '''
+        with self.cond:
+            self.watches.discard(watch)
+            # finished watches stay in the heap until their deadline, rebuild it once they dominate
+            if len(self.deadlines) > 2 * len(self.watches) + 16:
+                self.deadlines = [entry for entry in self.deadlines if entry[2] in self.watches]
+                heapq.heapify(self.deadlines)
+        # one last sample, short calls may never be sampled otherwise
+        watch.sample()
+        return watch.reason
+
+    def run(self) -> None:
+        next_sample = time.monotonic() + self.interval
+        while True:
+            with self.cond:
+                while not self.watches:
+                    self.deadlines.clear()
+                    self.cond.wait()
+
+                # Sleep until the closest deadline or the next memory sample
+                while self.deadlines and self.deadlines[0][2] not in self.watches:
+                    heapq.heappop(self.deadlines)
+                now = time.monotonic()
+                timeout = self.deadlines[0][0] - now if self.deadlines else None
+                if self.sample_memory:
+                    until_sample = max(next_sample - now, 0)
+                    timeout = until_sample if timeout is None else min(timeout, until_sample)
+                if timeout is None or timeout > 0:
+                    self.cond.wait(timeout)
+
+                now = time.monotonic()
+                expired: List[Watch] = []
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    _, _, watch = heapq.heappop(self.deadlines)
+                    if watch in self.watches:
+                        expired.append(watch)
+
+                sampled: List[Watch] = []
+                if self.sample_memory and now >= next_sample:
+                    sampled = list(self.watches)
+                    next_sample = now + self.interval
+
+            for watch in expired:
+                watch.kill('time')
+            for watch in sampled:
+                if watch.over_mem_limit():
+                    watch.kill('memory')
+
+
+def memory_limit_env(memory_limit: int) -> str:
+    '''
+    Value of INVOKEE_MEMORY_LIMIT for a child process,
+    the child applies it as an rlimit when the kernel enforces memory
+    '''
+    return str(memory_limit) if MEMORY_ENFORCEMENT == 'rlimit' else ''
+
+
+_supervisor = Supervisor()
+
+
+def get_supervisor() -> Supervisor:
+    '''
+    Get the shared supervisor of all invokee processes
+    '''
+    return _supervisor
@@ -0,0 +1,52 @@
+from typing import Any, BinaryIO
+import pickle
+import struct
+
+'''
+This file handles the binary channel between the API server and its invokee processes.
+Every message is a pickled object prefixed by its length
+'''
+
+HEADER = struct.Struct('!Q')  # 8 bytes, unsigned, network byte order
+
+
+def write_frame(stream: BinaryIO, obj: Any) -> None:
+    '''
+    Write a length-framed object to a binary stream
+    '''
+    payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    stream.write(HEADER.pack(len(payload)))
+    stream.write(payload)
+    stream.flush()
+
+
+def read_frame(stream: BinaryIO) -> Any:
+    '''
+    Read a length-framed object from a binary stream
+    Raise EOFError if the other end closed the channel
+    '''
+    return pickle.loads(read_payload(stream))
+
+
+def read_payload(stream: BinaryIO) -> bytearray:
+    '''
+    Read the pickled payload of a frame without decoding it
+    '''
+    (size,) = HEADER.unpack(read_exact(stream, HEADER.size))
+    return read_exact(stream, size)
+
+
+def read_exact(stream: BinaryIO, size: int) -> bytearray:
+    '''
+    Read exactly size bytes from a binary stream,
+    straight into one preallocated buffer
+    '''
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = stream.readinto(view[received:])
+        if not count:
+            raise EOFError('Channel closed by the other end')
+        received += count
+    return buffer
@@ -0,0 +1,222 @@
+from collections import deque
+from contextlib import redirect_stdout, redirect_stderr
+from typing import Any, Callable, Dict, List, Union
+import marshal
+import os
+import pickle
+import signal
+import sys
+import traceback
+from threading import Lock
+
+from .transport import read_frame, write_frame
+
+'''
+This file is the entrypoint of a warm worker process.
+A worker receives invocation requests over a pipe and keeps running between calls
+'''
+#!DO NOT IMPORT HEAVY MODULES HERE, THEY SLOW DOWN EVERY WORKER START!
+
+# Exit code of a one-off invokee that hit the kernel memory limit
+MEMORY_ERROR_EXIT = 3
+
+
+class LineBuffer:
+    '''
+    A file-like object that only keeps the last non-empty lines written to it
+    Each complete line can also be forwarded as soon as it is written
+    '''
+
+    def __init__(self, maxsize: int, forward: Callable[[str], None] = None) -> None:
+        self.lines = deque(maxlen=maxsize)
+        self.partial = ''
+        self.forward = forward
+
+    def write(self, text: str) -> int:
+        self.partial += text
+        *lines, self.partial = self.partial.split('\n')
+        for line in lines:
+            self.add_line(line + '\n')
+        return len(text)
+
+    def add_line(self, line: str) -> None:
+        if not line.strip():
+            return
+        self.lines.append(line)
+        if self.forward is not None:
+            self.forward(line)
+
+    def flush(self) -> None:
+        pass
+
+    def getvalue(self) -> str:
+        self.add_line(self.partial)
+        self.partial = ''
+        return ''.join(self.lines)
+
+
+def apply_memory_limit() -> None:
+    '''
+    Let the kernel enforce the memory limit of this process, if one is given.
+    The limit is counted on top of the memory used by the bare interpreter
+    '''
+    limit = os.environ.get('INVOKEE_MEMORY_LIMIT')
+    if not limit:
+        return
+
+    import resource
+    with open('/proc/self/statm') as f:
+        baseline = int(f.read().split()[0]) * resource.getpagesize()
+    resource.setrlimit(resource.RLIMIT_AS, (baseline + int(limit), resource.RLIM_INFINITY))
+
+
+class ItemTimeout(BaseException):
+    '''
+    Raised inside a batch item that runs longer than its own timeout
+    '''
+
+
+def raise_item_timeout(signum, frame) -> None:
+    raise ItemTimeout()
+
+
+def load_func(code: bytes, func_name: str) -> Callable:
+    '''
+    Load a prepared function from its marshalled code
+    '''
+    # Each request gets a fresh namespace so requests can not leak state to each other
+    namespace = {'__name__': 'invokee', '__builtins__': __builtins__}
+    exec(marshal.loads(code), namespace)
+    return namespace[func_name]
+
+
+def call_func(func: Callable, params: list, max_stdout: int, timeout: Union[float, None] = None,
+              forward: Callable[[str, str], None] = None) -> Dict[str, Any]:
+    '''
+    Call a function once and collect its output
+    forward receives ('stdout' | 'stderr', line) while the function runs
+    '''
+    stdout = LineBuffer(max_stdout, forward and (lambda line: forward('stdout', line)))
+    stderr = LineBuffer(max_stdout, forward and (lambda line: forward('stderr', line)))
+    response = {
+        'status': 'success',
+        'message': 'Function ran successfully',
+        'error': None,
+        'return_value': None,
+        'stdout': '',
+        'stderr': '',
+    }
+
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        if timeout:
+            signal.signal(signal.SIGALRM, raise_item_timeout)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            response['return_value'] = func(*params)
+        except ItemTimeout:
+            response['status'] = 'error'
+            response['message'] = response['error'] = 'Function exceeded the item timeout'
+        except MemoryError:
+            # raised by the kernel limit, report it the same way as a sampled one
+            response['status'] = 'error'
+            response['message'] = response['error'] = 'Function exceeded the memory limit'
+            traceback.print_exc()
+        except BaseException as e:
+            response['error'] = repr(e)
+            traceback.print_exc()
+        finally:
+            if timeout:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+
+    response['stdout'] = stdout.getvalue()
+    response['stderr'] = stderr.getvalue()
+    return response
+
+
+def run_batch(func: Callable, items: List[list], max_stdout: int, item_timeout: Union[float, None] = None) -> Dict[str, Any]:
+    '''
+    Call a function once per item, results are kept in order
+    '''
+    return {
+        'status': 'success',
+        'message': 'Batch ran successfully',
+        'results': [call_func(func, params, max_stdout, item_timeout) for params in items],
+    }
+
+
+def run_request(request: Dict[str, Any], forward: Callable[[str, str], None] = None) -> Dict[str, Any]:
+    '''
+    Run one invocation request, either a single call or a batch
+    '''
+    try:
+        func = load_func(request['code'], request['func_name'])
+    except BaseException:
+        func = None
+        error = traceback.format_exc()
+
+    if 'items' in request:
+        if func is None:
+            # the traceback stays out of the message, the API answers with it
+            return {'status': 'error', 'message': 'Function could not be loaded', 'error': error,
+                    'stdout': '', 'stderr': error, 'results': []}
+        return run_batch(func, request['items'], request['max_stdout'], request.get('item_timeout'))
+
+    if func is None:
+        if forward is not None:
+            forward('stderr', error)
+        return {'status': 'success', 'message': 'Function ran successfully', 'error': error,
+                'return_value': None, 'stdout': '', 'stderr': error}
+    return call_func(func, request['params'], request['max_stdout'], forward=forward)
+
+
+def make_sendable(response: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Drop the return values that can not be sent back (e.g. not picklable)
+    '''
+    for item in response.get('results', [response]):
+        try:
+            pickle.dumps(item['return_value'])
+        except Exception as e:
+            item['return_value'] = None
+            item['error'] = f'Return value could not be sent back: {e}'
+            item['stderr'] += item['error'] + '\n'
+    return response
+
+
+def main() -> None:
+    '''
+    Serve invocation requests until the API server closes the pipe
+    '''
+    apply_memory_limit()
+
+    # Keep private copies of the pipes, user code must not write to the channel
+    channel_in = os.fdopen(os.dup(sys.stdin.fileno()), 'rb')
+    channel_out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, sys.stdin.fileno())
+    os.dup2(devnull, sys.stdout.fileno())
+
+    while True:
+        try:
+            request = read_frame(channel_in)
+        except EOFError:
+            break
+
+        # streamed output is sent as (stream name, line) frames before the response
+        forward = None
+        if request.get('stream'):
+            lock = Lock()
+
+            def forward(name: str, line: str) -> None:
+                with lock:
+                    write_frame(channel_out, (name, line))
+
+        response = run_request(request, forward)
+        try:
+            write_frame(channel_out, response)
+        except Exception:
+            write_frame(channel_out, make_sendable(response))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+import atexit
+import json
+import os
+import runpy
+import select
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import traceback
+import psutil
+from importlib import import_module
+from threading import Lock, Thread
+from typing import Dict, List, Sequence, Union
+from config import ZYGOTE_ENABLED, ZYGOTE_PRELOAD
+
+'''
+This file contains the zygote, a process that imports heavy libraries once and forks invokees on demand.
+Forked invokees start with those libraries loaded and share their memory pages copy-on-write,
+instead of each importing its own copy in a new interpreter.
+The API server asks for a process over a Unix socket, its pipes are passed along with SCM_RIGHTS.
+The zygote sends back the pid of the process, then its exit code once it exits.
+A retired zygote stops forking and exits once its last process did, so running invocations are never cut short
+'''
+#!DO NOT IMPORT HEAVY MODULES HERE, THE ZYGOTE ONLY IMPORTS WHAT IT IS ASKED TO!
+
+PID = struct.Struct('!i')  # pid, then exit code, sent back on the connection of a request
+SIZE = struct.Struct('!I')  # length of a request
+MAX_FDS = 16  # file descriptors passed with 1 request
+LOST_EXIT = -1  # exit code of a process whose zygote died before it, its real one is lost
+
+
+def recv_exact(conn: socket.socket, size: int) -> Union[bytes, None]:
+    '''
+    Read exactly size bytes from a socket, None if it was closed first
+    '''
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class ZygoteProcess:
+    '''
+    A process forked by the zygote, used like a subprocess.Popen
+    It is not a child of the API server, its exit code comes from the zygote
+    '''
+
+    def __init__(self, conn: socket.socket, pid: int) -> None:
+        self.conn = conn
+        self.pid = pid
+        self.returncode: Union[int, None] = None
+        self.stdin = self.stdout = self.stderr = None
+        self.lock = Lock()
+        try:
+            # psutil remembers when the process started, so a pid reused after it exited is never signaled
+            self.ps_process = psutil.Process(pid)
+        except psutil.Error:
+            self.ps_process = None
+
+    def read_exit_code(self, timeout: Union[float, None]) -> bool:
+        '''
+        Wait up to timeout for the exit code, False if the process is still running
+        '''
+        if self.conn is not None:
+            if not select.select([self.conn], [], [], timeout)[0]:
+                return False
+            data = recv_exact(self.conn, PID.size)
+            self.conn.close()
+            self.conn = None
+            if data is not None:
+                (self.returncode,) = PID.unpack(data)
+                return True
+
+        # the zygote died first, the process is an orphan now and only its end can be watched
+        try:
+            if self.ps_process is not None:
+                self.ps_process.wait(timeout)
+        except psutil.TimeoutExpired:
+            return False
+        except psutil.Error:
+            pass
+        self.returncode = LOST_EXIT
+        return True
+
+    def poll(self) -> Union[int, None]:
+        with self.lock:
+            if self.returncode is None:
+                self.read_exit_code(0)
+            return self.returncode
+
+    def wait(self, timeout: Union[float, None] = None) -> int:
+        with self.lock:
+            if self.returncode is None and not self.read_exit_code(timeout):
+                raise subprocess.TimeoutExpired(str(self.pid), timeout)
+            return self.returncode
+
+    def kill(self) -> None:
+        if self.returncode is None and self.ps_process is not None:
+            try:
+                self.ps_process.kill()
+            except psutil.Error:
+                pass
+
+
+class Zygote:
+    '''
+    The API server side of a zygote process
+    '''
+
+    def __init__(self, modules: Sequence[str]) -> None:
+        self.dir = tempfile.mkdtemp(prefix='zygote-')
+        self.path = os.path.join(self.dir, 'zygote.sock')
+        # the zygote exits once its stdin is closed, so it never outlives the API server
+        self.process = subprocess.Popen(['python3', '-m', 'logic.zygote', self.path, *modules],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=os.getcwd())
+        if self.process.stdout.readline() != b'ready\n':
+            self.stop()
+            raise RuntimeError('Zygote did not start')
+        self.process.stdout.close()
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def spawn(self, argv: List[str], fds: Dict[int, int], env: Dict[str, str]) -> ZygoteProcess:
+        '''
+        Fork a process running argv like python would ('-m', module or a script path).
+        fds maps each fd number of the process to an fd of the API server, env is added to the environment
+        '''
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.path)
+            request = json.dumps({'argv': argv, 'fds': list(fds), 'env': env}).encode()
+            socket.send_fds(conn, [SIZE.pack(len(request)) + request], list(fds.values()))
+            data = recv_exact(conn, PID.size)
+            if data is None:
+                raise OSError('Zygote closed the connection')
+        except BaseException:
+            conn.close()
+            raise
+        return ZygoteProcess(conn, PID.unpack(data)[0])
+
+    def retire(self) -> None:
+        '''
+        Stop forking, the zygote exits once every process it forked did
+        '''
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        Thread(target=self.cleanup, name='zygote-retire', daemon=True).start()
+
+    def cleanup(self) -> None:
+        self.process.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def stop(self) -> None:
+        if self.alive():
+            self.process.kill()
+        self.cleanup()
+
+
+_zygote: Union[Zygote, None] = None
+_zygote_lock = Lock()
+
+
+def get_zygote() -> Union[Zygote, None]:
+    '''
+    Get the zygote, start it on first use or after it died
+    None if it is disabled or can not run on this platform
+    '''
+    global _zygote
+    if not ZYGOTE_ENABLED or not hasattr(os, 'fork') or not hasattr(socket, 'send_fds'):
+        return None
+
+    with _zygote_lock:
+        if _zygote is not None and not _zygote.alive():
+            _zygote.cleanup()
+            _zygote = None
+        if _zygote is None:
+            try:
+                _zygote = Zygote(ZYGOTE_PRELOAD)
+            except Exception as e:
+                print('Could not start the zygote:', e)
+                return None
+        return _zygote
+
+
+def retire_zygote() -> None:
+    '''
+    Retire the zygote, the next process comes from a new one importing the libraries again
+    '''
+    global _zygote
+    with _zygote_lock:
+        if _zygote is not None:
+            _zygote.retire()
+            _zygote = None
+
+
+atexit.register(retire_zygote)
+
+
+def popen(argv: List[str], env: Dict[str, str], stdin: int = subprocess.DEVNULL, stdout: Union[int, None] = None,
+          stderr: Union[int, None] = None, pass_fds: Sequence[int] = (), text: bool = False) -> Union[ZygoteProcess, None]:
+    '''
+    Start a process from the zygote, like subprocess.Popen would start python with argv
+    stdin, stdout and stderr are subprocess.PIPE, subprocess.DEVNULL or None to share the ones of the API server
+    None if there is no zygote, the caller starts the process itself then
+    '''
+    zygote = get_zygote()
+    if zygote is None:
+        return None
+
+    child_fds, parent_ends, child_ends = {}, {}, []
+    for fd, mode in ((0, stdin), (1, stdout), (2, stderr)):
+        if mode == subprocess.PIPE:
+            read_end, write_end = os.pipe()
+            child, parent_ends[fd] = (read_end, write_end) if fd == 0 else (write_end, read_end)
+            child_ends.append(child)
+        elif mode == subprocess.DEVNULL:
+            child = os.open(os.devnull, os.O_RDWR)
+            child_ends.append(child)
+        else:
+            child = fd
+        child_fds[fd] = child
+    for fd in pass_fds:
+        child_fds[fd] = fd
+
+    try:
+        process = zygote.spawn(argv, child_fds, env)
+    except OSError as e:
+        print('Could not fork from the zygote:', e)
+        for fd in parent_ends.values():
+            os.close(fd)
+        return None
+    finally:
+        for fd in child_ends:
+            os.close(fd)
+
+    if 0 in parent_ends:
+        process.stdin = os.fdopen(parent_ends[0], 'w' if text else 'wb')
+    if 1 in parent_ends:
+        process.stdout = os.fdopen(parent_ends[1], 'r' if text else 'rb')
+    if 2 in parent_ends:
+        process.stderr = os.fdopen(parent_ends[2], 'r' if text else 'rb')
+    return process
+
+
+def run_child(request: dict, fds: List[int], inherited: List[int]) -> None:
+    '''
+    Turn a freshly forked zygote into the requested process, never returns
+    '''
+    code = 1
+    try:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for fd in inherited:
+            os.close(fd)
+
+        # move the received fds above the ones they replace, then onto the numbers the process expects
+        moved = [os.dup(fd) for fd in fds]
+        for fd in fds:
+            os.close(fd)
+        high = [os.dup2(fd, 256 + i) for i, fd in enumerate(moved)]
+        for fd in moved:
+            os.close(fd)
+        for target, fd in zip(request['fds'], high):
+            os.dup2(fd, target)
+            os.close(fd)
+
+        # modules seeded at import would give every child the same random numbers
+        if 'numpy' in sys.modules:
+            sys.modules['numpy'].random.seed()
+
+        # same sys.path as python started with argv: the script directory or cwd, then PYTHONPATH
+        argv = request['argv']
+        sys.path[0] = os.getcwd() if argv[0] == '-m' else os.path.dirname(os.path.abspath(argv[0]))
+        os.environ.update(request['env'])
+        paths = [path for path in request['env'].get('PYTHONPATH', '').split(os.pathsep) if path]
+        sys.path[1:1] = [path for path in paths if path not in sys.path]
+
+        if argv[0] == '-m':
+            sys.argv = argv[1:]
+            runpy.run_module(argv[1], run_name='__main__', alter_sys=True)
+        else:
+            sys.argv = argv
+            runpy.run_path(argv[0], run_name='__main__')
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException as e:
+        # print the traceback python would, without the frames of the zygote
+        tb = e.__traceback__
+        while tb is not None and tb.tb_frame.f_code.co_filename in (__file__, runpy.__file__, '<frozen runpy>'):
+            tb = tb.tb_next
+        traceback.print_exception(type(e), e, tb)
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def serve(socket_path: str, modules: List[str]) -> None:
+    '''
+    Import the modules, then fork 1 process per request until the API server retires the zygote or goes away.
+    Exit codes are still sent after that, the zygote exits once its last process did
+    '''
+    for name in ['logic.worker', 'logic.transport', *modules]:
+        try:
+            import_module(name)
+        except Exception as e:
+            print(f'Zygote could not preload {name}:', e, file=sys.stderr)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(64)
+
+    # SIGCHLD wakes the loop up through a pipe, exited processes are reaped there
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    children: Dict[int, socket.socket] = {}  # pid -> connection waiting for its exit code
+
+    sys.stdout.write('ready\n')
+    sys.stdout.flush()
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+
+    forking = True
+    while forking or children:
+        sources = [wakeup_read, listener, sys.stdin.fileno()] if forking else [wakeup_read]
+        try:
+            readable = select.select(sources, [], [])[0]
+        except InterruptedError:
+            continue
+
+        if forking and sys.stdin.fileno() in readable and not os.read(sys.stdin.fileno(), 1024):
+            # retired or the API server is gone
+            forking = False
+            listener.close()
+            os.unlink(socket_path)
+
+        if wakeup_read in readable:
+            os.read(wakeup_read, 1024)
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if pid == 0:
+                    break
+                conn = children.pop(pid, None)
+                if conn is not None:
+                    try:
+                        conn.sendall(PID.pack(os.waitstatus_to_exitcode(status)))
+                    except OSError:
+                        pass
+                    conn.close()
+
+        if forking and listener in readable:
+            conn, _ = listener.accept()
+            fds = []
+            try:
+                message, fds, _, _ = socket.recv_fds(conn, 65536, MAX_FDS)
+                (size,) = SIZE.unpack(message[:SIZE.size])
+                data = message[SIZE.size:]
+                if len(data) < size:
+                    data += recv_exact(conn, size - len(data)) or b''
+                request = json.loads(data)
+
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    inherited = [listener.fileno(), conn.fileno(), wakeup_read, wakeup_write,
+                                 *(other.fileno() for other in children.values())]
+                    run_child(request, fds, inherited)
+                children[pid] = conn
+                conn.sendall(PID.pack(pid))
+            except Exception as e:
+                print('Zygote could not fork:', e, file=sys.stderr)
+                conn.close()
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1], sys.argv[2:])
@@ -1,32 +1,90 @@
 from pydantic import BaseModel, Field
-from typing import List, Any
+from typing import List, Any, Optional
+
+class TokenRequest(BaseModel):
+    username: str
+    password: str
+
 
 class GetUserFuncsRequest(BaseModel):
     username: str = Field('admin')
     password: str = Field('admin')
+    token: Optional[str] = None  # session token, replaces username and password
 
 
 class CreateFuncRequest(BaseModel):
     content: str
+    deterministic: bool = False  # same params always give the same result
     username: str = Field('admin')
     password: str = Field('admin')
 
 
+class BulkCreateFuncRequest(BaseModel):
+    functions: List[CreateFuncRequest]
+    username: Optional[str] = None  # author of every function, overrides the ones in functions
+    password: Optional[str] = None
+
+
 class ExecFuncRequest(BaseModel):
     params: List[Any]
     target: str  # a file that contains the function
+    alias: str = Field('latest')  # alias of the version to run
+    version: Optional[str] = None  # version to run, overrides alias
+    username: str = Field('admin')
+    password: str = Field('admin')
+    token: Optional[str] = None  # session token, replaces username and password
+
+
+class BatchExecFuncRequest(BaseModel):
+    items: List[List[Any]]  # one params list per invocation
+    target: str  # a file that contains the function
+    alias: str = Field('latest')  # alias of the version to run
+    version: Optional[str] = None  # version to run, overrides alias
+    item_timeout: Optional[float] = None  # seconds, per item
+    username: str = Field('admin')
+    password: str = Field('admin')
+    token: Optional[str] = None  # session token, replaces username and password
+
+
+class VersionsRequest(BaseModel):
+    target: str
     username: str = Field('admin')
     password: str = Field('admin')
+    token: Optional[str] = None  # session token, replaces username and password
+
+
+class AliasRequest(BaseModel):
+    target: str
+    version: str  # version the alias points to from now on
+    username: str = Field('admin')
+    password: str = Field('admin')
+    token: Optional[str] = None  # session token, replaces username and password
 
 
 class ModifyFuncRequest(BaseModel):
     content: str
     target: str
+    username: str = Field('admin')
+    password: str = Field('admin')
+    token: Optional[str] = None  # session token, replaces username and password
 
 
 class DelFuncRequest(BaseModel):
     target: str
+    username: str = Field('admin')
+    password: str = Field('admin')
+    token: Optional[str] = None  # session token, replaces username and password
 
 
 class LibInstallRequest(BaseModel):
     libs: List[str]
+
+
+class FuncLibInstallRequest(BaseModel):
+    libs: List[str]
+    target: str  # the function whose environment gets the libraries
+    alias: str = Field('latest')  # alias of the version that gets the libraries
+    version: Optional[str] = None  # version that gets the libraries, overrides alias
+    username: str = Field('admin')
+    password: str = Field('admin')
+    token: Optional[str] = None  # session token, replaces username and password
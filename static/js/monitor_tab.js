@@ -19,10 +19,20 @@ const executeButton = document.getElementById("execute-btn");
 const closeButton = document.getElementById("close-res-container");
 const resContainer = document.getElementById("display-res");
 
-// Fetch all cloud functions from the server
-const fetchFunctions = async () => {
+// Functions shown on 1 page, 5x5
+const pageSize = 25;
+// Cursors of the pages before the current one, and of the current one
+const previousCursors = [];
+let currentCursor = null;
+
+// Fetch 1 page of cloud functions from the server
+const fetchFunctions = async (cursor) => {
   try {
-    const response = await fetch(`${config.API_URL}/users/functions`, {
+    const query = new URLSearchParams({ limit: pageSize });
+    if (cursor) {
+      query.set("cursor", cursor);
+    }
+    const response = await fetch(`${config.API_URL}/users/functions?${query}`, {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
@@ -45,25 +55,22 @@ const fetchFunctions = async () => {
     }
 
     const data = await response.json();
-    return data.data.functions;
+    return data.data;
   } catch (error) {
     console.error("Fetch error: ", error);
   }
 };
 
-// Display the fetched functions in a paginated format
-const displayFunctions = (functions) => {
-  if (isEmpty(functions)) {
+// Display 1 fetched page of functions, with buttons to the pages around it
+const displayFunctions = (page) => {
+  if (!page || isEmpty(page.functions)) {
     displayNoFunctionsMessage();
     return;
   }
 
-  const flattenedFunctions = flattenFunctions(functions);
-  const pageSize = 25; // 5x5
-  const numberOfPages = calculateNumberOfPages(flattenedFunctions, pageSize);
-
-  createPaginationButtons(numberOfPages, flattenedFunctions, pageSize);
-  displayPage(flattenedFunctions, 0, pageSize);
+  const flattenedFunctions = flattenFunctions(page.functions);
+  displayPage(flattenedFunctions);
+  createPaginationButtons(page.next_cursor);
 };
 
 // Check if the functions object is empty
@@ -91,40 +98,57 @@ const flattenFunctions = (functions) => {
   return flatFuncs;
 };
 
-// Calculate the number of pages
-const calculateNumberOfPages = (flattenedFunctions, pageSize) => {
-  return Math.ceil(flattenedFunctions.length / pageSize);
-};
-
-// Create the pagination buttons
-const createPaginationButtons = (
-  numberOfPages,
-  flattenedFunctions,
-  pageSize
-) => {
+// Create the previous and next page buttons, pages are fetched when clicked
+const createPaginationButtons = (nextCursor) => {
   const pagination = document.createElement("div");
-  for (let i = 0; i < numberOfPages; i++) {
-    const button = createPaginationButton(i, flattenedFunctions, pageSize);
-    pagination.appendChild(button);
+  if (previousCursors.length > 0) {
+    const cursor = previousCursors[previousCursors.length - 1];
+    pagination.appendChild(
+      createPaginationButton("Previous", async () => {
+        previousCursors.pop();
+        await goToPage(cursor);
+      })
+    );
+  }
+  pagination.appendChild(createPageNumber());
+  if (nextCursor) {
+    pagination.appendChild(
+      createPaginationButton("Next", async () => {
+        previousCursors.push(currentCursor);
+        await goToPage(nextCursor);
+      })
+    );
   }
   monitorContainer.appendChild(pagination);
 };
 
 // Create a single pagination button
-const createPaginationButton = (pageIndex, flattenedFunctions, pageSize) => {
+const createPaginationButton = (label, onClick) => {
   const button = document.createElement("button");
-  button.textContent = pageIndex + 1;
-  button.addEventListener("click", () =>
-    displayPage(flattenedFunctions, pageIndex, pageSize)
-  );
+  button.textContent = label;
+  button.addEventListener("click", onClick);
   return button;
 };
 
+// Show the number of the current page
+const createPageNumber = () => {
+  const pageNumber = document.createElement("span");
+  pageNumber.textContent = ` Page ${previousCursors.length + 1} `;
+  return pageNumber;
+};
+
+// Fetch and display the page that starts at a cursor
+const goToPage = async (cursor) => {
+  currentCursor = cursor;
+  const page = await fetchFunctions(cursor);
+  displayFunctions(page);
+};
+
 // Display a page of functions
-const displayPage = (flattenedFunctions, pageIndex, pageSize) => {
+const displayPage = (flattenedFunctions) => {
   clearMonitorContainer();
   const grid = createGrid();
-  addFunctionsToGrid(flattenedFunctions, pageIndex, pageSize, grid);
+  addFunctionsToGrid(flattenedFunctions, grid);
   monitorContainer.appendChild(grid);
 };
 
@@ -145,13 +169,11 @@ const createGrid = () => {
 };
 
 // Add the functions to the grid
-const addFunctionsToGrid = (flattenedFunctions, pageIndex, pageSize, grid) => {
-  const start = pageIndex * pageSize;
-  const end = start + pageSize;
-  for (let i = start; i < end && i < flattenedFunctions.length; i++) {
-    const button = createFunctionButton(flattenedFunctions[i]);
+const addFunctionsToGrid = (flattenedFunctions, grid) => {
+  flattenedFunctions.forEach((func) => {
+    const button = createFunctionButton(func);
     grid.appendChild(button);
-  }
+  });
 };
 
 // Create a button for a single function
@@ -322,22 +344,78 @@ const createResultElement = (label, result) => {
   return p;
 };
 
-// Fetch and display functions
+// Fetch and display the first page of functions
 const fetchAndDisplayFunctions = async () => {
-  const functions = await fetchFunctions();
-  displayFunctions(functions);
+  previousCursors.length = 0;
+  await goToPage(null);
 };
 
-// Execute a function
+// Execute a function, show its output while it runs
 const executeFunction = async () => {
   const params = getParams();
   const funcName = funcNameElement.textContent;
   const target = funcStoreElement.textContent;
 
+  const res = { return_value: "Running...", stdout: "", stderr: "" };
+  displayExecResult(res);
+
   const response = await sendExecuteRequest(funcName, target, params);
-  const data = await response.json();
+  if (!response) {
+    res.return_value = "Could not reach the server";
+    displayExecResult(res);
+    return;
+  }
 
-  displayExecResult(data.data);
+  // Rejected or failed requests answer with JSON instead of an event stream
+  const contentType = response.headers.get("Content-Type") || "";
+  if (!response.ok || !contentType.startsWith("text/event-stream") || !response.body) {
+    const data = await response.json().catch(() => null);
+    res.return_value = data && data.message ? data.message : `Server error ${response.status}`;
+    displayExecResult(res);
+    return;
+  }
+
+  let finished = false;
+  await readEventStream(response, (event, data) => {
+    if (event === "result") {
+      finished = true;
+      res.return_value = data.status === "success" ? data.return_value : data.message;
+    } else {
+      res[event] += data.line;
+    }
+    displayExecResult(res);
+  });
+
+  if (!finished) {
+    res.return_value = "Function did not return a result";
+    displayExecResult(res);
+  }
+};
+
+// Read Server-Sent Events from a response, call onEvent for each of them
+const readEventStream = async (response, onEvent) => {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+
+    // Events are separated by a blank line
+    const events = buffer.split("\n\n");
+    buffer = events.pop();
+    events.forEach((raw) => {
+      const event = raw.match(/^event: (.*)$/m);
+      const data = raw.match(/^data: (.*)$/m);
+      if (event && data) {
+        onEvent(event[1], JSON.parse(data[1]));
+      }
+    });
+  }
 };
 
 // Get the parameters from the input fields
@@ -367,7 +445,7 @@ const sendExecuteRequest = async (funcName, target, params) => {
   };
 
   try {
-    const response = await fetch(`${config.API_URL}/execute/${funcName}`, {
+    const response = await fetch(`${config.API_URL}/execute/${funcName}?mode=stream`, {
       method: "POST",
       credentials: "same-origin",
       headers: {
@@ -377,15 +455,14 @@ const sendExecuteRequest = async (funcName, target, params) => {
     });
 
     if (!response.ok) {
-      const errorData = await response.json();
-      console.error("Server error on executing function: ", errorData);
+      console.error("Server error on executing function: ", response.status);
     }
 
     return response;
 
   } catch (error) {
     console.error("Error on executing function: ", error);
-    return response;
+    return null;
   }
 
 };
@@ -418,5 +495,6 @@ executeButton.addEventListener("click", executeFunction);
 // Close the function details when the close button is clicked
 closeButton.addEventListener("click", closeFunctionDetails);
 
-// Fetch and display functions every 5 seconds
-setInterval(fetchAndDisplayFunctions, 5000);
+// Fetch and display functions, then refresh the current page every 5 seconds
+fetchAndDisplayFunctions();
+setInterval(() => goToPage(currentCursor), 5000);
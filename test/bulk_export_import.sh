@@ -0,0 +1,12 @@
+port='9999'  # The port that the server is running on
+
+# back up every function of a user, as a JSON array
+curl -s -X POST "http://localhost:$port/api/users/functions/export" \
+     -H 'Content-Type: application/json' \
+     -d '{"username": "test", "password": "test"}' > functions_backup.json
+
+# add them all back in 1 request, as another user
+jq '{functions: ., username: "test_copy", password: "test"}' functions_backup.json | \
+curl -X POST "http://localhost:$port/api/functions/bulk" \
+     -H 'Content-Type: application/json' \
+     -d @-
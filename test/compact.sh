@@ -0,0 +1,7 @@
+port='9999'  # The port that the server is running on
+
+# Start a compaction, or get the one already running
+curl -X POST http://localhost:$port/api/admin/compact
+
+# Poll its status
+curl http://localhost:$port/api/admin/compact
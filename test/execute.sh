@@ -1,5 +1,5 @@
 params='[5]'  # The parameters for the function, as a JSON array
-target='0'  # The file that contains the function
+target='test/pascal_triangle'  # The function, as listed by get_user_funcs
 port='9999'  # The port that the server is running on
 
 json_data=$(jq -n \
@@ -0,0 +1,12 @@
+params='[5]'  # The parameters for the function, as a JSON array
+target='test/pascal_triangle'  # The function, as listed by get_user_funcs
+port='9999'  # The port that the server is running on
+
+json_data=$(jq -n \
+                --arg target "$target" \
+                --argjson params "$params" \
+                '{"params":$params, "target":$target, "username":"test", "password":"test"}')
+
+job_id=$(curl -s -X POST -H "Content-Type: application/json" -d "$json_data" "http://localhost:$port/api/execute/pascal_triangle?mode=async" | jq -r '.data.job_id')
+sleep 1
+curl http://localhost:$port/api/jobs/$job_id
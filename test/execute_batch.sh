@@ -0,0 +1,10 @@
+items='[[1], [3], [5]]'  # One parameter list per invocation
+target='test/pascal_triangle'  # The function, as listed by get_user_funcs
+port='9999'  # The port that the server is running on
+
+json_data=$(jq -n \
+                --arg target "$target" \
+                --argjson items "$items" \
+                '{"items":$items, "target":$target, "item_timeout":10, "username":"test", "password":"test"}')
+
+curl -X POST -H "Content-Type: application/json" -d "$json_data" http://localhost:$port/api/execute/pascal_triangle/batch
@@ -0,0 +1,15 @@
+port='9999'  # The port that the server is running on
+limit=25  # Functions per page
+prefix='pascal'  # Only functions whose name starts with this
+
+# first page, then follow data.next_cursor until it is null
+cursor=''
+while :; do
+    page=$(curl -s -G "http://localhost:$port/api/admin/functions" \
+         --data-urlencode "limit=$limit" \
+         --data-urlencode "prefix=$prefix" \
+         --data-urlencode "cursor=$cursor")
+    echo "$page"
+    cursor=$(echo "$page" | jq -r '.data.next_cursor // empty')
+    [ -z "$cursor" ] && break
+done
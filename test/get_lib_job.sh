@@ -0,0 +1,4 @@
+job_id=''  # The job id returned by install_libs or install_func_libs
+port='9999'  # The port that the server is running on
+
+curl http://localhost:$port/api/libs/jobs/$job_id
@@ -0,0 +1,13 @@
+port='9999'  # The port that the server is running on
+
+token=$(curl -s -X POST "http://localhost:$port/api/auth/token" \
+     -H 'Content-Type: application/json' \
+     -d '{
+         "username": "test",
+         "password": "test"
+     }' | jq -r '.data.token')
+
+# the token replaces username and password until it expires
+curl -X POST "http://localhost:$port/api/users/functions" \
+     -H 'Content-Type: application/json' \
+     -d "{\"token\": \"$token\"}"
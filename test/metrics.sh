@@ -0,0 +1,3 @@
+port='9999'  # The port that the server is running on
+
+curl http://localhost:$port/metrics
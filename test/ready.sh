@@ -0,0 +1,4 @@
+port='9999'  # The port that the server is running on
+
+# 503 until the libraries are installed, 200 afterwards
+curl -i http://localhost:$port/api/ready
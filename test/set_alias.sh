@@ -0,0 +1,11 @@
+target='test/pascal_triangle'  # The function, as listed by get_user_funcs
+version=$1  # The version to deploy, as listed by versions.sh
+port='9999'  # The port that the server is running on
+
+json_data=$(jq -n \
+                --arg target "$target" \
+                --arg version "$version" \
+                '{"target":$target, "version":$version, "username":"test", "password":"test"}')
+
+# point prod to the version, run it with "alias": "prod" in execute requests
+curl -X PUT -H "Content-Type: application/json" -d "$json_data" http://localhost:$port/api/functions/pascal_triangle/aliases/prod
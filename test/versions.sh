@@ -0,0 +1,8 @@
+target='test/pascal_triangle'  # The function, as listed by get_user_funcs
+port='9999'  # The port that the server is running on
+
+json_data=$(jq -n \
+                --arg target "$target" \
+                '{"target":$target, "username":"test", "password":"test"}')
+
+curl -X POST -H "Content-Type: application/json" -d "$json_data" http://localhost:$port/api/functions/pascal_triangle/versions
@@ -8,12 +8,13 @@ This file contains all the utility functions used in the app
 
 def get_files(target_dir: str) -> List[str]:
     '''
-    Get all files in the target directory
+    Get all files in the target directory and its subdirectories,
+    as paths relative to the target directory
     '''
     files = []
     for root, dirs, filenames in os.walk(target_dir):
         for file in filenames:
-            files.append(file)
+            files.append(os.path.relpath(os.path.join(root, file), target_dir))
     return files
 
 